@@ -0,0 +1,427 @@
+"""
+Архив холодных яиц (hot/cold tiering для eggs_detail)
+
+eggs_detail растет бесконечно, а снимок держит его в памяти целиком. Яйца,
+которые уже не изменятся (полностью вылупленные) или давно отправлены
+(старше N дней), переносятся из памяти в архив на диске:
+
+- сегменты архива - файлы segment-NNNNNN.jsonl, куда записи только дописываются
+  (одна строка JSON на яйцо: детальная информация, данные multi egg, флаг вылупления);
+- индекс - SQLite база index.sqlite3: ключ яйца -> сегмент, смещение и длина
+  записи, плюс колонки для поиска (egg_id, sender_id, hatched_by).
+
+Если яйцо снова понадобилось (нажали кнопку под старым сообщением), хранилище
+подгружает его обратно в память через fault_in(). Запросы Eggchain Explorer
+проваливаются в архив прозрачно через методы поиска StorageBackend.
+
+Повторная запись того же яйца дописывает новую строку в сегмент и переключает
+индекс на нее, старая строка остается мусором в сегменте.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'index.sqlite3'
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.jsonl'
+# Новый сегмент начинается, когда текущий дорос до этого размера
+SEGMENT_MAX_BYTES = 64 << 20
+
+# Флаги индекса по коллекциям состояния
+ARCHIVE_FLAGS = {
+    'eggs_detail': 'in_detail',
+    'multi_eggs': 'in_multi',
+    'hatched_eggs': 'in_hatched'
+}
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived_eggs (
+    egg_key TEXT PRIMARY KEY,
+    egg_id TEXT,
+    sender_id INTEGER,
+    hatched_by INTEGER,
+    in_detail INTEGER NOT NULL DEFAULT 0,
+    in_multi INTEGER NOT NULL DEFAULT 0,
+    in_hatched INTEGER NOT NULL DEFAULT 0,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archived_eggs_egg_id ON archived_eggs(egg_id);
+CREATE INDEX IF NOT EXISTS archived_eggs_sender ON archived_eggs(sender_id);
+CREATE INDEX IF NOT EXISTS archived_eggs_hatched_by ON archived_eggs(hatched_by);
+"""
+
+
+class ArchivedEgg:
+    """Яйцо из архива: данные из всех коллекций, где оно было"""
+
+    __slots__ = ('egg_key', 'detail', 'multi', 'hatched')
+
+    def __init__(self, egg_key, detail, multi, hatched):
+        self.egg_key = egg_key
+        self.detail = detail
+        self.multi = multi
+        self.hatched = hatched
+
+
+class EggArchive:
+    """Сегменты архива яиц + индекс в SQLite
+
+    Методы безопасны для вызова из разных потоков (цикл событий, поток записи).
+    readonly=True - режим Eggchain Explorer без бота: только поиск.
+    """
+
+    def __init__(self, directory, readonly=False, segment_max_bytes=SEGMENT_MAX_BYTES):
+        self.directory = directory
+        self.readonly = readonly
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.RLock()
+        # Открытые дескрипторы сегментов для чтения: {номер сегмента: fd}
+        self._read_fds = {}
+
+        index_path = os.path.join(directory, INDEX_NAME)
+        if readonly:
+            self._conn = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(index_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(INDEX_SCHEMA)
+
+        self._segment = self._last_segment()
+
+        # Метрики
+        self.appended = 0
+        self.appended_bytes = 0
+        self.lookups = 0
+
+    @classmethod
+    def open_existing(cls, directory):
+        """Открывает архив только для чтения, если он есть на диске"""
+        if not os.path.exists(os.path.join(directory, INDEX_NAME)):
+            return None
+        return cls(directory, readonly=True)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f'{SEGMENT_PREFIX}{segment:06d}{SEGMENT_SUFFIX}')
+
+    def _last_segment(self):
+        segments = [
+            int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        ] if os.path.isdir(self.directory) else []
+        return max(segments, default=1)
+
+    # Запись
+
+    def append(self, eggs):
+        """Дописывает яйца в текущий сегмент и обновляет индекс
+
+        eggs - список ArchivedEgg. Сначала записи попадают на диск (fsync),
+        затем индекс переключается на них одной транзакцией: при сбое между
+        этими шагами в сегменте остается только неиспользуемый хвост.
+        """
+        if not eggs:
+            return 0
+        rows = []
+        with self._lock:
+            path = self._segment_path(self._segment)
+            if os.path.exists(path) and os.path.getsize(path) >= self.segment_max_bytes:
+                self._segment += 1
+                path = self._segment_path(self._segment)
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                parts = []
+                for egg in eggs:
+                    line = json.dumps(
+                        {'k': egg.egg_key, 'd': egg.detail, 'm': egg.multi, 'h': egg.hatched},
+                        ensure_ascii=False,
+                        separators=(',', ':')
+                    ).encode('utf-8') + b'\n'
+                    detail = egg.detail or {}
+                    rows.append((
+                        egg.egg_key, detail.get('egg_id'), detail.get('sender_id'), detail.get('hatched_by'),
+                        1 if egg.detail is not None else 0,
+                        1 if egg.multi is not None else 0,
+                        1 if egg.hatched else 0,
+                        self._segment, offset, len(line)
+                    ))
+                    parts.append(line)
+                    offset += len(line)
+                data = b''.join(parts)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            cur = self._conn.cursor()
+            cur.execute('BEGIN')
+            try:
+                cur.executemany(
+                    'INSERT OR REPLACE INTO archived_eggs '
+                    '(egg_key, egg_id, sender_id, hatched_by, in_detail, in_multi, in_hatched, segment, offset, length) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+            self.appended += len(eggs)
+            self.appended_bytes += len(data)
+        return len(eggs)
+
+    def reset(self, collection):
+        """Коллекция заменена целиком - архивные записи в ней больше не действуют"""
+        flag = ARCHIVE_FLAGS.get(collection)
+        if flag is None or self.readonly:
+            return
+        with self._lock:
+            self._conn.execute(f'UPDATE archived_eggs SET {flag} = 0 WHERE {flag} = 1')
+
+    # Чтение
+
+    def _read_record(self, segment, offset, length):
+        fd = self._read_fds.get(segment)
+        if fd is None:
+            fd = self._read_fds[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return json.loads(os.pread(fd, length, offset))
+
+    def _rows(self, where, params):
+        with self._lock:
+            return self._conn.execute(
+                f'SELECT egg_key, in_detail, in_multi, in_hatched, segment, offset, length '
+                f'FROM archived_eggs WHERE {where}',
+                params
+            ).fetchall()
+
+    def _load(self, rows):
+        eggs = []
+        with self._lock:
+            for egg_key, in_detail, in_multi, in_hatched, segment, offset, length in rows:
+                record = self._read_record(segment, offset, length)
+                eggs.append(ArchivedEgg(
+                    egg_key,
+                    record['d'] if in_detail else None,
+                    record['m'] if in_multi else None,
+                    bool(in_hatched)
+                ))
+            self.lookups += len(eggs)
+        return eggs
+
+    def get(self, egg_key):
+        """Возвращает ArchivedEgg по ключу или None"""
+        eggs = self._load(self._rows('egg_key = ?', (egg_key,)))
+        return eggs[0] if eggs else None
+
+    def find_egg_key(self, egg_id):
+        rows = self._rows('egg_id = ? AND in_detail = 1 LIMIT 1', (egg_id,))
+        return rows[0][0] if rows else None
+
+    def find_hatched_key(self, egg_id):
+        # Ключ имеет вид {sender_id}_{egg_id}, поэтому ищем по egg_id или по суффиксу ключа
+        rows = self._rows(
+            "in_hatched = 1 AND (egg_id = ? OR egg_key LIKE ? ESCAPE '\\') LIMIT 1",
+            (egg_id, '%\\_' + egg_id.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        )
+        return rows[0][0] if rows else None
+
+    def is_hatched(self, egg_key):
+        return bool(self._rows('egg_key = ? AND in_hatched = 1', (egg_key,)))
+
+    def sent_by(self, user_id):
+        """[ArchivedEgg] с детальной информацией, отправленные пользователем"""
+        return self._load(self._rows('sender_id = ? AND in_detail = 1', (user_id,)))
+
+    def hatched_by(self, user_id):
+        """[ArchivedEgg] с детальной информацией, вылупленные пользователем"""
+        return self._load(self._rows('hatched_by = ? AND in_detail = 1', (user_id,)))
+
+    def hatched_keys_without_detail(self, user_id):
+        """Ключи вылупленных яиц отправителя, для которых нет детальной информации"""
+        prefix = f'{user_id}_'
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT egg_key FROM archived_eggs WHERE in_hatched = 1 AND in_detail = 0 "
+                "AND egg_key >= ? AND egg_key < ?",
+                (prefix, prefix[:-1] + chr(ord('_') + 1))
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def user_ids(self):
+        with self._lock:
+            return {
+                row[0] for row in self._conn.execute(
+                    'SELECT sender_id FROM archived_eggs WHERE in_detail = 1 AND sender_id IS NOT NULL '
+                    'UNION SELECT hatched_by FROM archived_eggs WHERE in_detail = 1 AND hatched_by IS NOT NULL'
+                )
+            }
+
+    def count_hatched(self, exclude=()):
+        """Количество вылупленных яиц в архиве, не считая ключей из exclude"""
+        exclude = list(exclude)
+        with self._lock:
+            total = self._conn.execute('SELECT COUNT(*) FROM archived_eggs WHERE in_hatched = 1').fetchone()[0]
+            for start in range(0, len(exclude), 500):
+                chunk = exclude[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                total -= self._conn.execute(
+                    f'SELECT COUNT(*) FROM archived_eggs WHERE in_hatched = 1 AND egg_key IN ({placeholders})',
+                    chunk
+                ).fetchone()[0]
+        return total
+
+    def iter_all(self):
+        """Перебирает все яйца архива (для полного backup)"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT egg_key, in_detail, in_multi, in_hatched, segment, offset, length FROM archived_eggs '
+                'WHERE in_detail = 1 OR in_multi = 1 OR in_hatched = 1 ORDER BY segment, offset'
+            ).fetchall()
+        for start in range(0, len(rows), 1000):
+            yield from self._load(rows[start:start + 1000])
+
+    def close(self):
+        with self._lock:
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds.clear()
+            self._conn.close()
+
+    def stats(self):
+        with self._lock:
+            archived, hatched = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(in_hatched), 0) FROM archived_eggs'
+            ).fetchone()
+        segment_bytes = 0
+        if os.path.isdir(self.directory):
+            segment_bytes = sum(
+                os.path.getsize(os.path.join(self.directory, name))
+                for name in os.listdir(self.directory)
+                if name.startswith(SEGMENT_PREFIX)
+            )
+        return {
+            'archived_eggs': archived,
+            'archived_hatched': hatched,
+            'segments': self._segment,
+            'segment_bytes': segment_bytes,
+            'appended': self.appended,
+            'appended_bytes': self.appended_bytes,
+            'lookups': self.lookups
+        }
+
+
+class ColdEggMover:
+    """Фоновая задача: раз в interval секунд переносит холодные яйца в архив
+
+    Перенос идет в три шага, как и сохранение снимка: в цикле событий хранилище
+    выбирает холодные яйца и снимает их копии, в отдельном потоке они
+    дописываются в архив, затем в цикле событий яйца удаляются из памяти
+    (удаление фиксируется в журнале). on_moved(changes) получает количество
+    записанных изменений - обычно это persister.mark_dirty.
+    """
+
+    def __init__(self, storage, interval=3600.0, batch_size=20000, on_moved=None):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.on_moved = on_moved
+
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='egg-archiver')
+
+        # Метрики
+        self.runs = 0
+        self.moved_total = 0
+        self.errors = 0
+        self.last_run_ms = None
+        self.last_run_at = None
+
+    async def run_once(self):
+        """Переносит одну пачку холодных яиц, возвращает количество перенесенных"""
+        started = time.perf_counter()
+        batch = self.storage.capture_cold_eggs(self.batch_size)
+        if not batch:
+            return 0
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.storage.archive_eggs, batch
+            )
+        except Exception as e:
+            self.storage.release_cold_eggs(batch)
+            self.errors += 1
+            logger.error(f"Failed to archive {len(batch)} cold eggs: {e}", exc_info=True)
+            return 0
+        moved, changes = self.storage.drop_archived_eggs(batch)
+        if changes and self.on_moved is not None:
+            self.on_moved(changes)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.runs += 1
+        self.moved_total += moved
+        self.last_run_ms = elapsed_ms
+        self.last_run_at = time.time()
+        logger.info(f"Archived {moved} cold eggs out of memory in {elapsed_ms:.1f} ms")
+        return moved
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                moved = await self.run_once()
+            except Exception as e:
+                # Ошибка одной пачки не должна останавливать перенос до перезапуска
+                self.errors += 1
+                moved = 0
+                logger.error(f"Cold egg mover run failed: {e}", exc_info=True)
+            # Полная пачка - холодные яйца еще остались, продолжаем почти сразу
+            timeout = 1.0 if moved >= self.batch_size else self.interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        """Запускает фоновую задачу в текущем цикле событий"""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"Cold egg mover started (interval={self.interval}s, batch={self.batch_size})")
+
+    async def stop(self):
+        """Останавливает фоновую задачу, дождавшись текущего переноса"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await self._task
+            except Exception as e:
+                # Остановка бота продолжается: дальше сбрасываются данные на диск
+                logger.error(f"Cold egg mover task failed: {e}", exc_info=True)
+            self._task = None
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'moved_total': self.moved_total,
+            'errors': self.errors,
+            'last_run_ms': round(self.last_run_ms, 3) if self.last_run_ms is not None else None,
+            'last_run_at': self.last_run_at,
+            'interval_seconds': self.interval,
+            'batch_size': self.batch_size
+        }
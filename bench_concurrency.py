@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк параллельной обработки апдейтов
+
+Прогоняет поток апдейтов через тот же обработчик очереди, что использует
+Application (SimpleUpdateProcessor с лимитом concurrent_updates), и печатает
+пропускную способность для разных уровней параллельности.
+
+Обработчики повторяют форму настоящих: нажатие на яйцо выполняет синхронную
+транзакцию вылупления (как hatch_egg - без await между проверкой и
+начислением, поэтому без блокировки) и отвечает через Bot API (answer + edit
+сообщения); проверка задания ждет get_chat_member под блокировкой
+пользователя (KeyedLocks, как user_locks); inline запрос только отвечает.
+Вызовы Bot API заменены задержкой --latency - именно она делает
+последовательную обработку медленной.
+Данные бота и сеть не используются.
+
+    python bench_concurrency.py [--updates 2000] [--latency 50] [--levels 1,4,16,64,256]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from telegram.ext import SimpleUpdateProcessor
+
+from concurrency import KeyedLocks
+
+# Доля апдейтов, которые нажимают на общий multi egg
+SHARED_EGG_SHARE = 0.1
+# Доля проверок заданий и сколько пользователей их шлют (повторные нажатия ждут блокировку)
+TASK_CHECK_SHARE = 0.1
+TASK_USERS = 50
+
+
+class BenchState:
+    """Счетчики в форме данных бота"""
+
+    def __init__(self):
+        self.hatched = set()
+        self.multi_count = 0
+        self.points = {}
+        # Сколько раз пользователю начислена награда за задание
+        self.task_rewards = {}
+        self.user_locks = KeyedLocks()
+
+
+async def bot_api_call(latency):
+    await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+
+
+def hatch_egg(state, egg_key, clicker_id):
+    """Проверка и начисление без await - атомарны в цикле событий"""
+    if egg_key == 'shared':
+        state.multi_count += 1
+    elif egg_key in state.hatched:
+        return False
+    else:
+        state.hatched.add(egg_key)
+    state.points[clicker_id] = state.points.get(clicker_id, 0) + 1
+    return True
+
+
+async def handle_click(state, egg_key, clicker_id, latency):
+    if not hatch_egg(state, egg_key, clicker_id):
+        await bot_api_call(latency)  # answer "already hatched"
+        return
+    await bot_api_call(latency)  # query.answer
+    await bot_api_call(latency)  # edit_message_reply_markup / edit_message_text
+
+
+async def handle_task_check(state, user_id, latency):
+    async with state.user_locks.hold(user_id):
+        if user_id in state.task_rewards:
+            return
+        await bot_api_call(latency)  # get_chat_member
+        state.task_rewards[user_id] = state.task_rewards.get(user_id, 0) + 1
+        state.points[user_id] = state.points.get(user_id, 0) + 20
+
+
+async def handle_inline_query(latency):
+    await bot_api_call(latency)  # inline_query.answer
+
+
+def make_updates(count):
+    updates = []
+    for i in range(count):
+        roll = random.random()
+        if roll < SHARED_EGG_SHARE:
+            updates.append(('click', 'shared', i))
+        elif roll < SHARED_EGG_SHARE + TASK_CHECK_SHARE:
+            updates.append(('task', None, random.randrange(TASK_USERS)))
+        elif roll < 0.6:
+            updates.append(('click', f'egg_{i}', i))
+        else:
+            updates.append(('inline', None, i))
+    return updates
+
+
+async def run_level(level, updates, latency):
+    state = BenchState()
+    processor = SimpleUpdateProcessor(level)
+    await processor.initialize()
+
+    async def dispatch(update):
+        kind, egg_key, user_id = update
+        if kind == 'click':
+            await handle_click(state, egg_key, user_id, latency)
+        elif kind == 'task':
+            await handle_task_check(state, user_id, latency)
+        else:
+            await handle_inline_query(latency)
+
+    started = time.perf_counter()
+    # Так же, как Application: каждый апдейт - задача, лимит держит процессор
+    tasks = [asyncio.create_task(processor.process_update(update, dispatch(update))) for update in updates]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await processor.shutdown()
+
+    expected_shared = sum(1 for kind, egg_key, _ in updates if egg_key == 'shared')
+    assert state.multi_count == expected_shared, "lost updates on the shared egg"
+    assert all(count == 1 for count in state.task_rewards.values()), "task reward credited twice"
+    return elapsed, state.user_locks.stats()
+
+
+async def main(args):
+    random.seed(args.seed)
+    updates = make_updates(args.updates)
+    latency = args.latency / 1000
+    print(f"{len(updates)} updates, Bot API latency ~{args.latency} ms")
+    print(f"{'concurrency':>12} {'seconds':>9} {'updates/s':>10} {'contended':>10} {'max wait ms':>12}")
+    for level in args.levels:
+        elapsed, locks = await run_level(level, updates, latency)
+        print(
+            f"{level:>12} {elapsed:>9.2f} {len(updates) / elapsed:>10.1f} "
+            f"{locks['contended']:>10} {locks['max_wait_ms']:>12.1f}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent update processing")
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=50.0, help="simulated Bot API latency, ms")
+    parser.add_argument('--levels', default='1,4,16,64,256',
+                        type=lambda value: [int(level) for level in value.split(',')])
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
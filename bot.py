@@ -8,17 +8,35 @@ from telegram import (
     Update,
     WebAppInfo
 )
-from telegram.ext import Application, CommandHandler, InlineQueryHandler, CallbackQueryHandler, ContextTypes, ChatMemberHandler, MessageHandler, filters
-from telegram.constants import ChatMemberStatus
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, InlineQueryHandler, CallbackQueryHandler, ChosenInlineResultHandler, ContextTypes, ChatMemberHandler, MessageHandler, TypeHandler, filters
+from telegram.constants import ChatMemberStatus, ChatType
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter
 import uuid
 from aiohttp import web
+import functools
 import json
 import os
 import re
+import signal
 from datetime import datetime, date
 import aiohttp
-from eggchain_api import setup_eggchain_routes, set_bot_instance
+from archive import ColdEggMover
+from concurrency import KeyedLocks
+from drafts import DraftEggCache
+from egg_ids import EggIdAllocator, EggIdSequence, decode_callback_data, encode_callback_data
+from eggchain_api import setup_eggchain_routes, set_bot_instance, set_storage
+from jobs import BackgroundJobs, DebouncedJobs
+from leaderboard import Leaderboard
+from outbound import OutboundScheduler
+from persistence import WriteBehindSaver
+import snapshot_codec
+from storage import COLLECTIONS, JsonFileStorage, SQLiteStorage
+from state import plain_collection, plain_record
+from state_service import StateClient, StateServer, WorkerPool
+from totals import GlobalTotals
+from unreachable import REASON_BLOCKED, UnreachableUsers, undeliverable_reason
+from webhook import WebhookReceiver
 
 # Настройка логирования
 logging.basicConfig(
@@ -38,6 +56,14 @@ MAINTENANCE_MODE = os.environ.get('MAINTENANCE_MODE', 'false').lower() == 'true'
 if MAINTENANCE_MODE:
     logger.warning("⚠️ MAINTENANCE MODE ENABLED - Bot is in maintenance mode")
 
+# Несколько процессов (state_service.py): при WORKERS > 0 этот процесс владеет данными
+# и получает апдейты, а обрабатывают их WORKERS процессов, запущенных с ROLE=worker.
+# Обработчики не загружают данные и выполняют изменения транзакциями через STATE_SOCKET
+WORKERS = int(os.environ.get('WORKERS', '0'))
+ROLE = os.environ.get('ROLE', 'main').lower()
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX', '0'))
+STATE_SOCKET = os.environ.get('STATE_SOCKET', '/tmp/tohatch_state.sock')
+
 # Файл для сохранения данных
 # ВСЕГДА используем Volume /data/bot_data.json
 import time
@@ -66,6 +92,40 @@ if not os.access(volume_dir, os.W_OK):
 logger.info(f"Volume mounted successfully at {volume_dir}")
 logger.info(f"Data file: {DATA_FILE}")
 
+# Хранилище данных: 'json' (снимок + журнал изменений) или 'sqlite'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json').lower()
+SQLITE_FILE = '/data/bot_data.sqlite3'
+
+# Журнал изменений: каждое событие дописывается в конец файла,
+# снимок пишется только при компактизации
+JOURNAL_FILE = '/data/bot_data.journal'
+# Снимок разбит на сегменты (по коллекциям, яйца - еще и по хешу ключа),
+# при компактизации переписываются только измененные сегменты.
+# DATA_FILE читается только один раз - для переноса данных в сегменты
+SNAPSHOT_DIR = '/data/bot_data.snapshot'
+SNAPSHOT_BUCKETS = int(os.environ.get('SNAPSHOT_BUCKETS', '64'))
+# Формат сегментов: 'binary' (компактный, быстро загружается) или 'json'
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'binary').lower()
+JOURNAL_FSYNC_INTERVAL = float(os.environ.get('JOURNAL_FSYNC_INTERVAL', '1'))
+
+# Архив холодных яиц: вылупленные яйца и яйца старше ARCHIVE_AFTER_DAYS дней
+# переносятся из памяти и снимка в архив на диске раз в ARCHIVE_INTERVAL секунд
+ARCHIVE_DIR = '/data/bot_data.archive'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))
+# Как часто (в секундах) общая статистика admin_stats пересчитывается с нуля для сверки
+TOTALS_RECONCILE_INTERVAL = float(os.environ.get('TOTALS_RECONCILE_INTERVAL', '600'))
+
+# Компактизация журнала в снимок: раз в SAVE_INTERVAL_SECONDS секунд
+# или сразу, как только в журнале накопилось SAVE_MAX_DIRTY записей
+SAVE_INTERVAL_SECONDS = float(os.environ.get('SAVE_INTERVAL_SECONDS', '60'))
+SAVE_MAX_DIRTY = int(os.environ.get('SAVE_MAX_DIRTY', '5000'))
+
+# Для SQLite изменения применяются пакетными транзакциями:
+# раз в SQLITE_BATCH_INTERVAL секунд или по SQLITE_BATCH_SIZE событий
+SQLITE_BATCH_INTERVAL = float(os.environ.get('SQLITE_BATCH_INTERVAL', '1'))
+SQLITE_BATCH_SIZE = int(os.environ.get('SQLITE_BATCH_SIZE', '500'))
+
 # ID канала Hatch Egg
 HATCH_EGG_CHANNEL = "@hatch_egg"
 
@@ -112,14 +172,16 @@ def save_maintenance_mode(enabled):
         logger.error(f"Error saving maintenance mode: {e}")
 
 # Загружаем состояние режима обслуживания при старте
-MAINTENANCE_MODE = load_maintenance_mode()
-# Включаем режим обслуживания сразу (для переезда данных)
-MAINTENANCE_MODE = True
-save_maintenance_mode(True)
-if MAINTENANCE_MODE:
-    logger.warning("⚠️ MAINTENANCE MODE IS ENABLED - Bot is in maintenance mode!")
-else:
-    logger.info("Bot is running normally (maintenance mode disabled)")
+# (обработчики получают его от владельца данных при подключении)
+if ROLE != 'worker':
+    MAINTENANCE_MODE = load_maintenance_mode()
+    # Включаем режим обслуживания сразу (для переезда данных)
+    MAINTENANCE_MODE = True
+    save_maintenance_mode(True)
+    if MAINTENANCE_MODE:
+        logger.warning("⚠️ MAINTENANCE MODE IS ENABLED - Bot is in maintenance mode!")
+    else:
+        logger.info("Bot is running normally (maintenance mode disabled)")
 
 # Лимиты
 FREE_EGGS_PER_DAY = 10
@@ -128,190 +190,248 @@ TON_PRICE_PER_PACK = 0.15  # 0.15 TON за 10 яиц
 TON_WALLET = "UQCHdlQ2TLpa6Kpu5Pu8HeJd1xe3EL1Kx2wFekeuOnSpFcP0"  # TON кошелек для оплаты
 MINI_APP_URL = "https://hatchapp-xi.vercel.app"  # URL mini app
 REFERRAL_PERCENTAGE = 0.25  # 25% от поинтов реферала
+REFERRALS_PAGE_SIZE = 50  # Рефералов на странице /api/referrals по умолчанию
+REFERRALS_PAGE_MAX = 200  # Максимальный limit в /api/referrals
+LEADERBOARD_PAGE_SIZE = 50  # Мест на странице /api/leaderboard по умолчанию
+LEADERBOARD_PAGE_MAX = 200  # Максимальный limit в /api/leaderboard
+
+# Сколько апдейтов обрабатывать параллельно (1 - строго по очереди).
+# Изменения данных - синхронные транзакции (hatch_egg, ...), проверки с ожиданием
+# Bot API защищены блокировками пользователей (concurrency.py)
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '16'))
+
+# Webhook: если задан WEBHOOK_URL (публичный адрес сервера API), Telegram присылает
+# апдейты на WEBHOOK_URL + WEBHOOK_PATH вместо опроса getUpdates (webhook.py)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None
+# Очередь апдейтов ограничена: когда она заполнена, polling ждет, а webhook отвечает 503
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '1000'))
+
+# Сколько фоновых задач выполняют побочные действия (сообщения, редактирование яиц)
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', '8'))
+
+# Исходящие сообщения (outbound.py): не больше OUTBOUND_RATE в секунду на бота
+# (в режиме WORKERS делится между процессами) и не чаще раза в OUTBOUND_CHAT_INTERVAL секунд в один чат
+OUTBOUND_RATE = float(os.environ.get('OUTBOUND_RATE', '25'))
+OUTBOUND_CHAT_INTERVAL = float(os.environ.get('OUTBOUND_CHAT_INTERVAL', '1'))
+
+# Пользователи, которым нельзя написать (заблокировали бота, удалили аккаунт):
+# личные сообщения им не отправляются UNREACHABLE_TTL_DAYS дней или до /start
+UNREACHABLE_USERS_FILE = '/data/unreachable_users.json'
+UNREACHABLE_TTL_DAYS = float(os.environ.get('UNREACHABLE_TTL_DAYS', '7'))
+
+# Верхняя граница выданных номеров яиц (egg_ids.py); номера выдаются блоками по EGG_ID_BLOCK
+EGG_ID_FILE = '/data/egg_id_sequence.json'
+EGG_ID_BLOCK = int(os.environ.get('EGG_ID_BLOCK', '1000'))
+
+# Черновики яиц из inline запросов: сколько живет невыбранный результат и сколько их держать
+DRAFT_EGG_TTL = float(os.environ.get('DRAFT_EGG_TTL', '86400'))
+DRAFT_EGG_MAX = int(os.environ.get('DRAFT_EGG_MAX', '200000'))
+# Сколько секунд Telegram может отдавать пользователю закэшированный результат inline запроса.
+# Результат стабилен, пока яйцо не выбрано; выбранное яйцо в пределах этого окна
+# может быть отправлено повторно - оба сообщения будут одним яйцом
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', '10'))
+
+def create_storage():
+    """Создает хранилище данных согласно STORAGE_BACKEND"""
+    json_storage = JsonFileStorage(
+        DATA_FILE,
+        JOURNAL_FILE,
+        SNAPSHOT_DIR,
+        fsync_interval=JOURNAL_FSYNC_INTERVAL,
+        checkpoint_interval=SAVE_INTERVAL_SECONDS,
+        checkpoint_max_pending=SAVE_MAX_DIRTY,
+        snapshot_buckets=SNAPSHOT_BUCKETS,
+        snapshot_format=SNAPSHOT_FORMAT,
+        archive_dir=ARCHIVE_DIR,
+        archive_after_days=ARCHIVE_AFTER_DAYS
+    )
+    if STORAGE_BACKEND == 'sqlite':
+        # При первом запуске SQLite импортирует данные из JSON снимка и журнала
+        return SQLiteStorage(
+            SQLITE_FILE,
+            checkpoint_interval=SQLITE_BATCH_INTERVAL,
+            checkpoint_max_pending=SQLITE_BATCH_SIZE,
+            legacy_storage=json_storage
+        )
+    if STORAGE_BACKEND != 'json':
+        logger.warning(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', using json")
+    return json_storage
+
+# Данные загружает только владелец: процессы-обработчики (ROLE=worker) работают через сервис состояния
+if ROLE != 'worker':
+    storage = create_storage()
+    logger.info(f"Storage backend: {storage.name}")
+
+    # Фоновый сохранятель: периодически снимает копию изменений в цикле событий
+    # (capture_checkpoint) и пишет ее на диск в отдельном потоке
+    persister = WriteBehindSaver(
+        storage.capture_checkpoint,
+        interval=storage.checkpoint_interval,
+        max_dirty=storage.checkpoint_max_pending
+    )
 
-# Функция для загрузки данных из файла
-def load_data():
-    """Загружает данные из файла"""
-    logger.info(f"=== LOADING DATA ===")
-    logger.info(f"Loading data from: {DATA_FILE}")
-    logger.info(f"Current working directory: {os.getcwd()}")
-    logger.info(f"Volume /data exists: {os.path.exists('/data')}")
-    logger.info(f"Volume /data writable: {os.access('/data', os.W_OK) if os.path.exists('/data') else False}")
-    logger.info(f"File exists: {os.path.exists(DATA_FILE)}")
-    
-    if os.path.exists(DATA_FILE):
-        file_size = os.path.getsize(DATA_FILE)
-        logger.info(f"Data file size: {file_size} bytes")
-        # Проверяем, что файл не пустой
-        if file_size == 0:
-            logger.error(f"CRITICAL: Data file {DATA_FILE} exists but is EMPTY (0 bytes)!")
-            logger.warning("Using default data - file will be overwritten on first save")
-            return get_default_data()
-    
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                # Логируем загруженные данные для отладки
-                egg_points_count = len(data.get('egg_points', {}))
-                referrers_count = len(data.get('referrers', {}))
-                hatched_eggs_count = len(data.get('hatched_eggs', []))
-                eggs_detail_count = len(data.get('eggs_detail', {}))
-                logger.info(f"=== DATA LOADED SUCCESSFULLY ===")
-                logger.info(f"Loaded data: {egg_points_count} users with points, {referrers_count} referrers")
-                logger.info(f"Hatched eggs: {hatched_eggs_count}, Eggs detail: {eggs_detail_count}")
-                logger.info(f"=== END LOADING ===")
-                
-                return {
-                    'hatched_eggs': set(data.get('hatched_eggs', [])),
-                    'eggs_hatched_by_user': data.get('eggs_hatched_by_user', {}),
-                    'user_eggs_hatched_by_others': data.get('user_eggs_hatched_by_others', {}),
-                    'eggs_sent_by_user': data.get('eggs_sent_by_user', {}),
-                    'daily_eggs_sent': data.get('daily_eggs_sent', {}),  # {user_id: {'date': '2024-01-01', 'count': 5}}
-                    'egg_points': data.get('egg_points', {}),
-                    'completed_tasks': data.get('completed_tasks', {}),
-                    'referrers': data.get('referrers', {}),  # {user_id: referrer_id} - кто привел пользователя
-                    'referral_earnings': data.get('referral_earnings', {}),  # {referrer_id: total_earned} - сколько заработал рефовод
-                    'ton_payments': data.get('ton_payments', {}),  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
-                    'eggs_detail': data.get('eggs_detail', {}),  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched, is_multi, max_hatches, hatched_count, hatched_by_list}}
-                    'multi_eggs': data.get('multi_eggs', {}),  # {egg_key: {hatched_by_list: [user_id1, user_id2, ...], hatched_count: int}}
-                    'admin_tasks': data.get('admin_tasks', [])  # [{id, name, avatar_url, channel, reward, created_at}]
-                }
-        except Exception as e:
-            logger.error(f"=== ERROR LOADING DATA ===")
-            logger.error(f"Error loading data from {DATA_FILE}: {e}", exc_info=True)
-            logger.error(f"File exists but corrupted or unreadable!")
-            logger.error(f"CRITICAL: Will NOT use default data to prevent data loss!")
-            logger.error(f"Trying to backup corrupted file and raise error...")
-            
-            # Пытаемся создать backup поврежденного файла
-            try:
-                backup_file = DATA_FILE + '.corrupted.' + str(int(time.time()))
-                import shutil
-                if os.path.exists(DATA_FILE):
-                    shutil.copy2(DATA_FILE, backup_file)
-                    logger.error(f"Corrupted file backed up to: {backup_file}")
-            except Exception as backup_error:
-                logger.error(f"Failed to backup corrupted file: {backup_error}")
-            
-            # НЕ возвращаем дефолтные данные - это приведет к потере данных!
-            # Вместо этого поднимаем исключение
-            raise RuntimeError(f"Failed to load data from {DATA_FILE}. File may be corrupted. Backup created if possible.")
+    # Фоновый перенос холодных яиц в архив; удаление из памяти попадает в журнал,
+    # поэтому после переноса просим сохранятель записать снимок
+    cold_egg_mover = ColdEggMover(storage, interval=ARCHIVE_INTERVAL, on_moved=persister.mark_dirty)
+
+# Блокировки пользователей для проверок с ожиданием Bot API (подписки, задания)
+user_locks = KeyedLocks()
+
+# Яйца, предложенные в inline режиме, но еще не отправленные
+draft_eggs = DraftEggCache(ttl=DRAFT_EGG_TTL, max_size=DRAFT_EGG_MAX, reuse_window=INLINE_CACHE_TIME)
+
+# Номера новых яиц: границу хранит владелец данных, блоки берутся транзакцией reserve_egg_ids
+if ROLE != 'worker':
+    egg_id_sequence = EggIdSequence(EGG_ID_FILE)
+    egg_id_sequence.load(has_data=any(os.path.exists(path) for path in (DATA_FILE, SNAPSHOT_DIR, SQLITE_FILE)))
+egg_id_allocator = EggIdAllocator(lambda count: call_state('reserve_egg_ids', count), block_size=EGG_ID_BLOCK)
+
+# Недоступные пользователи: файл ведет владелец данных, обработчики держат копию в памяти
+unreachable_users = UnreachableUsers(
+    UNREACHABLE_USERS_FILE if ROLE != 'worker' else None,
+    ttl=UNREACHABLE_TTL_DAYS * 86400
+)
+if ROLE != 'worker':
+    unreachable_users.load()
+    unreachable_saver = WriteBehindSaver(unreachable_users.capture, interval=30.0, max_dirty=1000)
+
+def is_transient_error(error):
+    """Ошибка Bot API, после которой имеет смысл повторить запрос"""
+    # BadRequest в PTB - наследник NetworkError, но повтор его не исправит
+    return isinstance(error, RetryAfter) or (isinstance(error, NetworkError) and not isinstance(error, BadRequest))
+
+# Фоновые побочные действия после нажатия (jobs.py); меньший приоритет выполняется раньше
+JOB_PRIORITY_EDIT = 0  # обновление сообщения с яйцом - его видят все в чате
+background_jobs = BackgroundJobs(workers=BACKGROUND_WORKERS, should_retry=is_transient_error)
+# Прогресс на кнопке multi egg: нажатия за MULTI_EGG_EDIT_DELAY секунд дают одну правку сообщения
+MULTI_EGG_EDIT_DELAY = float(os.environ.get('MULTI_EGG_EDIT_DELAY', '1'))
+multi_egg_edits = DebouncedJobs(background_jobs, delay=MULTI_EGG_EDIT_DELAY)
+
+def handle_undeliverable(user_id, error):
+    """Окончательная ошибка личного сообщения: запоминаем недоступного пользователя"""
+    reason = undeliverable_reason(error)
+    if reason is None:
+        return
+    logger.warning(f"User {user_id} is unreachable ({reason}), skipping DMs to them")
+    if ROLE == 'worker':
+        unreachable_users.mark(user_id, reason)
+        background_jobs.submit(JOB_PRIORITY_EDIT, 'mark_unreachable', call_state, 'mark_user_unreachable', user_id, reason)
     else:
-        logger.error(f"=== DATA FILE NOT FOUND ===")
-        logger.error(f"Data file {DATA_FILE} does not exist!")
-        logger.error(f"Volume /data exists: {os.path.exists('/data')}")
-        logger.error(f"Volume /data writable: {os.access('/data', os.W_OK) if os.path.exists('/data') else False}")
-        logger.error("File does not exist - this is first run or data was lost")
-        logger.error(f"=== END LOADING (DEFAULT DATA) ===")
-        # Только если файла действительно нет - используем дефолт
-        return get_default_data()
-
-# Функция для получения данных по умолчанию
-def get_default_data():
-    """Возвращает данные по умолчанию"""
-    return {
-        'hatched_eggs': set(),
-        'eggs_hatched_by_user': {},
-        'user_eggs_hatched_by_others': {},
-        'eggs_sent_by_user': {},
-        'daily_eggs_sent': {},
-        'egg_points': {},
-        'completed_tasks': {},
-        'referrers': {},
-        'referral_earnings': {},
-        'ton_payments': {},
-        'eggs_detail': {},
-        'multi_eggs': {},
-        'admin_tasks': []
-    }
+        mark_user_unreachable(user_id, reason)
+
+# Личные сообщения и уведомления идут через планировщик с ограничением скорости
+outbound = OutboundScheduler(
+    rate=OUTBOUND_RATE / WORKERS if ROLE == 'worker' and WORKERS > 0 else OUTBOUND_RATE,
+    chat_interval=OUTBOUND_CHAT_INTERVAL,
+    should_retry=is_transient_error,
+    skip=unreachable_users.is_unreachable,
+    on_undeliverable=handle_undeliverable
+)
 
-# Функция для сохранения данных в файл
-def save_data():
-    """Сохраняет данные в файл"""
+# Сервис состояния: сервер и пул обработчиков у владельца при WORKERS > 0,
+# клиент - в процессе-обработчике
+state_server = None
+worker_pool = None
+state_client = None
+
+# Прием апдейтов через webhook (только при WEBHOOK_URL)
+webhook_receiver = None
+
+def get_state():
+    """Возвращает живые коллекции бота из памяти"""
+    return {name: globals()[name] for name in COLLECTIONS}
+
+def build_snapshot_data():
+    """Собирает полное состояние бота в словарь для backup"""
+    return storage.export_data()
+
+def describe_change(ref):
+    """Превращает ссылку на данные в запись журнала с текущим значением
+
+    ref - (collection,) для всей коллекции или (collection, key) для одного ключа.
+    Если ключа уже нет, записывается удаление.
+    """
+    collection = ref[0]
+    container = globals()[collection]
+    if len(ref) == 1:
+        return ['r', collection, plain_collection(container)]
+    key = ref[1]
+    if collection == 'hatched_eggs':
+        return ['p', collection, key, 1] if key in container else ['d', collection, key]
+    if key in container:
+        return ['p', collection, key, plain_record(container[key])]
+    return ['d', collection, key]
+
+def save_data(event=None, *refs):
+    """Фиксирует изменение в хранилище, запись на диск произойдет в фоне
+
+    event - тип события ('egg_sent', 'egg_hatched', ...)
+    refs - измененные данные: (collection, key) или (collection,)
+    """
+    if refs:
+        storage.record(event, [describe_change(ref) for ref in refs])
+        persister.mark_dirty()
+    else:
+        # Без описания изменений хранилищу нечего записать - просим полный сброс
+        storage.record(event, [describe_change((name,)) for name in COLLECTIONS])
+        persister.mark_dirty(persister.max_dirty)
+
+if ROLE != 'worker':
+    # Загружаем данные при старте
+    # ВАЖНО: Если загрузка не удалась из-за ошибки (не отсутствия файла), бот не запустится
+    # Это защита от потери данных
     try:
-        data = {
-            'hatched_eggs': list(hatched_eggs),
-            'eggs_hatched_by_user': eggs_hatched_by_user,
-            'user_eggs_hatched_by_others': user_eggs_hatched_by_others,
-            'eggs_sent_by_user': eggs_sent_by_user,
-            'daily_eggs_sent': daily_eggs_sent,
-            'egg_points': egg_points,
-            'completed_tasks': completed_tasks,
-            'referrers': referrers,
-            'referral_earnings': referral_earnings,
-            'ton_payments': ton_payments,
-            'eggs_detail': eggs_detail,
-            'multi_eggs': multi_eggs,
-            'admin_tasks': admin_tasks
-        }
-        
-        # Логируем что сохраняем
-        egg_points_count = len(egg_points)
-        referrers_count = len(referrers)
-        logger.info(f"Saving data to {DATA_FILE}: {egg_points_count} users with points, {referrers_count} referrers")
-        
-        # Сохраняем во временный файл сначала, потом переименовываем (атомарная операция)
-        temp_file = DATA_FILE + '.tmp'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
-        # Атомарно заменяем старый файл новым
-        if os.path.exists(DATA_FILE):
-            os.replace(temp_file, DATA_FILE)
-        else:
-            os.rename(temp_file, DATA_FILE)
-        
-        # Проверяем, что файл действительно сохранился
-        if os.path.exists(DATA_FILE):
-            file_size = os.path.getsize(DATA_FILE)
-            logger.info(f"Data saved successfully to {DATA_FILE} (size: {file_size} bytes)")
-        else:
-            logger.error(f"CRITICAL: Data file {DATA_FILE} was not created after save!")
-            
-    except Exception as e:
-        logger.error(f"Error saving data to {DATA_FILE}: {e}", exc_info=True)
-        # Пытаемся удалить временный файл если он остался
-        temp_file = DATA_FILE + '.tmp'
-        if os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
-
-# Загружаем данные при старте
-# ВАЖНО: Если загрузка не удалась из-за ошибки (не отсутствия файла), бот не запустится
-# Это защита от потери данных
-try:
-    data = load_data()
-except RuntimeError as e:
-    logger.error(f"CRITICAL: Cannot start bot without data! Error: {e}")
-    logger.error("Bot will NOT start to prevent data loss. Please fix the data file manually.")
-    raise  # Останавливаем запуск бота
-
-hatched_eggs = data['hatched_eggs']
-eggs_hatched_by_user = data['eggs_hatched_by_user']
-user_eggs_hatched_by_others = data['user_eggs_hatched_by_others']
-eggs_sent_by_user = data.get('eggs_sent_by_user', {})
-daily_eggs_sent = data.get('daily_eggs_sent', {})
-egg_points = data['egg_points']
-completed_tasks = data['completed_tasks']
-referrers = data.get('referrers', {})  # {user_id: referrer_id}
-referral_earnings = data.get('referral_earnings', {})  # {referrer_id: total_earned}
-ton_payments = data.get('ton_payments', {})  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
-eggs_detail = data.get('eggs_detail', {})  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched, is_multi, max_hatches, hatched_count, hatched_by_list}}
-multi_eggs = data.get('multi_eggs', {})  # {egg_key: {hatched_by_list: [user_id1, user_id2, ...], hatched_count: int}}
-admin_tasks = data.get('admin_tasks', [])  # [{id, name, avatar_url, channel, reward, created_at}]
-
-# Логируем загруженные данные при старте
-logger.info(f"Bot started with data: {len(egg_points)} users with points, {len(referrers)} referrers, {len(eggs_detail)} eggs in detail")
-if len(egg_points) > 0:
-    sample_user = list(egg_points.keys())[0]
-    logger.info(f"Sample user {sample_user} has {egg_points[sample_user]} points")
-if len(referrers) > 0:
-    sample_ref = list(referrers.items())[0]
-    logger.info(f"Sample referral: user {sample_ref[0]} referred by {sample_ref[1]}")
+        data = storage.load()
+    except RuntimeError as e:
+        logger.error(f"CRITICAL: Cannot start bot without data! Error: {e}")
+        logger.error("Bot will NOT start to prevent data loss. Please fix the data file manually.")
+        raise  # Останавливаем запуск бота
+
+    if storage.dirty_after_load:
+        # Сразу сворачиваем проигранный журнал (и исправленные ключи) в новый снимок
+        persister.mark_dirty(storage.dirty_after_load)
+
+    # Все ключи пользователей - int. Счетчики (egg_points, eggs_hatched_by_user,
+    # user_eggs_hatched_by_others, eggs_sent_by_user, referral_earnings) - представления
+    # над общей таблицей пользователей user_table (state.py). Яйца - одна запись Egg
+    # в egg_table, eggs_detail, multi_eggs и hatched_eggs - представления над ней
+    hatched_eggs = data['hatched_eggs']
+    eggs_hatched_by_user = data['eggs_hatched_by_user']
+    user_eggs_hatched_by_others = data['user_eggs_hatched_by_others']
+    eggs_sent_by_user = data['eggs_sent_by_user']
+    daily_eggs_sent = data['daily_eggs_sent']
+    egg_points = data['egg_points']
+    completed_tasks = data['completed_tasks']
+    referrers = data['referrers']  # {user_id: referrer_id}
+    referral_earnings = data['referral_earnings']  # {referrer_id: total_earned}
+    ton_payments = data['ton_payments']  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
+    user_table = egg_points.table
+    eggs_detail = data['eggs_detail']  # {egg_key: Egg с полями sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched, is_multi, max_hatches, hatched_count, hatched_by_list}
+    multi_eggs = data['multi_eggs']  # {egg_key: {hatched_by_list: [user_id1, user_id2, ...], hatched_count: int}}
+    egg_table = eggs_detail.table
+    # Таблица лидеров по egg_points: обновляется при каждом изменении поинтов
+    leaderboard = Leaderboard()
+    leaderboard.load_from(egg_points.items())
+    user_table.watch('points', leaderboard.set)
+    admin_tasks = data.get('admin_tasks', [])  # [{id, name, avatar_url, channel, reward, created_at}]
+
+    storage.attach(get_state)
+
+    # Общая статистика для admin_stats ведется на каждом изменении и сверяется в фоне
+    global_totals = GlobalTotals(
+        user_table, daily_eggs_sent, storage.count_hatched_eggs, interval=TOTALS_RECONCILE_INTERVAL
+    )
+
+    # Логируем загруженные данные при старте
+    logger.info(f"Bot started with data: {len(egg_points)} users with points, {len(referrers)} referrers, {len(eggs_detail)} eggs in detail")
+    if len(egg_points) > 0:
+        sample_user = list(egg_points.keys())[0]
+        logger.info(f"Sample user {sample_user} has {egg_points[sample_user]} points")
+    if len(referrers) > 0:
+        sample_ref = list(referrers.items())[0]
+        logger.info(f"Sample referral: user {sample_ref[0]} referred by {sample_ref[1]}")
 
 # Функция для проверки и обновления ежедневного лимита
 def check_daily_limit(user_id):
@@ -360,6 +480,373 @@ def add_paid_eggs(user_id, amount):
         daily_eggs_sent[user_id]['paid_eggs'] = user_data.get('paid_eggs', 0) + amount
 
 
+# Транзакции над данными. Каждая - синхронная функция без await: в цикле событий она
+# выполняется целиком, поэтому атомарна. Обработчики апдейтов вызывают их через
+# call_state - в своем процессе или у владельца данных (ROLE=worker, state_service.py)
+
+def register_start(user_id, referrer_id=None):
+    """Транзакция /start: привязка реферала из ссылки и статистика пользователя"""
+    if referrer_id is not None:
+        # Устанавливаем реферала только если:
+        # 1. У пользователя еще нет реферала
+        # 2. Реферал не является самим пользователем
+        if user_id not in referrers and referrer_id != user_id:
+            referrers[user_id] = referrer_id
+            logger.info(f"User {user_id} became referral of {referrer_id} via startapp link (total referrers now: {len(referrers)})")
+            
+            # Сохраняем данные
+            save_data('referral_set', ('referrers', user_id))
+        elif user_id in referrers:
+            logger.info(f"User {user_id} already has referrer {referrers[user_id]}, ignoring startapp={referrer_id}")
+        else:
+            logger.info(f"User {user_id} tried to set themselves as referrer via startapp, ignoring")
+    
+    return {
+        'hatched': eggs_hatched_by_user.get(user_id, 0),
+        'my_eggs_hatched': user_eggs_hatched_by_others.get(user_id, 0)
+    }
+
+
+def record_sent_egg(egg_key, egg_info):
+    """Транзакция отправки яйца: запись в eggs_detail и счетчики отправленных
+
+    Проверяет задание "Send 100 egg". Яйцо, которое уже учтено, не меняется.
+    """
+    if egg_key in eggs_detail:
+        return {'recorded': False, 'send_task_completed': False}
+    sender_id = egg_info['sender_id']
+    is_multi = egg_info['is_multi']
+    
+    # Сохраняем детальную информацию о яйце для Eggchain Explorer
+    eggs_detail[egg_key] = egg_info
+    
+    # Если это multi egg, инициализируем структуру для отслеживания вылуплений
+    if is_multi:
+        multi_eggs[egg_key] = {
+            'hatched_by_list': [],
+            'hatched_count': 0
+        }
+    
+    # Увеличиваем общий счетчик отправленных яиц
+    eggs_sent_by_user[sender_id] = eggs_sent_by_user.get(sender_id, 0) + 1
+    
+    # Увеличиваем ежедневный счетчик
+    increment_daily_count(sender_id)
+    
+    changes = [
+        ('eggs_detail', egg_key),
+        ('eggs_sent_by_user', sender_id),
+        ('daily_eggs_sent', sender_id)
+    ]
+    if is_multi:
+        changes.append(('multi_eggs', egg_key))
+    save_data('egg_sent', *changes)
+    
+    # Проверяем задание "Send 100 egg"
+    send_task_completed = False
+    if eggs_sent_by_user[sender_id] >= 100 and not completed_tasks.get(sender_id, {}).get('send_100_eggs', False):
+        # Начисляем 500 Egg
+        egg_points[sender_id] = egg_points.get(sender_id, 0) + 500
+        
+        # Отмечаем задание как выполненное
+        if sender_id not in completed_tasks:
+            completed_tasks[sender_id] = {}
+        completed_tasks[sender_id]['send_100_eggs'] = True
+        
+        # Сохраняем данные
+        save_data('task_completed', ('egg_points', sender_id), ('completed_tasks', sender_id))
+        
+        logger.info(f"User {sender_id} completed 'Send 100 egg' task, earned 500 Egg points")
+        send_task_completed = True
+    return {'recorded': True, 'send_task_completed': send_task_completed}
+
+
+def hatch_egg(egg_key, sender_id, egg_id, clicker_id, is_multi, egg_info):
+    """Транзакция нажатия на яйцо: проверка и зачисление вылупления
+
+    Проверка "яйцо еще не вылуплено" и зачисление идут без переключений на другие
+    апдейты, поэтому яйцо не вылупится дважды, а multi egg - сверх max_hatches.
+    egg_info - черновик яйца (или данные из callback_data), если яйцо еще не
+    учтено как отправленное. Возвращает статус ('hatched', 'own_egg',
+    'already_hatched', 'already_hatched_multi', 'limit_reached'), тип яйца,
+    прогресс и выполненные задания.
+    """
+    # Если яйца нет в памяти (например, хранится только в SQLite), подгружаем его
+    storage.fault_in(egg_key)
+    
+    # Первое нажатие под яйцом, которое еще не учтено как отправленное
+    # (ChosenInlineResult не пришел): учитываем его сейчас
+    send_task_completed = False
+    if egg_key not in eggs_detail and egg_key not in hatched_eggs and egg_key not in multi_eggs:
+        send_task_completed = record_sent_egg(egg_key, egg_info)['send_task_completed']
+    
+    # Получаем информацию о яйце из eggs_detail
+    egg_info = eggs_detail.get(egg_key, {})
+    if not egg_info:
+        # Если информации нет, определяем тип по префиксу callback_data
+        # Для multi используем значение из callback или дефолт 50
+        default_max = 50 if is_multi else 1
+        egg_info = {'is_multi': is_multi, 'max_hatches': default_max}
+    
+    # Определяем, является ли яйцо multi egg и максимальное количество вылуплений
+    is_multi_egg = egg_info.get('is_multi', is_multi)
+    max_hatches = egg_info.get('max_hatches', 1)
+    
+    # Если это multi egg, но max_hatches не установлен, используем значение из egg_info или дефолт
+    if is_multi_egg and max_hatches == 1:
+        max_hatches = egg_info.get('max_hatches', 50)  # Дефолт для старых multi eggs
+    
+    logger.info(f"Egg type check: is_multi={is_multi}, is_multi_egg={is_multi_egg}, max_hatches={max_hatches}, egg_key={egg_key}")
+    
+    result = {
+        'status': 'hatched',
+        'is_multi': is_multi_egg,
+        'max_hatches': max_hatches,
+        'hatched_count': 0,
+        'send_task_completed': send_task_completed,
+        'hatch_task_completed': False
+    }
+    
+    # ВАЖНО: Проверяем, не пытается ли отправитель вылупить свое яйцо
+    # Это должно быть ПЕРЕД любым изменением сообщения
+    if clicker_id == sender_id:
+        logger.info(f"BLOCKED: Sender {sender_id} tried to hatch their own egg {egg_id}")
+        result['status'] = 'own_egg'
+        return result
+    
+    # Для multi egg проверяем лимит и дубликаты
+    if is_multi_egg:
+        # Проверяем, не вылуплял ли уже этот пользователь это яйцо
+        egg = egg_table.get(egg_key)
+        if egg is not None and egg.in_multi and egg.has_hatcher(clicker_id):
+            logger.info(f"User {clicker_id} already hatched multi egg {egg_key}")
+            result['status'] = 'already_hatched_multi'
+            return result
+    
+        # Проверяем лимит вылуплений
+        if egg is not None and egg.in_multi and egg.multi_count >= max_hatches:
+            logger.info(f"Multi egg {egg_key} reached limit of {max_hatches} hatches")
+            result['status'] = 'limit_reached'
+            return result
+    
+        # Обновляем eggs_detail
+        if egg_key not in eggs_detail:
+            now = datetime.now().isoformat()
+            eggs_detail[egg_key] = {
+                'sender_id': sender_id,
+                'egg_id': egg_id,
+                'hatched_by': None,  # Для multi egg храним список вылупивших
+                'timestamp_sent': now,
+                'timestamp_hatched': now,
+                'is_multi': True,
+                'max_hatches': max_hatches
+            }
+        if egg_key not in multi_eggs:
+            multi_eggs[egg_key] = {'hatched_by_list': [], 'hatched_count': 0}
+        egg = egg_table.get(egg_key)
+    
+        # Добавляем пользователя в список вылупивших (один список для multi_eggs и eggs_detail)
+        egg.add_hatcher(clicker_id)
+        egg.multi_count += 1
+        egg.hatched_count = egg.multi_count
+        if egg.multi_count == 1:
+            egg.timestamp_hatched = datetime.now().isoformat()
+    else:
+        # Обычное яйцо - проверяем, не было ли уже вылуплено
+        if egg_key in hatched_eggs:
+            logger.info(f"Egg {egg_key} already hatched")
+            result['status'] = 'already_hatched'
+            return result
+    
+        # Помечаем яйцо как вылупленное
+        hatched_eggs.add(egg_key)
+        global_totals.egg_hatched()
+    
+        # Обновляем детальную информацию о яйце для Eggchain Explorer
+        if egg_key not in eggs_detail:
+            eggs_detail[egg_key] = {
+                'sender_id': sender_id,
+                'egg_id': egg_id,
+                'timestamp_sent': datetime.now().isoformat(),
+                'is_multi': False,
+                'max_hatches': 1
+            }
+        egg = egg_table.get(egg_key)
+        egg.hatched_by = clicker_id
+        egg.timestamp_hatched = datetime.now().isoformat()
+        egg.hatched_count = 1
+        egg.set_hatchers([clicker_id])
+    
+    # РЕФЕРАЛЬНАЯ СИСТЕМА: Если clicker_id еще не имеет реферала, устанавливаем sender_id как его реферала
+    # Когда кто-то открывает яйцо, он становится рефералом того, кто отправил яйцо
+    # ВАЖНО: Для multi egg реферал устанавливается только при первом вылуплении
+    if clicker_id not in referrers and sender_id != clicker_id:
+        referrers[clicker_id] = sender_id
+        logger.info(f"User {clicker_id} became referral of {sender_id} (total referrers now: {len(referrers)})")
+    
+    # Обновляем статистику
+    # Увеличиваем счетчик для того, кто вылупил (для каждого вылупления, включая multi egg)
+    eggs_hatched_by_user[clicker_id] = eggs_hatched_by_user.get(clicker_id, 0) + 1
+    # Увеличиваем счетчик для отправителя (его яйцо вылупили) - для каждого вылупления multi egg
+    user_eggs_hatched_by_others[sender_id] = user_eggs_hatched_by_others.get(sender_id, 0) + 1
+    
+    # Начисляем поинты Egg
+    # +1 очко тому, кто вылупил чужое яйцо
+    clicker_points = 1
+    old_clicker_points = egg_points.get(clicker_id, 0)
+    egg_points[clicker_id] = old_clicker_points + clicker_points
+    logger.info(f"User {clicker_id} earned {clicker_points} points (total: {egg_points[clicker_id]})")
+    
+    # +2 очка отправителю, чье яйцо вылупили
+    sender_points = 2
+    old_sender_points = egg_points.get(sender_id, 0)
+    egg_points[sender_id] = old_sender_points + sender_points
+    logger.info(f"User {sender_id} earned {sender_points} points (total: {egg_points[sender_id]})")
+    
+    # РЕФЕРАЛЬНАЯ СИСТЕМА: Рефовод получает 25% от поинтов реферала
+    # Когда реферал зарабатывает поинты, его рефовод получает 25% от этих поинтов
+    
+    # Проверяем, есть ли у clicker_id реферал (может быть установлен выше или уже был)
+    clicker_referrer = referrers.get(clicker_id)
+    if clicker_referrer and clicker_referrer != clicker_id:
+        # Реферал clicker_id получает 25% от поинтов clicker_id
+        referral_bonus = int(clicker_points * REFERRAL_PERCENTAGE)
+        if referral_bonus > 0:
+            referral_earnings[clicker_referrer] = referral_earnings.get(clicker_referrer, 0) + referral_bonus
+            egg_points[clicker_referrer] = egg_points.get(clicker_referrer, 0) + referral_bonus
+            logger.info(f"Referrer {clicker_referrer} earned {referral_bonus} points (25% of {clicker_points}) from referral {clicker_id}")
+    
+    # Проверяем, есть ли у sender_id реферал
+    sender_referrer = referrers.get(sender_id)
+    if sender_referrer and sender_referrer != sender_id:
+        # Реферал sender_id получает 25% от поинтов sender_id
+        referral_bonus = int(sender_points * REFERRAL_PERCENTAGE)
+        if referral_bonus > 0:
+            referral_earnings[sender_referrer] = referral_earnings.get(sender_referrer, 0) + referral_bonus
+            egg_points[sender_referrer] = egg_points.get(sender_referrer, 0) + referral_bonus
+            logger.info(f"Referrer {sender_referrer} earned {referral_bonus} points (25% of {sender_points}) from referral {sender_id}")
+    
+    # Проверяем задание "Hatch 100 egg"
+    hatched_count = eggs_hatched_by_user.get(clicker_id, 0)
+    if hatched_count >= 333 and not completed_tasks.get(clicker_id, {}).get('hatch_333_eggs', False):
+        # Начисляем 100 Egg
+        egg_points[clicker_id] = egg_points.get(clicker_id, 0) + 100
+    
+        # Отмечаем задание как выполненное
+        if clicker_id not in completed_tasks:
+            completed_tasks[clicker_id] = {}
+        completed_tasks[clicker_id]['hatch_333_eggs'] = True
+    
+        logger.info(f"User {clicker_id} completed 'Hatch 333 egg' task, earned 100 Egg points")
+        result['hatch_task_completed'] = True
+    
+    # Сохраняем данные после обновления
+    logger.info(f"Before save: {len(egg_points)} users with points, {len(referrers)} referrers")
+    changes = [
+        ('multi_eggs' if is_multi_egg else 'hatched_eggs', egg_key),
+        ('eggs_detail', egg_key),
+        ('referrers', clicker_id),
+        ('eggs_hatched_by_user', clicker_id),
+        ('user_eggs_hatched_by_others', sender_id),
+        ('egg_points', clicker_id),
+        ('egg_points', sender_id),
+        ('completed_tasks', clicker_id)
+    ]
+    for referrer_id in (clicker_referrer, sender_referrer):
+        if referrer_id:
+            changes.append(('egg_points', referrer_id))
+            changes.append(('referral_earnings', referrer_id))
+    save_data('egg_hatched', *changes)
+    logger.info(f"After save: {len(egg_points)} users with points, {len(referrers)} referrers")
+    
+    result['hatched_count'] = egg.multi_count if is_multi_egg else 1
+    return result
+
+
+def reward_channel_subscription(user_id):
+    """Транзакция награды за подписку на @hatch_egg: 20 Eggs один раз
+
+    Возвращает True, если награда начислена сейчас.
+    """
+    if completed_tasks.get(user_id, {}).get('subscribed_to_hatch_egg', False):
+        return False
+    # Начисляем 20 Eggs (available eggs to send)
+    today = date.today().isoformat()
+    user_data = daily_eggs_sent.get(user_id, {})
+    if user_data.get('date') != today:
+        # Сохраняем paid_eggs при инициализации нового дня
+        old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
+        daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
+        user_data = daily_eggs_sent[user_id]
+    user_data['paid_eggs'] = user_data.get('paid_eggs', 0) + 20
+    
+    # Отмечаем задание как выполненное
+    if user_id not in completed_tasks:
+        completed_tasks[user_id] = {}
+    completed_tasks[user_id]['subscribed_to_hatch_egg'] = True
+    
+    # Сохраняем данные после обновления
+    save_data('task_completed', ('daily_eggs_sent', user_id), ('completed_tasks', user_id))
+    
+    logger.info(f"User {user_id} subscribed to Hatch Egg, earned 20 Eggs")
+    return True
+
+
+def get_maintenance_mode():
+    """Текущее состояние режима обслуживания (для процессов-обработчиков)"""
+    return MAINTENANCE_MODE
+
+def mark_user_unreachable(user_id, reason):
+    """Запоминает недоступного пользователя и сообщает об этом обработчикам"""
+    until = unreachable_users.mark(user_id, reason)
+    unreachable_saver.mark_dirty()
+    if state_server is not None:
+        state_server.broadcast(['unreachable', user_id, until, reason])
+
+def mark_user_reachable(user_id):
+    """Снимает отметку недоступности (пользователь написал боту или разблокировал его)"""
+    if unreachable_users.clear(user_id):
+        unreachable_saver.mark_dirty()
+    if state_server is not None:
+        state_server.broadcast(['reachable', user_id])
+
+def reserve_egg_ids(count):
+    """Выдает блок номеров яиц, возвращает первый номер"""
+    return egg_id_sequence.reserve(count)
+
+def get_unreachable_users():
+    """Копия кэша недоступных пользователей для процесса-обработчика при подключении"""
+    return unreachable_users.export()
+
+
+# Транзакции, доступные процессам-обработчикам через сервис состояния
+STATE_OPERATIONS = {
+    'check_daily_limit': check_daily_limit,
+    'register_start': register_start,
+    'record_sent_egg': record_sent_egg,
+    'hatch_egg': hatch_egg,
+    'reward_channel_subscription': reward_channel_subscription,
+    'get_maintenance_mode': get_maintenance_mode,
+    'mark_user_unreachable': mark_user_unreachable,
+    'mark_user_reachable': mark_user_reachable,
+    'get_unreachable_users': get_unreachable_users,
+    'reserve_egg_ids': reserve_egg_ids
+}
+
+
+async def call_state(operation, *args):
+    """Выполняет транзакцию: в своем процессе или у владельца данных (ROLE=worker)"""
+    if state_client is not None:
+        return await state_client.call(operation, *args)
+    return STATE_OPERATIONS[operation](*args)
+
+
+def notify_user(user_id, text):
+    """Ставит уведомление пользователю о награде в очередь исходящих сообщений"""
+    # Одинаковое уведомление, которое еще ждет отправки, второй раз не ставится
+    outbound.send(user_id, text, coalesce_key=text)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     # Проверка режима обслуживания
@@ -376,34 +863,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Обрабатываем параметр startapp из ссылки https://t.me/bot?startapp=referrer_id
     # Когда пользователь переходит по ссылке, бот получает команду /start referrer_id
+    referrer_id = None
     if context.args and len(context.args) > 0:
         logger.info(f"START with args: {context.args}, first arg: {context.args[0]}")
         try:
             referrer_id = int(context.args[0])
-            
-            # Устанавливаем реферала только если:
-            # 1. У пользователя еще нет реферала
-            # 2. Реферал не является самим пользователем
-            if user_id not in referrers and referrer_id != user_id:
-                # Убеждаемся, что оба ID - int
-                user_id_int = int(user_id)
-                referrer_id_int = int(referrer_id)
-                
-                referrers[user_id_int] = referrer_id_int
-                logger.info(f"User {user_id_int} became referral of {referrer_id_int} via startapp link (total referrers now: {len(referrers)})")
-                
-                # Сохраняем данные
-                save_data()
-            elif user_id in referrers:
-                logger.info(f"User {user_id} already has referrer {referrers[user_id]}, ignoring startapp={referrer_id}")
-            else:
-                logger.info(f"User {user_id} tried to set themselves as referrer via startapp, ignoring")
         except ValueError:
             logger.warning(f"Invalid referrer_id in startapp parameter: {context.args[0]}")
     
-    # Получаем статистику пользователя
-    hatched_count = eggs_hatched_by_user.get(user_id, 0)
-    my_eggs_hatched = user_eggs_hatched_by_others.get(user_id, 0)
+    # Пользователь пишет боту - значит, личные сообщения снова доходят
+    if unreachable_users.is_unreachable(user_id):
+        await call_state('mark_user_reachable', user_id)
+    
+    # Привязываем реферала и получаем статистику пользователя
+    user_stats = await call_state('register_start', user_id, referrer_id)
+    hatched_count = user_stats['hatched']
+    my_eggs_hatched = user_stats['my_eggs_hatched']
     
     # Создаем кнопку для открытия mini app
     keyboard = InlineKeyboardMarkup([
@@ -440,9 +915,17 @@ async def reset_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     referral_earnings.clear()  # Реферальные заработки
     completed_tasks.clear()  # Выполненные задания
     
-    # Сохраняем изменения
-    save_data()
+    # Сохраняем изменения. Замена hatched_eggs целиком снимает и флаги вылупления
+    # у яиц в архиве (в том числе у переносимых в этот момент), иначе сверка
+    # вернула бы их в total_eggs_hatched
+    save_data(
+        'reset_all',
+        ('egg_points',), ('eggs_sent_by_user',), ('daily_eggs_sent',),
+        ('eggs_hatched_by_user',), ('user_eggs_hatched_by_others',), ('hatched_eggs',),
+        ('referral_earnings',), ('completed_tasks',)
+    )
     
+    await global_totals.reconcile()
     logger.info(f"User {user_id} reset ALL counters and free eggs")
     
     await update.message.reply_text(
@@ -462,25 +945,16 @@ async def reset_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик inline запросов"""
-    # Проверка режима обслуживания
-    if MAINTENANCE_MODE:
-        await update.inline_query.answer([], cache_time=1)
-        return
-    
-    query = update.inline_query.query.lower().strip()
-    
-    logger.info(f"Inline query received: '{query}' (original: '{update.inline_query.query}')")
-    
-    # Парсим запрос: пустой запрос, "egg" или "egg N" где N от 2 до 100
-    is_multi = False
-    max_hatches = 1
-    
+@functools.lru_cache(maxsize=1024)
+def parse_egg_query(query):
+    """Разбирает inline запрос в (is_multi, max_hatches)
+
+    Запросы повторяются (каждое нажатие клавиши - новый запрос), поэтому
+    результат разбора кэшируется.
+    """
     # Если запрос пустой или содержит "egg", показываем яйцо
     # Пытаемся извлечь число после "egg" для multi egg
     # Форматы: "", "egg", "egg 50", "egg50", "egg 100", и т.д.
-    import re
     egg_match = re.search(r'egg\s*(\d+)', query)
     if egg_match:
         hatch_count = int(egg_match.group(1))
@@ -502,76 +976,23 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Просто "egg" без числа - обычное яйцо
         is_multi = False
         max_hatches = 1
-    
-    # Получаем ID отправителя
-    sender_id = update.inline_query.from_user.id
-    
-    # Создаем уникальный ID для этого яйца
-    # Используем короткий формат: первые 16 символов UUID без дефисов
-    # Это достаточно для уникальности и помещается в лимит Telegram (64 байта)
-    egg_id = str(uuid.uuid4()).replace("-", "")[:16]
-    
-    # Сохраняем детальную информацию о яйце для Eggchain Explorer
-    egg_key = f"{sender_id}_{egg_id}"
-    eggs_detail[egg_key] = {
-        'sender_id': sender_id,
-        'egg_id': egg_id,
-        'hatched_by': None,
-        'timestamp_sent': datetime.now().isoformat(),
-        'timestamp_hatched': None,
-        'is_multi': is_multi,
-        'max_hatches': max_hatches,
-        'hatched_count': 0,
-        'hatched_by_list': []
-    }
-    
-    # Если это multi egg, инициализируем структуру для отслеживания вылуплений
-    if is_multi:
-        multi_eggs[egg_key] = {
-            'hatched_by_list': [],
-            'hatched_count': 0
-        }
-    
-    # Сохраняем информацию об отправителе яйца
-    # Формат callback_data: hatch_{sender_id}|{egg_id} или multi_{sender_id}|{egg_id} для multi egg
-    prefix = "multi" if is_multi else "hatch"
-    callback_data = f"{prefix}_{sender_id}|{egg_id}"
-    
-    # Проверяем длину callback_data (максимум 64 байта для Telegram)
-    callback_data_bytes = len(callback_data.encode('utf-8'))
-    if callback_data_bytes > 64:
-        # Если все еще слишком длинный, укорачиваем еще больше
-        # sender_id обычно 8-10 цифр, оставляем место для префикса "hatch_" и разделителя "|"
-        max_egg_id_len = 64 - len(f"hatch_{sender_id}|".encode('utf-8'))
-        if max_egg_id_len > 0:
-            egg_id = egg_id[:max_egg_id_len]
-            callback_data = f"hatch_{sender_id}|{egg_id}"
-            logger.warning(f"Callback data too long, shortened egg_id to {egg_id} (length: {len(egg_id)})")
-        else:
-            # Если даже с минимальным egg_id не помещается, используем только sender_id и timestamp
-            import time
-            egg_id = str(int(time.time()))[-8:]  # Последние 8 цифр timestamp
-            callback_data = f"hatch_{sender_id}|{egg_id}"
-            logger.warning(f"Callback data still too long, using timestamp-based egg_id: {egg_id}")
-    
-    # Создаем кнопку "Hatch"
-    button_text = "🥚 Hatch"
+    return is_multi, max_hatches
+
+
+def build_inline_results(sender_id, egg_id, is_multi, max_hatches, callback_data=None):
+    """Результат inline запроса: яйцо с кнопкой "Hatch" (безлимит)"""
+    if callback_data is None:
+        callback_data = encode_callback_data(is_multi, sender_id, egg_id, max_hatches)
     keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton(button_text, callback_data=callback_data)]
+        [InlineKeyboardButton("🥚 Hatch", callback_data=callback_data)]
     ])
-    
-    # Безлимитный режим - всегда разрешаем отправку яиц
-    # Проверяем ежедневный лимит только для статистики (не блокируем)
-    can_send_free, daily_count, total_limit = check_daily_limit(sender_id)
-    
-    # Создаем результат с эмодзи яйца (безлимит)
     if is_multi:
         title = f"🥚 Send Multi Egg ({max_hatches}x)"
         description = f"Multi egg - up to {max_hatches} users can hatch it!"
     else:
         title = "🥚 Send Egg"
         description = "Click to send an egg to the chat"
-    results = [
+    return [
         InlineQueryResultArticle(
             id=egg_id,
             title=title,
@@ -583,80 +1004,187 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=keyboard
         )
     ]
-    
-    await update.inline_query.answer(results, cache_time=1)
-    logger.info(f"Results sent: {len(results)} result(s), callback_data length: {len(callback_data.encode('utf-8'))}, can_send: {can_send_free}, daily_count: {daily_count}, total_limit: {total_limit}")
-    
-    # Увеличиваем счетчики когда яйцо отправлено через inline query
-    # В Telegram inline query, яйцо считается отправленным когда пользователь выбирает его из результатов
-    # Показываем яйцо для любого запроса (пустой или с "egg")
-    if True:  # Всегда увеличиваем счетчик при отправке яйца
-        # Увеличиваем общий счетчик отправленных яиц
-        eggs_sent_by_user[sender_id] = eggs_sent_by_user.get(sender_id, 0) + 1
-        
-        # Увеличиваем ежедневный счетчик
-        increment_daily_count(sender_id)
-        
-        # Проверяем задание "Send 100 egg"
-        if eggs_sent_by_user[sender_id] >= 100 and not completed_tasks.get(sender_id, {}).get('send_100_eggs', False):
-            # Начисляем 500 Egg
-            egg_points[sender_id] = egg_points.get(sender_id, 0) + 500
-            
-            # Отмечаем задание как выполненное
-            if sender_id not in completed_tasks:
-                completed_tasks[sender_id] = {}
-            completed_tasks[sender_id]['send_100_eggs'] = True
-            
-            # Сохраняем данные
-            save_data()
-            
-            logger.info(f"User {sender_id} completed 'Send 100 egg' task, earned 500 Egg points")
-            
-            # Уведомляем пользователя
-            try:
-                await context.bot.send_message(
-                    chat_id=sender_id,
-                    text="🎉 Congratulations! You earned 500 Egg points for sending 100 eggs!"
-                )
-            except Exception as e:
-                logger.error(f"Failed to send notification to user {sender_id}: {e}")
-        
-        save_data()
 
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки"""
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик inline запросов"""
     # Проверка режима обслуживания
     if MAINTENANCE_MODE:
-        await update.callback_query.answer("🔧 Бот находится на обслуживании. Попробуйте позже.", show_alert=True)
+        await update.inline_query.answer([], cache_time=1)
         return
     
-    query = update.callback_query
+    query = update.inline_query.query.lower().strip()
     
-    logger.info(f"Button callback received: {query.data}")
+    logger.info(f"Inline query received: '{query}' (original: '{update.inline_query.query}')")
     
-    # Получаем ID пользователя, который нажал на кнопку
-    clicker_id = query.from_user.id
+    # Парсим запрос: пустой запрос, "egg" или "egg N" где N от 2 до 100
+    is_multi, max_hatches = parse_egg_query(query)
     
-    # Извлекаем данные из callback_data
-    # Формат: hatch_{sender_id}|{egg_id} или multi_{sender_id}|{egg_id}
-    # Поддерживаем старые форматы для обратной совместимости
+    # Получаем ID отправителя
+    sender_id = update.inline_query.from_user.id
+    
+    # В течение INLINE_CACHE_TIME секунд после первого ответа (пока Telegram может показать
+    # закэшированный результат) предлагаем то же яйцо, потом - новое: без inline feedback
+    # бот не узнает, в сколько чатов отправлено яйцо
+    offer = (sender_id, max_hatches)
+    egg_key = draft_eggs.find_offer(offer)
+    if egg_key is not None:
+        egg_id = egg_key.split('_', 1)[1]
+        await update.inline_query.answer(
+            build_inline_results(sender_id, egg_id, is_multi, max_hatches),
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=True
+        )
+        logger.info(f"Results sent: offered egg {egg_key} reused")
+        return
+    
+    # Новое яйцо получает следующий номер (egg_ids.py), callback_data - компактный формат
+    egg_id = await egg_id_allocator.allocate()
+    callback_data = encode_callback_data(is_multi, sender_id, egg_id, max_hatches)
+    
+    # Предложенное яйцо пока только черновик: в eggs_detail и счетчики оно попадет,
+    # когда пользователь выберет результат (ChosenInlineResult) или под ним нажмут кнопку
+    egg_key = f"{sender_id}_{egg_id}"
+    draft_eggs.put(egg_key, {
+        'sender_id': sender_id,
+        'egg_id': egg_id,
+        'hatched_by': None,
+        'timestamp_sent': datetime.now().isoformat(),
+        'timestamp_hatched': None,
+        'is_multi': is_multi,
+        'max_hatches': max_hatches,
+        'hatched_count': 0,
+        'hatched_by_list': []
+    }, offer=offer)
+    
+    # Безлимитный режим - всегда разрешаем отправку яиц
+    # Проверяем ежедневный лимит только для статистики (не блокируем)
+    can_send_free, daily_count, total_limit = await call_state('check_daily_limit', sender_id)
+    
+    results = build_inline_results(sender_id, egg_id, is_multi, max_hatches, callback_data)
+    await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+    logger.info(f"Results sent: {len(results)} result(s), callback_data length: {len(callback_data.encode('utf-8'))}, can_send: {can_send_free}, daily_count: {daily_count}, total_limit: {total_limit}")
+
+
+async def promote_draft_egg(egg_key, context):
+    """Переносит отправленное яйцо из черновиков в постоянное состояние
+
+    Возвращает результат транзакции record_sent_egg или None, если черновика
+    нет (истек или яйцо уже учтено при нажатии на кнопку).
+    """
+    draft = draft_eggs.pop(egg_key)
+    if draft is None:
+        return None
+    result = await call_state('record_sent_egg', egg_key, draft)
+    if result['send_task_completed']:
+        notify_user(draft['sender_id'], "🎉 Congratulations! You earned 500 Egg points for sending 100 eggs!")
+    return result
+
+
+async def chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик выбора inline результата - яйцо действительно отправлено в чат
+
+    Telegram присылает ChosenInlineResult, только если для бота включен
+    inline feedback (/setinlinefeedback в BotFather). Без него яйцо учитывается
+    при первом нажатии на кнопку.
+    """
+    result = update.chosen_inline_result
+    egg_key = f"{result.from_user.id}_{result.result_id}"
+    promoted = await promote_draft_egg(egg_key, context)
+    if promoted is None:
+        logger.warning(f"Chosen inline result {egg_key} has no draft (expired or already clicked?)")
+    elif promoted['recorded']:
+        logger.info(f"Egg {egg_key} chosen and sent by user {result.from_user.id}")
+
+
+def hatched_egg_keyboard(sender_id):
+    """Кнопки под вылупленным яйцом и в личном сообщении"""
+    # Используем формат https://t.me/bot_username?startapp=sender_id для реферальной ссылки
+    referral_url = f"https://t.me/{BOT_USERNAME}?startapp={sender_id}"
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(
+                "📱 Hatch App",
+                url=referral_url
+            ),
+            InlineKeyboardButton(
+                "Send 🥚",
+                switch_inline_query_current_chat="egg"
+            )
+        ]
+    ])
+
+
+async def update_multi_egg_message(query, sender_id, egg_key, hatched_count, max_hatches):
+    """Фоновое задание: прогресс на кнопке multi egg или 🐣, когда лимит набран"""
+    remaining = max_hatches - hatched_count
+    if remaining > 0:
+        # Если еще можно вылупить, обновляем кнопку с прогрессом
+        button_text = f"🥚 Hatch ({hatched_count}/{max_hatches})"
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(button_text, callback_data=query.data)]
+        ])
+        # Сообщение остается просто с яйцом, не меняем текст
+        await query.edit_message_reply_markup(reply_markup=keyboard)
+        logger.info(f"Multi egg {egg_key} updated: {hatched_count}/{max_hatches} hatched, {remaining} remaining")
+        return
+    
+    # Если лимит достигнут, меняем эмодзи на 🐣 и добавляем кнопки
+    keyboard = hatched_egg_keyboard(sender_id)
+    try:
+        await query.edit_message_text(
+            "🐣",
+            reply_markup=keyboard
+        )
+        logger.info(f"Multi egg {egg_key} completed ({hatched_count}/{max_hatches}), changed emoji to 🐣 with buttons")
+    except Exception as e:
+        logger.error(f"Error updating multi egg message: {e}")
+        # Пытаемся хотя бы обновить reply_markup
+        await query.edit_message_reply_markup(reply_markup=keyboard)
+
+
+async def update_hatched_egg_message(query, sender_id, egg_key):
+    """Фоновое задание: меняет 🥚 на 🐣 под обычным яйцом и добавляет кнопки"""
+    keyboard = hatched_egg_keyboard(sender_id)
+    try:
+        await query.edit_message_text(
+            "🐣",
+            reply_markup=keyboard
+        )
+        logger.info(f"Successfully updated egg message to 🐣 with buttons for egg {egg_key}")
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+        # Если не удалось отредактировать текст, пробуем только reply_markup
+        await query.edit_message_reply_markup(reply_markup=keyboard)
+        logger.info(f"Updated reply_markup only for egg {egg_key}")
+
+
+def parse_callback_data(data):
+    """Разбирает callback_data кнопки яйца: (is_multi, sender_id, egg_id, max_hatches) или None
+
+    Формат: компактный 2{h|m}{max_hatches}.{sender_id}:{egg_id} (egg_ids.py).
+    Кнопки уже отправленных яиц несут старые форматы: компактный версии 1,
+    hatch_{sender_id}|{egg_id} и multi_{sender_id}|{egg_id} (а еще раньше
+    hatch_{egg_id}_{sender_id}) - их тоже разбираем, max_hatches у них None.
+    """
+    parsed = decode_callback_data(data)
+    if parsed is not None:
+        return parsed
     
     sender_id = None
     egg_id = None
     is_multi = False
     
     # Проверяем формат callback_data: hatch_ или multi_
-    if query.data.startswith("multi_"):
+    if data.startswith("multi_"):
         is_multi = True
-        data_part = query.data[6:]  # 6 = len("multi_")
-    elif query.data.startswith("hatch_"):
+        data_part = data[6:]  # 6 = len("multi_")
+    elif data.startswith("hatch_"):
         is_multi = False
-        data_part = query.data[6:]  # 6 = len("hatch_")
+        data_part = data[6:]  # 6 = len("hatch_")
     else:
-        await query.answer("❌ Ошибка: неверный формат данных", show_alert=True)
-        logger.error(f"Invalid callback_data format: {query.data}")
-        return
+        logger.error(f"Invalid callback_data format: {data}")
+        return None
     
     # Пробуем новый формат: sender_id|egg_id
     if "|" in data_part:
@@ -667,9 +1195,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 egg_id = parts[1]
                 logger.info(f"Parsed new format: sender_id={sender_id}, egg_id={egg_id}")
             except ValueError:
-                await query.answer("❌ Ошибка: неверный формат данных", show_alert=True)
-                logger.error(f"Invalid sender_id in new format: {query.data}")
-                return
+                logger.error(f"Invalid sender_id in new format: {data}")
+                return None
     
     # Если новый формат не сработал, пробуем старый формат
     if sender_id is None or egg_id is None:
@@ -683,357 +1210,116 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 egg_id = "_".join(parts[:-1])
                 logger.info(f"Parsed old format: sender_id={sender_id}, egg_id={egg_id}")
             except (ValueError, IndexError):
-                await query.answer("❌ Ошибка: неверный формат данных", show_alert=True)
-                logger.error(f"Invalid format in old format: {query.data}")
-                return
+                logger.error(f"Invalid format in old format: {data}")
+                return None
     
     # Если оба формата не сработали
     if sender_id is None or egg_id is None or not egg_id:
-        await query.answer("❌ Ошибка: неверный формат данных", show_alert=True)
-        logger.error(f"Could not parse callback_data: {query.data}")
-        return
-    
-    logger.info(f"Egg ID: {egg_id}, Sender ID: {sender_id}, Clicker ID: {clicker_id}, Is Multi: {is_multi}")
-    
-    # Создаем уникальный ключ для яйца (комбинация sender_id и egg_id)
-    # Это предотвращает коллизии при укорачивании UUID
-    egg_key = f"{sender_id}_{egg_id}"
-    
-    # Получаем информацию о яйце из eggs_detail
-    egg_info = eggs_detail.get(egg_key, {})
-    if not egg_info:
-        # Если информации нет, определяем тип по префиксу callback_data
-        # Для multi используем значение из callback или дефолт 50
-        default_max = 50 if is_multi else 1
-        egg_info = {'is_multi': is_multi, 'max_hatches': default_max}
+        logger.error(f"Could not parse callback_data: {data}")
+        return None
     
-    # Определяем, является ли яйцо multi egg и максимальное количество вылуплений
-    is_multi_egg = egg_info.get('is_multi', is_multi)
-    max_hatches = egg_info.get('max_hatches', 1)
-    
-    # Если это multi egg, но max_hatches не установлен, используем значение из egg_info или дефолт
-    if is_multi_egg and max_hatches == 1:
-        max_hatches = egg_info.get('max_hatches', 50)  # Дефолт для старых multi eggs
-    
-    logger.info(f"Egg type check: is_multi={is_multi}, is_multi_egg={is_multi_egg}, max_hatches={max_hatches}, egg_key={egg_key}")
-    
-    # ВАЖНО: Проверяем, не пытается ли отправитель вылупить свое яйцо
-    # Это должно быть ПЕРЕД любым изменением сообщения
-    if clicker_id == sender_id:
-        await query.answer("❌ You can't hatch your own egg! Only the recipient can do it.", show_alert=True)
-        logger.info(f"BLOCKED: Sender {sender_id} tried to hatch their own egg {egg_id}")
+    return is_multi, sender_id, egg_id, None
+
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий на кнопки"""
+    # Проверка режима обслуживания
+    if MAINTENANCE_MODE:
+        await update.callback_query.answer("🔧 Бот находится на обслуживании. Попробуйте позже.", show_alert=True)
         return
     
-    # Для multi egg проверяем лимит и дубликаты
-    if is_multi_egg:
-        # Проверяем, не вылуплял ли уже этот пользователь это яйцо
-        multi_egg_data = multi_eggs.get(egg_key, {'hatched_by_list': [], 'hatched_count': 0})
-        if clicker_id in multi_egg_data['hatched_by_list']:
-            await query.answer("🐣 You have already hatched this multi egg!", show_alert=True)
-            logger.info(f"User {clicker_id} already hatched multi egg {egg_key}")
-            return
-        
-        # Проверяем лимит вылуплений
-        if multi_egg_data['hatched_count'] >= max_hatches:
-            await query.answer(f"🐣 This multi egg has reached its limit of {max_hatches} hatches!", show_alert=True)
-            logger.info(f"Multi egg {egg_key} reached limit of {max_hatches} hatches")
-            return
-        
-        # Добавляем пользователя в список вылупивших
-        multi_egg_data['hatched_by_list'].append(clicker_id)
-        multi_egg_data['hatched_count'] += 1
-        multi_eggs[egg_key] = multi_egg_data
-        
-        # Обновляем eggs_detail
-        if egg_key not in eggs_detail:
-            eggs_detail[egg_key] = {
-                'sender_id': sender_id,
-                'egg_id': egg_id,
-                'hatched_by': None,  # Для multi egg храним список в multi_eggs
-                'timestamp_sent': datetime.now().isoformat(),
-                'timestamp_hatched': datetime.now().isoformat(),
-                'is_multi': True,
-                'max_hatches': max_hatches,
-                'hatched_count': multi_egg_data['hatched_count'],
-                'hatched_by_list': multi_egg_data['hatched_by_list'].copy()
-            }
-        else:
-            eggs_detail[egg_key]['hatched_count'] = multi_egg_data['hatched_count']
-            eggs_detail[egg_key]['hatched_by_list'] = multi_egg_data['hatched_by_list'].copy()
-            if eggs_detail[egg_key]['hatched_count'] == 1:
-                eggs_detail[egg_key]['timestamp_hatched'] = datetime.now().isoformat()
-    else:
-        # Обычное яйцо - проверяем, не было ли уже вылуплено
-        if egg_key in hatched_eggs:
-            await query.answer("🐣 This egg has already hatched!", show_alert=True)
-            logger.info(f"Egg {egg_key} already hatched")
-            return
-        
-        # Помечаем яйцо как вылупленное
-        hatched_eggs.add(egg_key)
-        
-        # Обновляем детальную информацию о яйце для Eggchain Explorer
-        if egg_key not in eggs_detail:
-            eggs_detail[egg_key] = {
-                'sender_id': sender_id,
-                'egg_id': egg_id,
-                'hatched_by': clicker_id,
-                'timestamp_sent': datetime.now().isoformat(),
-                'timestamp_hatched': datetime.now().isoformat(),
-                'is_multi': False,
-                'max_hatches': 1,
-                'hatched_count': 1,
-                'hatched_by_list': [clicker_id]
-            }
-        else:
-            eggs_detail[egg_key]['hatched_by'] = clicker_id
-            eggs_detail[egg_key]['timestamp_hatched'] = datetime.now().isoformat()
-            eggs_detail[egg_key]['hatched_count'] = 1
-            eggs_detail[egg_key]['hatched_by_list'] = [clicker_id]
+    query = update.callback_query
+    
+    logger.info(f"Button callback received: {query.data}")
     
-    # РЕФЕРАЛЬНАЯ СИСТЕМА: Если clicker_id еще не имеет реферала, устанавливаем sender_id как его реферала
-    # Когда кто-то открывает яйцо, он становится рефералом того, кто отправил яйцо
-    # ВАЖНО: Для multi egg реферал устанавливается только при первом вылуплении
-    if clicker_id not in referrers and sender_id != clicker_id:
-        referrers[clicker_id] = sender_id
-        logger.info(f"User {clicker_id} became referral of {sender_id} (total referrers now: {len(referrers)})")
+    # Получаем ID пользователя, который нажал на кнопку
+    clicker_id = query.from_user.id
     
-    # Обновляем статистику
-    # Увеличиваем счетчик для того, кто вылупил (для каждого вылупления, включая multi egg)
-    eggs_hatched_by_user[clicker_id] = eggs_hatched_by_user.get(clicker_id, 0) + 1
-    # Увеличиваем счетчик для отправителя (его яйцо вылупили) - для каждого вылупления multi egg
-    user_eggs_hatched_by_others[sender_id] = user_eggs_hatched_by_others.get(sender_id, 0) + 1
+    # Извлекаем данные из callback_data
+    parsed = parse_callback_data(query.data)
+    if parsed is None:
+        await query.answer("❌ Ошибка: неверный формат данных", show_alert=True)
+        return
+    is_multi, sender_id, egg_id, max_hatches = parsed
     
-    # Начисляем поинты Egg
-    # +1 очко тому, кто вылупил чужое яйцо
-    clicker_points = 1
-    old_clicker_points = egg_points.get(clicker_id, 0)
-    egg_points[clicker_id] = old_clicker_points + clicker_points
-    logger.info(f"User {clicker_id} earned {clicker_points} points (total: {egg_points[clicker_id]})")
+    logger.info(f"Egg ID: {egg_id}, Sender ID: {sender_id}, Clicker ID: {clicker_id}, Is Multi: {is_multi}")
     
-    # +2 очка отправителю, чье яйцо вылупили
-    sender_points = 2
-    old_sender_points = egg_points.get(sender_id, 0)
-    egg_points[sender_id] = old_sender_points + sender_points
-    logger.info(f"User {sender_id} earned {sender_points} points (total: {egg_points[sender_id]})")
+    # Создаем уникальный ключ для яйца (комбинация sender_id и egg_id)
+    # Это предотвращает коллизии при укорачивании UUID
+    egg_key = f"{sender_id}_{egg_id}"
     
-    # РЕФЕРАЛЬНАЯ СИСТЕМА: Рефовод получает 25% от поинтов реферала
-    # Когда реферал зарабатывает поинты, его рефовод получает 25% от этих поинтов
+    # Если яйцо еще не учтено как отправленное (ChosenInlineResult не пришел), транзакция
+    # учтет его по черновику, а если черновика нет (истек, рестарт, другой процесс) - по
+    # данным из callback_data. Время отправки тогда неизвестно, а лимит есть только в
+    # кнопках формата 2: для старых кнопок hatch_egg применяет прежний лимит по умолчанию
+    egg_info = draft_eggs.pop(egg_key)
+    if egg_info is None:
+        egg_info = {
+            'sender_id': sender_id,
+            'egg_id': egg_id,
+            'hatched_by': None,
+            'timestamp_sent': None,
+            'timestamp_hatched': None,
+            'is_multi': is_multi,
+            'hatched_count': 0,
+            'hatched_by_list': []
+        }
+        if max_hatches is not None:
+            egg_info['max_hatches'] = max_hatches
     
-    # Проверяем, есть ли у clicker_id реферал (может быть установлен выше или уже был)
-    clicker_referrer = referrers.get(clicker_id)
-    if clicker_referrer and clicker_referrer != clicker_id:
-        # Реферал clicker_id получает 25% от поинтов clicker_id
-        referral_bonus = int(clicker_points * REFERRAL_PERCENTAGE)
-        if referral_bonus > 0:
-            referral_earnings[clicker_referrer] = referral_earnings.get(clicker_referrer, 0) + referral_bonus
-            egg_points[clicker_referrer] = egg_points.get(clicker_referrer, 0) + referral_bonus
-            logger.info(f"Referrer {clicker_referrer} earned {referral_bonus} points (25% of {clicker_points}) from referral {clicker_id}")
+    # Проверка и зачисление вылупления - одна транзакция (hatch_egg)
+    result = await call_state('hatch_egg', egg_key, sender_id, egg_id, clicker_id, is_multi, egg_info)
+    is_multi_egg = result['is_multi']
+    max_hatches = result['max_hatches']
     
-    # Проверяем, есть ли у sender_id реферал
-    sender_referrer = referrers.get(sender_id)
-    if sender_referrer and sender_referrer != sender_id:
-        # Реферал sender_id получает 25% от поинтов sender_id
-        referral_bonus = int(sender_points * REFERRAL_PERCENTAGE)
-        if referral_bonus > 0:
-            referral_earnings[sender_referrer] = referral_earnings.get(sender_referrer, 0) + referral_bonus
-            egg_points[sender_referrer] = egg_points.get(sender_referrer, 0) + referral_bonus
-            logger.info(f"Referrer {sender_referrer} earned {referral_bonus} points (25% of {sender_points}) from referral {sender_id}")
+    # Уведомления о заданиях отправляем уже после транзакции
+    if result['send_task_completed']:
+        notify_user(sender_id, "🎉 Congratulations! You earned 500 Egg points for sending 100 eggs!")
     
-    # Проверяем задание "Hatch 100 egg"
-    hatched_count = eggs_hatched_by_user.get(clicker_id, 0)
-    if hatched_count >= 333 and not completed_tasks.get(clicker_id, {}).get('hatch_333_eggs', False):
-        # Начисляем 100 Egg
-        egg_points[clicker_id] = egg_points.get(clicker_id, 0) + 100
-        
-        # Отмечаем задание как выполненное
-        if clicker_id not in completed_tasks:
-            completed_tasks[clicker_id] = {}
-        completed_tasks[clicker_id]['hatch_333_eggs'] = True
-        
-        logger.info(f"User {clicker_id} completed 'Hatch 333 egg' task, earned 100 Egg points")
-        
-        # Уведомляем пользователя
-        try:
-            await context.bot.send_message(
-                chat_id=clicker_id,
-                text="🎉 Congratulations! You earned 100 Egg points for hatching 333 eggs!"
-            )
-        except Exception as e:
-            logger.error(f"Failed to send notification to user {clicker_id}: {e}")
+    status = result['status']
+    if status == 'own_egg':
+        await query.answer("❌ You can't hatch your own egg! Only the recipient can do it.", show_alert=True)
+        return
+    if status == 'already_hatched_multi':
+        await query.answer("🐣 You have already hatched this multi egg!", show_alert=True)
+        return
+    if status == 'limit_reached':
+        await query.answer(f"🐣 This multi egg has reached its limit of {max_hatches} hatches!", show_alert=True)
+        return
+    if status == 'already_hatched':
+        await query.answer("🐣 This egg has already hatched!", show_alert=True)
+        return
     
-    # Сохраняем данные после обновления
-    logger.info(f"Before save: {len(egg_points)} users with points, {len(referrers)} referrers")
-    save_data()
-    logger.info(f"After save: {len(egg_points)} users with points, {len(referrers)} referrers")
+    if result['hatch_task_completed']:
+        notify_user(clicker_id, "🎉 Congratulations! You earned 100 Egg points for hatching 333 eggs!")
     
-    # Для multi egg показываем прогресс во всплывающем уведомлении и отправляем ЛС
+    # Отвечаем на нажатие сразу после транзакции; личное сообщение и обновление
+    # сообщения с яйцом выполняются фоновыми заданиями (jobs.py)
     if is_multi_egg:
-        # Получаем актуальные данные после обновления
-        # ВАЖНО: данные уже обновлены, поэтому hatched_count уже увеличен на 1
-        multi_egg_data = multi_eggs.get(egg_key, {'hatched_count': 0, 'hatched_by_list': []})
-        hatched_count = multi_egg_data['hatched_count']
-        remaining = max_hatches - hatched_count
+        # Прогресс после этого вылупления (hatched_count уже увеличен на 1)
+        hatched_count = result['hatched_count']
         
-        logger.info(f"Multi egg {egg_key}: hatched_count={hatched_count}, max_hatches={max_hatches}, remaining={remaining}, clicker_id={clicker_id}")
+        logger.info(f"Multi egg {egg_key}: hatched_count={hatched_count}, max_hatches={max_hatches}, remaining={max_hatches - hatched_count}, clicker_id={clicker_id}")
         
         # Показываем прогресс во всплывающем уведомлении
-        answer_text = f"{hatched_count}/{max_hatches}"
-        await query.answer(answer_text)
-        
-        # Отправляем личное сообщение пользователю, который вылупил яйцо
-        # Используем asyncio для небольшой задержки, чтобы убедиться, что callback обработан
-        await asyncio.sleep(0.1)  # Небольшая задержка 100ms
-        
-        try:
-            # Создаем кнопки для ЛС сообщения
-            # Используем формат https://t.me/bot_username?startapp=sender_id для реферальной ссылки
-            referral_url = f"https://t.me/{BOT_USERNAME}?startapp={sender_id}"
-            ls_keyboard = InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton(
-                        "📱 Hatch App",
-                        url=referral_url
-                    ),
-                    InlineKeyboardButton(
-                        "Send 🥚",
-                        switch_inline_query_current_chat="egg"
-                    )
-                ]
-            ])
-            
-            logger.info(f"Attempting to send personal message to user {clicker_id} after hatching multi egg {egg_key} ({hatched_count}/{max_hatches})")
-            
-            # Пытаемся отправить сообщение
-            sent_message = await context.bot.send_message(
-                chat_id=clicker_id,
-                text="🐣",
-                reply_markup=ls_keyboard,
-                disable_notification=False
-            )
-            
-            if sent_message:
-                logger.info(f"Successfully sent personal message to user {clicker_id} (message_id: {sent_message.message_id})")
-            else:
-                logger.warning(f"send_message returned None for user {clicker_id}")
-                
-        except Exception as e:
-            error_msg = str(e)
-            error_type = type(e).__name__
-            logger.error(f"Failed to send personal message to user {clicker_id}: {error_type}: {error_msg}", exc_info=True)
-            
-            # Если это ошибка "bot blocked by user" или "chat not found", логируем отдельно
-            if "chat not found" in error_msg.lower() or "bot was blocked" in error_msg.lower() or "forbidden" in error_msg.lower() or "user is deactivated" in error_msg.lower():
-                logger.warning(f"User {clicker_id} has not started a conversation with the bot, blocked it, or account is deactivated. Cannot send DM.")
-            else:
-                logger.error(f"Unexpected error when sending message to user {clicker_id}: {error_msg}")
+        await query.answer(f"{hatched_count}/{max_hatches}")
         
-        # Обновляем сообщение в чате
-        try:
-            if remaining > 0:
-                # Если еще можно вылупить, обновляем кнопку с прогрессом
-                button_text = f"🥚 Hatch ({hatched_count}/{max_hatches})"
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton(button_text, callback_data=query.data)]
-                ])
-                # Сообщение остается просто с яйцом, не меняем текст
-                await query.edit_message_reply_markup(reply_markup=keyboard)
-                logger.info(f"Multi egg {egg_key} updated: {hatched_count}/{max_hatches} hatched, {remaining} remaining")
-            else:
-                # Если лимит достигнут, меняем эмодзи на 🐣 и добавляем кнопки
-                # Используем формат https://t.me/bot_username?startapp=sender_id для реферальной ссылки
-                referral_url = f"https://t.me/{BOT_USERNAME}?startapp={sender_id}"
-                keyboard = InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton(
-                            "📱 Hatch App",
-                            url=referral_url
-                        ),
-                        InlineKeyboardButton(
-                            "Send 🥚",
-                            switch_inline_query_current_chat="egg"
-                        )
-                    ]
-                ])
-                # Меняем эмодзи с 🥚 на 🐣
-                await query.edit_message_text(
-                    "🐣",
-                    reply_markup=keyboard
-                )
-                logger.info(f"Multi egg {egg_key} completed ({hatched_count}/{max_hatches}), changed emoji to 🐣 with buttons")
-        except Exception as e:
-            logger.error(f"Error updating multi egg message: {e}", exc_info=True)
-            # Пытаемся хотя бы обновить reply_markup
-            try:
-                if remaining > 0:
-                    button_text = f"🥚 Hatch ({hatched_count}/{max_hatches})"
-                    keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton(button_text, callback_data=query.data)]
-                    ])
-                    await query.edit_message_reply_markup(reply_markup=keyboard)
-                else:
-                    referral_url = f"https://t.me/{BOT_USERNAME}?startapp={sender_id}"
-                    keyboard = InlineKeyboardMarkup([
-                        [
-                            InlineKeyboardButton(
-                                "📱 Hatch App",
-                                url=referral_url
-                            ),
-                            InlineKeyboardButton(
-                                "Send 🥚",
-                                switch_inline_query_current_chat="egg"
-                            )
-                        ]
-                    ])
-                    await query.edit_message_reply_markup(reply_markup=keyboard)
-            except Exception as e2:
-                logger.error(f"Error updating multi egg reply_markup: {e2}", exc_info=True)
+        # Правки одного сообщения склеиваются; 🐣 при наборе лимита ставится сразу
+        multi_egg_edits.submit(
+            egg_key, JOB_PRIORITY_EDIT, 'multi_egg_edit', update_multi_egg_message,
+            query, sender_id, egg_key, hatched_count, max_hatches,
+            final=hatched_count >= max_hatches
+        )
+        # Личное сообщение тому, кто вылупил яйцо: одно на каждое яйцо (кнопка ведет к его
+        # отправителю), поэтому сообщения не склеиваются
+        outbound.send(clicker_id, "🐣", reply_markup=hatched_egg_keyboard(sender_id), disable_notification=False)
     else:
         # Обычное яйцо - вылуплено
         await query.answer("🐣 Hatching egg...")
         
         logger.info(f"Egg {egg_id} hatched by {clicker_id} (sent by {sender_id})")
         
-        # Создаем кнопки для открытия mini app и отправки еще одного яйца
-        # Используем формат https://t.me/bot_username?startapp=sender_id для реферальной ссылки
-        referral_url = f"https://t.me/{BOT_USERNAME}?startapp={sender_id}"
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(
-                    "📱 Hatch App",
-                    url=referral_url
-                ),
-                InlineKeyboardButton(
-                    "Send 🥚",
-                    switch_inline_query_current_chat="egg"
-                )
-            ]
-        ])
-        
-        # Меняем 🥚 на 🐣 и добавляем кнопки
-        try:
-            await query.edit_message_text(
-                "🐣",
-                reply_markup=keyboard
-            )
-            logger.info(f"Successfully updated egg message to 🐣 with buttons for egg {egg_key}")
-        except Exception as e:
-            logger.error(f"Error editing message: {e}", exc_info=True)
-            # Если не удалось отредактировать текст, пробуем только reply_markup
-            try:
-                await query.edit_message_reply_markup(reply_markup=keyboard)
-                logger.info(f"Updated reply_markup only for egg {egg_key}")
-            except Exception as e2:
-                logger.error(f"Error updating reply_markup: {e2}", exc_info=True)
-                # Если и это не работает, пробуем отредактировать только текст
-                try:
-                    await query.edit_message_text("🐣")
-                    # Затем добавляем кнопки отдельно
-                    await query.edit_message_reply_markup(reply_markup=keyboard)
-                except Exception as e3:
-                    logger.error(f"Error editing message text and reply_markup: {e3}", exc_info=True)
-                    # Если и это не работает, просто отвечаем
-                    await query.answer("🐣 Egg hatched!", show_alert=False)
+        background_jobs.submit(JOB_PRIORITY_EDIT, 'egg_edit', update_hatched_egg_message, query, sender_id, egg_key)
 
 
 async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1051,36 +1337,27 @@ async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         # Если пользователь подписался (стал MEMBER или не LEFT/KICKED)
         if new_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            # Проверяем, не получал ли уже награду
-            if not completed_tasks.get(user_id, {}).get('subscribed_to_hatch_egg', False):
-                # Начисляем 20 Eggs (available eggs to send)
-                today = date.today().isoformat()
-                user_data = daily_eggs_sent.get(user_id, {})
-                if user_data.get('date') != today:
-                    # Сохраняем paid_eggs при инициализации нового дня
-                    old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
-                    daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
-                    user_data = daily_eggs_sent[user_id]
-                user_data['paid_eggs'] = user_data.get('paid_eggs', 0) + 20
-                
-                # Отмечаем задание как выполненное
-                if user_id not in completed_tasks:
-                    completed_tasks[user_id] = {}
-                completed_tasks[user_id]['subscribed_to_hatch_egg'] = True
-                
-                # Сохраняем данные после обновления
-                save_data()
-                
-                logger.info(f"User {user_id} subscribed to Hatch Egg, earned 20 Eggs")
-                
+            # Проверка и начисление - одна транзакция: награда начисляется один раз,
+            # даже если одновременно идет проверка подписки из API
+            rewarded = await call_state('reward_channel_subscription', user_id)
+            
+            if rewarded:
                 # Уведомляем пользователя
-                try:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="🎉 Congratulations! You earned 20 Eggs for subscribing to @hatch_egg!"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send notification to user {user_id}: {e}")
+                notify_user(user_id, "🎉 Congratulations! You earned 20 Eggs for subscribing to @hatch_egg!")
+
+
+async def my_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пользователь заблокировал или разблокировал бота в личном чате"""
+    member_update = update.my_chat_member
+    if member_update is None or member_update.chat.type != ChatType.PRIVATE:
+        return
+    user_id = member_update.chat.id
+    if member_update.new_chat_member.status == ChatMemberStatus.BANNED:
+        logger.info(f"User {user_id} blocked the bot")
+        await call_state('mark_user_unreachable', user_id, REASON_BLOCKED)
+    elif member_update.new_chat_member.status == ChatMemberStatus.MEMBER:
+        logger.info(f"User {user_id} unblocked the bot")
+        await call_state('mark_user_reachable', user_id)
 
 
 async def stats_api(request):
@@ -1111,16 +1388,18 @@ async def stats_api(request):
             headers={'Access-Control-Allow-Origin': '*'}
         )
     
-    hatched_count = eggs_hatched_by_user.get(user_id, 0)
-    my_eggs_hatched = user_eggs_hatched_by_others.get(user_id, 0)
-    sent_count = eggs_sent_by_user.get(user_id, 0)
-    points = egg_points.get(user_id, 0)
+    # Все счетчики пользователя - одна запись таблицы пользователей
+    counters = user_table.get(user_id)
+    hatched_count = counters.hatched or 0
+    my_eggs_hatched = counters.hatched_by_others or 0
+    sent_count = counters.sent or 0
+    points = counters.points or 0
     tasks = completed_tasks.get(user_id, {})
-    referral_earned = referral_earnings.get(user_id, 0)
+    referral_earned = counters.referral_earned or 0
     referrer_id = referrers.get(user_id)
     
-    # Count referrals (users who have this user as referrer)
-    referrals_count = sum(1 for ref_user_id, ref_referrer_id in referrers.items() if ref_referrer_id == user_id)
+    # Count referrals (users who have this user as referrer) - по обратному индексу
+    referrals_count = referrers.referral_count(user_id)
     
     # Calculate available eggs (10 free per day + paid eggs - sent today)
     # Paid eggs сохраняются между днями, сбрасывается только daily_sent
@@ -1150,7 +1429,93 @@ async def stats_api(request):
             'referral_earned': referral_earned,
             'referral_earnings': referral_earned,  # Alias for compatibility
             'referrals_count': referrals_count,
-            'has_referrer': referrer_id is not None
+            'has_referrer': referrer_id is not None,
+            'rank': leaderboard.rank(user_id)  # Место по egg_points (None - нет поинтов)
+        },
+        headers={'Access-Control-Allow-Origin': '*'}
+    )
+
+
+async def referrals_api(request):
+    """API endpoint для списка рефералов пользователя (постранично, новые первыми)"""
+    if MAINTENANCE_MODE:
+        return web.json_response(
+            {'error': 'Bot is under maintenance. Please try again later.'},
+            status=503,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    
+    try:
+        user_id = int(request.query['user_id'])
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', REFERRALS_PAGE_SIZE))
+    except KeyError:
+        return web.json_response(
+            {'error': 'user_id required'},
+            status=400,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    except ValueError:
+        return web.json_response(
+            {'error': 'invalid user_id, offset or limit'},
+            status=400,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), REFERRALS_PAGE_MAX)
+    
+    referrals = []
+    for referral_id in referrers.referrals_of(user_id, offset, limit):
+        counters = user_table.get(referral_id)
+        referrals.append({
+            'user_id': referral_id,
+            'egg_points': counters.points or 0,
+            'hatched_by_me': counters.hatched or 0,
+            'eggs_sent': counters.sent or 0
+        })
+    
+    return web.json_response(
+        {
+            'user_id': user_id,
+            'total': referrers.referral_count(user_id),
+            'offset': offset,
+            'limit': limit,
+            'referrals': referrals
+        },
+        headers={'Access-Control-Allow-Origin': '*'}
+    )
+
+
+async def leaderboard_api(request):
+    """API endpoint для таблицы лидеров по egg_points (постранично)"""
+    if MAINTENANCE_MODE:
+        return web.json_response(
+            {'error': 'Bot is under maintenance. Please try again later.'},
+            status=503,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    
+    try:
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', LEADERBOARD_PAGE_SIZE))
+    except ValueError:
+        return web.json_response(
+            {'error': 'invalid offset or limit'},
+            status=400,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), LEADERBOARD_PAGE_MAX)
+    
+    return web.json_response(
+        {
+            'total': len(leaderboard),
+            'offset': offset,
+            'limit': limit,
+            'leaders': [
+                {'rank': rank, 'user_id': user_id, 'egg_points': points}
+                for rank, user_id, points in leaderboard.page(offset, limit)
+            ]
         },
         headers={'Access-Control-Allow-Origin': '*'}
     )
@@ -1193,42 +1558,28 @@ async def check_subscription_api(request):
     
     # Проверяем подписку через Telegram API
     try:
-        subscribed = completed_tasks.get(user_id, {}).get('subscribed_to_hatch_egg', False)
-        
-        # Если еще не отмечено как выполненное, проверяем через API
-        if not subscribed and bot_application:
-            try:
-                chat_member = await bot_application.bot.get_chat_member(
-                    chat_id=HATCH_EGG_CHANNEL,
-                    user_id=user_id
-                )
-                
-                # Проверяем, что пользователь подписан
-                if chat_member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-                    # Начисляем 20 Eggs (available eggs to send)
-                    today = date.today().isoformat()
-                    user_data = daily_eggs_sent.get(user_id, {})
-                    if user_data.get('date') != today:
-                        # Сохраняем paid_eggs при инициализации нового дня
-                        old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
-                        daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
-                        user_data = daily_eggs_sent[user_id]
-                    user_data['paid_eggs'] = user_data.get('paid_eggs', 0) + 20
-                    
-                    # Отмечаем задание как выполненное
-                    if user_id not in completed_tasks:
-                        completed_tasks[user_id] = {}
-                    completed_tasks[user_id]['subscribed_to_hatch_egg'] = True
-                    
-                    # Сохраняем данные после обновления
-                    save_data()
+        # Проверка и начисление под блокировкой пользователя: повторный запрос
+        # дождется первого и не начислит награду дважды
+        async with user_locks.hold(user_id):
+            subscribed = completed_tasks.get(user_id, {}).get('subscribed_to_hatch_egg', False)
+            
+            # Если еще не отмечено как выполненное, проверяем через API
+            if not subscribed and bot_application:
+                try:
+                    chat_member = await bot_application.bot.get_chat_member(
+                        chat_id=HATCH_EGG_CHANNEL,
+                        user_id=user_id
+                    )
                     
-                    subscribed = True
-                    logger.info(f"User {user_id} is subscribed to Hatch Egg, earned 20 Eggs")
-            except Exception as e:
-                logger.error(f"Error checking chat member: {e}")
-                # Если пользователь не найден или не подписан, subscribed остается False
-        
+                    # Проверяем, что пользователь подписан
+                    if chat_member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+                        # Начисляем 20 Eggs той же транзакцией, что и при событии подписки в канале
+                        reward_channel_subscription(user_id)
+                        subscribed = True
+                except Exception as e:
+                    logger.error(f"Error checking chat member: {e}")
+                    # Если пользователь не найден или не подписан, subscribed остается False
+            
         return web.json_response(
             {
                 'subscribed': subscribed
@@ -1337,7 +1688,7 @@ async def verify_ton_payment_api(request):
     
     # Добавляем оплаченные яйца к лимиту пользователя
     add_paid_eggs(user_id, eggs_to_add)
-    save_data()
+    save_data('payment_recorded', ('ton_payments', user_id), ('daily_eggs_sent', user_id))
     
     logger.info(f"TON payment verified: user_id={user_id}, amount={amount}, eggs={eggs_to_add}, tx_hash={tx_hash}")
     
@@ -1429,34 +1780,78 @@ async def admin_stats_api(request):
     
     logger.info(f"admin_stats_api: Access granted for user_id: {user_id}")
     
-    # Подсчитываем статистику
-    total_users = len(set(list(eggs_hatched_by_user.keys()) + list(user_eggs_hatched_by_others.keys()) + list(eggs_sent_by_user.keys()) + list(egg_points.keys())))
-    total_eggs_sent = sum(eggs_sent_by_user.values())
-    total_eggs_hatched = len(hatched_eggs)
-    total_points = sum(egg_points.values())
+    # Статистика ведется на каждом изменении данных (totals.py), здесь только читается.
+    # online_users - пользователи с ежедневным счетчиком за сегодня (упрощенная версия),
+    # active_users_24h - за сегодня и вчера
+    stats = global_totals.summary()
+    stats['total_referrals'] = len(referrers)
+    stats['total_tasks'] = len(admin_tasks)
+    
+    return web.json_response(
+        stats,
+        headers={'Access-Control-Allow-Origin': '*'}
+    )
+
+
+async def admin_metrics_api(request):
+    """API endpoint для внутренних метрик бота (только для owner)"""
+    user_id = request.query.get('user_id')
+    if not user_id:
+        return web.json_response(
+            {'error': 'user_id required'}, 
+            status=400,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return web.json_response(
+            {'error': 'invalid user_id'}, 
+            status=400,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
     
-    # Подсчитываем активных пользователей за последние 24 часа
-    from datetime import datetime, timedelta
-    yesterday = (datetime.now() - timedelta(days=1)).date().isoformat()
-    active_users = set()
-    for user_id_key, user_data in daily_eggs_sent.items():
-        if user_data.get('date') == date.today().isoformat() or user_data.get('date') == yesterday:
-            active_users.add(user_id_key)
+    # Проверяем права доступа
+    if not OWNER_ID:
+        return web.json_response(
+            {'error': 'OWNER_ID not configured'}, 
+            status=403,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
     
-    # Подсчитываем онлайн пользователей (активные за последний час - упрощенная версия)
-    # В реальности нужно отслеживать последнюю активность, но для простоты используем сегодняшних активных
-    online_users = len([uid for uid, data in daily_eggs_sent.items() if data.get('date') == date.today().isoformat()])
+    if user_id != OWNER_ID:
+        return web.json_response(
+            {'error': 'Access denied. Only owner can view metrics.'}, 
+            status=403,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
     
     return web.json_response(
         {
-            'total_users': total_users,
-            'online_users': online_users,
-            'active_users_24h': len(active_users),
-            'total_eggs_sent': total_eggs_sent,
-            'total_eggs_hatched': total_eggs_hatched,
-            'total_points': total_points,
-            'total_referrals': len(referrers),
-            'total_tasks': len(admin_tasks)
+            'persistence': persister.stats(),
+            'storage': storage.stats(),
+            'archive_mover': cold_egg_mover.stats(),
+            'draft_eggs': draft_eggs.stats(),
+            'leaderboard': leaderboard.stats(),
+            'global_totals': global_totals.stats(),
+            'egg_ids': {
+                'allocator': egg_id_allocator.stats(),
+                'sequence': egg_id_sequence.stats()
+            },
+            'user_locks': user_locks.stats(),
+            'concurrent_updates': CONCURRENT_UPDATES,
+            'state_service': state_server.stats() if state_server else None,
+            'workers': worker_pool.stats() if worker_pool else None,
+            'update_queue': {
+                'depth': bot_application.update_queue.qsize() if bot_application else None,
+                'size': UPDATE_QUEUE_SIZE
+            },
+            'webhook': webhook_receiver.stats() if webhook_receiver else None,
+            'background_jobs': background_jobs.stats(),
+            'multi_egg_edits': multi_egg_edits.stats(),
+            'outbound': outbound.stats(),
+            'unreachable_users': unreachable_users.stats()
         },
         headers={'Access-Control-Allow-Origin': '*'}
     )
@@ -1525,61 +1920,63 @@ async def check_task_subscription_api(request):
         
         chat_identifier = match.group(1)
         
-        # Проверяем, выполнена ли уже эта задача
-        task_key = f'task_{task_id}'
-        if completed_tasks.get(user_id, {}).get(task_key, False):
-            return web.json_response(
-                {'subscribed': True},
-                headers={'Access-Control-Allow-Origin': '*'}
-            )
-        
-        # Проверяем подписку через Telegram Bot API
-        subscribed = False
-        if bot_application:
-            try:
-                # Пробуем получить информацию о чате
-                chat_member = await bot_application.bot.get_chat_member(
-                    chat_id=f'@{chat_identifier}',
-                    user_id=user_id
+        # Проверка и начисление под блокировкой пользователя (награда начисляется один раз)
+        async with user_locks.hold(user_id):
+            # Проверяем, выполнена ли уже эта задача
+            task_key = f'task_{task_id}'
+            if completed_tasks.get(user_id, {}).get(task_key, False):
+                return web.json_response(
+                    {'subscribed': True},
+                    headers={'Access-Control-Allow-Origin': '*'}
                 )
-                
-                # Проверяем, что пользователь подписан
-                if chat_member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-                    subscribed = True
-                    
-                    # Находим задачу и начисляем награду
-                    task = None
-                    for t in admin_tasks:
-                        if t.get('id') == task_id:
-                            task = t
-                            break
+            
+            # Проверяем подписку через Telegram Bot API
+            subscribed = False
+            if bot_application:
+                try:
+                    # Пробуем получить информацию о чате
+                    chat_member = await bot_application.bot.get_chat_member(
+                        chat_id=f'@{chat_identifier}',
+                        user_id=user_id
+                    )
                     
-                    if task:
-                        reward = task.get('reward', 0)
-                        if reward > 0:
-                            # Начисляем Eggs
-                            today = date.today().isoformat()
-                            user_data = daily_eggs_sent.get(user_id, {})
-                            if user_data.get('date') != today:
-                                old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
-                                daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
-                                user_data = daily_eggs_sent[user_id]
-                            user_data['paid_eggs'] = user_data.get('paid_eggs', 0) + reward
+                    # Проверяем, что пользователь подписан
+                    if chat_member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+                        subscribed = True
                         
-                        # Отмечаем задание как выполненное
-                        if user_id not in completed_tasks:
-                            completed_tasks[user_id] = {}
-                        completed_tasks[user_id][task_key] = True
+                        # Находим задачу и начисляем награду
+                        task = None
+                        for t in admin_tasks:
+                            if t.get('id') == task_id:
+                                task = t
+                                break
                         
-                        # Сохраняем данные
-                        save_data()
-                        
-                        logger.info(f"User {user_id} completed task {task_id}, earned {reward} Eggs")
-            except Exception as e:
-                logger.error(f"Error checking chat member for {chat_identifier}: {e}")
-                # Если не удалось проверить (например, бот не в чате или приватный канал), возвращаем False
-                subscribed = False
-        
+                        if task:
+                            reward = task.get('reward', 0)
+                            if reward > 0:
+                                # Начисляем Eggs
+                                today = date.today().isoformat()
+                                user_data = daily_eggs_sent.get(user_id, {})
+                                if user_data.get('date') != today:
+                                    old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
+                                    daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
+                                    user_data = daily_eggs_sent[user_id]
+                                user_data['paid_eggs'] = user_data.get('paid_eggs', 0) + reward
+                            
+                            # Отмечаем задание как выполненное
+                            if user_id not in completed_tasks:
+                                completed_tasks[user_id] = {}
+                            completed_tasks[user_id][task_key] = True
+                            
+                            # Сохраняем данные
+                            save_data('task_completed', ('daily_eggs_sent', user_id), ('completed_tasks', user_id))
+                            
+                            logger.info(f"User {user_id} completed task {task_id}, earned {reward} Eggs")
+                except Exception as e:
+                    logger.error(f"Error checking chat member for {chat_identifier}: {e}")
+                    # Если не удалось проверить (например, бот не в чате или приватный канал), возвращаем False
+                    subscribed = False
+            
         return web.json_response(
             {'subscribed': subscribed},
             headers={'Access-Control-Allow-Origin': '*'}
@@ -1615,6 +2012,8 @@ async def public_tasks_api(request):
 
 async def admin_maintenance_api(request):
     """API endpoint для управления режимом обслуживания (только для owner)"""
+    global MAINTENANCE_MODE
+    
     # Handle CORS preflight
     if request.method == 'OPTIONS':
         return web.Response(
@@ -1674,9 +2073,10 @@ async def admin_maintenance_api(request):
                 enabled = str(enabled).lower() == 'true'
             
             # Обновляем глобальную переменную
-            global MAINTENANCE_MODE
             MAINTENANCE_MODE = enabled
             save_maintenance_mode(enabled)
+            if state_server is not None:
+                state_server.broadcast(['maintenance', enabled])
             
             logger.info(f"Maintenance mode {'ENABLED' if enabled else 'DISABLED'} by owner {user_id}")
             
@@ -1745,20 +2145,27 @@ async def admin_backup_api(request):
             headers={'Access-Control-Allow-Origin': '*'}
         )
     
-    # Читаем файл данных
+    # Собираем данные для backup
     try:
-        if not os.path.exists(DATA_FILE):
-            return web.json_response(
-                {'error': 'Data file not found'}, 
-                status=404,
-                headers={'Access-Control-Allow-Origin': '*'}
-            )
-        
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        # Сначала сбрасываем накопленные изменения в фоне: иначе export_data у SQLite
+        # дописывал бы всю очередь в базу синхронно, в цикле событий
+        await persister.flush_async()
+        # Берем актуальное состояние из памяти: файл может отставать от журнала
+        data = build_snapshot_data()
         
         logger.info(f"Backup downloaded by owner {user_id}")
         
+        # ?format=binary - компактный бинарный снимок (конвертер в JSON: snapshot_codec.py)
+        if request.query.get('format') == 'binary':
+            return web.Response(
+                body=snapshot_codec.encode(data, compress=True),
+                headers={
+                    'Access-Control-Allow-Origin': '*',
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Disposition': 'attachment; filename="bot_data.bin"'
+                }
+            )
+        
         return web.json_response(
             data,
             headers={
@@ -1847,7 +2254,7 @@ async def admin_tasks_api(request):
                 'created_at': datetime.now().isoformat()
             }
             admin_tasks.append(new_task)
-            save_data()
+            save_data('admin_tasks_changed', ('admin_tasks',))
             return web.json_response(
                 {'success': True, 'task': new_task},
                 headers={'Access-Control-Allow-Origin': '*'}
@@ -1871,7 +2278,7 @@ async def admin_tasks_api(request):
                 )
             
             admin_tasks = [t for t in admin_tasks if t.get('id') != task_id]
-            save_data()
+            save_data('admin_tasks_changed', ('admin_tasks',))
             return web.json_response(
                 {'success': True},
                 headers={'Access-Control-Allow-Origin': '*'}
@@ -1891,80 +2298,272 @@ async def admin_tasks_api(request):
         )
 
 
+def create_api_app():
+    """Создает aiohttp приложение со всеми API эндпоинтами"""
+    app = web.Application()
+    app.router.add_get('/api/stats', stats_api)
+    app.router.add_get('/api/referrals', referrals_api)
+    app.router.add_get('/api/leaderboard', leaderboard_api)
+    app.router.add_post('/api/stats/check_subscription', check_subscription_api)
+    app.router.add_options('/api/stats/check_subscription', check_subscription_api)
+    app.router.add_post('/api/ton/verify_payment', verify_ton_payment_api)
+    app.router.add_get('/api/ton/payment_info', get_payment_info_api)
+    app.router.add_options('/api/ton/verify_payment', verify_ton_payment_api)
+    # Admin API endpoints
+    app.router.add_get('/api/admin/stats', admin_stats_api)
+    app.router.add_get('/api/admin/metrics', admin_metrics_api)
+    app.router.add_get('/api/admin/tasks', admin_tasks_api)
+    app.router.add_post('/api/admin/tasks', admin_tasks_api)
+    app.router.add_delete('/api/admin/tasks', admin_tasks_api)
+    app.router.add_options('/api/admin/tasks', admin_tasks_api)
+    # Maintenance mode API
+    app.router.add_get('/api/admin/maintenance', admin_maintenance_api)
+    app.router.add_post('/api/admin/maintenance', admin_maintenance_api)
+    app.router.add_options('/api/admin/maintenance', admin_maintenance_api)
+    # Backup data API (only for owner)
+    app.router.add_get('/api/admin/backup', admin_backup_api)
+    app.router.add_options('/api/admin/backup', admin_backup_api)
+    # Public tasks endpoint (for users to see available tasks)
+    app.router.add_get('/api/tasks', public_tasks_api)
+    # Добавляем роуты для Eggchain Explorer
+    setup_eggchain_routes(app)
+    # Task subscription check endpoint
+    app.router.add_post('/api/tasks/check_subscription', check_task_subscription_api)
+    app.router.add_options('/api/tasks/check_subscription', check_task_subscription_api)
+    return app
+
+
+# Типы апдейтов, для которых есть обработчики: остальные Telegram не присылает
+ALLOWED_UPDATES = [
+    Update.MESSAGE,
+    Update.INLINE_QUERY,
+    Update.CHOSEN_INLINE_RESULT,
+    Update.CALLBACK_QUERY,
+    Update.CHAT_MEMBER,
+    Update.MY_CHAT_MEMBER
+]
+
+
+def add_bot_handlers(application):
+    """Регистрирует обработчики апдейтов"""
+    application.add_handler(CommandHandler("start", start))
+    # Команда reset_all отключена для защиты данных пользователей
+    # application.add_handler(CommandHandler("reset_all", reset_all))
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(ChosenInlineResultHandler(chosen_inline_result))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(my_chat_member_handler, ChatMemberHandler.MY_CHAT_MEMBER))
+
+
+def update_partition(update):
+    """Ключ раздела апдейта: отправитель яйца для нажатий, иначе сам пользователь
+
+    Inline запрос, выбор результата и нажатия под яйцом одного отправителя
+    попадают в один процесс-обработчик - туда, где лежит черновик яйца.
+    """
+    query = update.callback_query
+    if query is not None and query.data:
+        parsed = decode_callback_data(query.data)
+        if parsed is not None:
+            return parsed[1]
+    if query is not None and query.data and query.data[:6] in ('hatch_', 'multi_'):
+        data_part = query.data[6:]
+        sender = data_part.split('|', 1)[0] if '|' in data_part else data_part.rsplit('_', 1)[-1]
+        if sender.isdigit():
+            return int(sender)
+    user = update.effective_user
+    return user.id if user is not None else 0
+
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Передает апдейт процессу-обработчику его раздела (WORKERS > 0)
+
+    Если обработчик не подключен (перезапускается), апдейт обрабатывает
+    сам владелец данных обычными обработчиками.
+    """
+    worker_index = update_partition(update) % WORKERS
+    if state_server.push(worker_index, ['update', update.to_dict()]):
+        raise ApplicationHandlerStop
+    logger.warning(f"Worker {worker_index} is not attached, handling update {update.update_id} in the main process")
+
+
+def run_worker():
+    """Процесс-обработчик (ROLE=worker): апдейты и транзакции через владельца данных"""
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .updater(None)
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+        .build()
+    )
+    add_bot_handlers(application)
+    
+    def on_push(message):
+        global MAINTENANCE_MODE
+        kind = message[0]
+        if kind == 'update':
+            application.update_queue.put_nowait(Update.de_json(message[1], application.bot))
+        elif kind == 'maintenance':
+            MAINTENANCE_MODE = message[1]
+        elif kind == 'unreachable':
+            _, user_id, until, reason = message
+            unreachable_users.mark(user_id, reason, until)
+        elif kind == 'reachable':
+            unreachable_users.clear(message[1])
+    
+    async def serve():
+        global state_client, MAINTENANCE_MODE
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop_event.set)
+        
+        state_client = StateClient(STATE_SOCKET, on_push=on_push)
+        await state_client.connect(worker_index=WORKER_INDEX)
+        MAINTENANCE_MODE = await state_client.call('get_maintenance_mode')
+        unreachable_users.replace(await state_client.call('get_unreachable_users'))
+        async with application:
+            await application.start()
+            background_jobs.start()
+            outbound.start(application.bot)
+            logger.info(f"Worker {WORKER_INDEX} started (pid {os.getpid()})")
+            # Работаем до сигнала остановки или потери связи с владельцем данных
+            closed = asyncio.create_task(state_client.closed.wait())
+            stopped = asyncio.create_task(stop_event.wait())
+            await asyncio.wait([closed, stopped], return_when=asyncio.FIRST_COMPLETED)
+            closed.cancel()
+            stopped.cancel()
+            await application.stop()
+            multi_egg_edits.flush_all()
+            await background_jobs.stop()
+            await outbound.stop()
+        await state_client.close()
+    
+    asyncio.run(serve())
+
+
 def main():
     """Запуск бота"""
-    import threading
-    import asyncio
-    global bot_application
+    global bot_application, state_server, worker_pool, webhook_receiver
+    if ROLE == 'worker':
+        run_worker()
+        return
+    if WORKERS > 0:
+        state_server = StateServer(STATE_SOCKET, STATE_OPERATIONS)
+        worker_pool = WorkerPool(os.path.abspath(__file__), WORKERS, env={'STATE_SOCKET': STATE_SOCKET})
+    # Бот и API сервер работают в одном цикле событий: обработчики API
+    # напрямую вызывают методы бота и читают те же данные без гонок потоков
+    api_runner = None
+    
+    async def start_api_server():
+        # Используем PORT из окружения (для Railway, Render и т.д.) или 8080 по умолчанию
+        port = int(os.environ.get('PORT', 8080))
+        app = create_api_app()
+        if webhook_receiver is not None:
+            # Апдейты Telegram принимает тот же сервер, что и API
+            app.router.add_post(WEBHOOK_PATH, webhook_receiver.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '0.0.0.0', port)
+        await site.start()
+        logger.info(f"API server started on http://0.0.0.0:{port}/api/stats")
+        return runner
+    
+    async def on_startup(app):
+        nonlocal api_runner
+        # Запускаем фоновое сохранение в цикле событий бота
+        persister.start()
+        unreachable_saver.start()
+        cold_egg_mover.start()
+        global_totals.start()
+        background_jobs.start()
+        outbound.start(app.bot)
+        if WORKERS > 0:
+            # Сервис состояния поднимается до обработчиков: они подключаются к нему при старте
+            await state_server.start()
+            worker_pool.start()
+        api_runner = await start_api_server()
+    
+    async def on_shutdown(app):
+        # Сначала останавливаем обработчики и API, чтобы после финального сброса никто не менял данные
+        if worker_pool is not None:
+            await worker_pool.stop()
+            await state_server.stop()
+        if api_runner is not None:
+            await api_runner.cleanup()
+        multi_egg_edits.flush_all()
+        await background_jobs.stop()
+        await outbound.stop()
+        # При корректной остановке сбрасываем все несохраненные изменения
+        await cold_egg_mover.stop()
+        await global_totals.stop()
+        await persister.stop()
+        await unreachable_saver.stop()
+        storage.close()
+    
+    async def run_webhook():
+        """Webhook режим: апдейты приходят POST запросами на сервер API"""
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop_event.set)
+        async with application:
+            await on_startup(application)
+            try:
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL + WEBHOOK_PATH,
+                    allowed_updates=ALLOWED_UPDATES,
+                    secret_token=WEBHOOK_SECRET
+                )
+                await application.start()
+                logger.info(f"Webhook set to {WEBHOOK_URL + WEBHOOK_PATH}")
+                await stop_event.wait()
+                await application.stop()
+            finally:
+                await on_shutdown(application)
     
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if WEBHOOK_URL:
+        # Апдейты принимает сервер API, опрос getUpdates не нужен
+        builder = builder.updater(None)
+    application = builder.build()
     bot_application = application
+    if WEBHOOK_URL:
+        webhook_receiver = WebhookReceiver(application.bot, application.update_queue, secret_token=WEBHOOK_SECRET)
     
     # Передаем бота в eggchain_api для получения информации о пользователях
     set_bot_instance(application.bot)
+    # Explorer ищет яйца через хранилище (память + индексы на диске)
+    set_storage(storage)
     
     # Регистрируем обработчики
-    application.add_handler(CommandHandler("start", start))
-    # Команда reset_all отключена для защиты данных пользователей
-    # application.add_handler(CommandHandler("reset_all", reset_all))
-    application.add_handler(InlineQueryHandler(inline_query))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER))
-    
-    # Запускаем веб-сервер для API в отдельном потоке
-    def run_api_server():
-        async def start_server():
-            import os
-            # Используем PORT из окружения (для Railway, Render и т.д.) или 8080 по умолчанию
-            port = int(os.environ.get('PORT', 8080))
-            
-            app = web.Application()
-            app.router.add_get('/api/stats', stats_api)
-            app.router.add_post('/api/stats/check_subscription', check_subscription_api)
-            app.router.add_options('/api/stats/check_subscription', check_subscription_api)
-            app.router.add_post('/api/ton/verify_payment', verify_ton_payment_api)
-            app.router.add_get('/api/ton/payment_info', get_payment_info_api)
-            app.router.add_options('/api/ton/verify_payment', verify_ton_payment_api)
-            # Admin API endpoints
-            app.router.add_get('/api/admin/stats', admin_stats_api)
-            app.router.add_get('/api/admin/tasks', admin_tasks_api)
-            app.router.add_post('/api/admin/tasks', admin_tasks_api)
-            app.router.add_delete('/api/admin/tasks', admin_tasks_api)
-            app.router.add_options('/api/admin/tasks', admin_tasks_api)
-            # Maintenance mode API
-            app.router.add_get('/api/admin/maintenance', admin_maintenance_api)
-            app.router.add_post('/api/admin/maintenance', admin_maintenance_api)
-            app.router.add_options('/api/admin/maintenance', admin_maintenance_api)
-            # Backup data API (only for owner)
-            app.router.add_get('/api/admin/backup', admin_backup_api)
-            app.router.add_options('/api/admin/backup', admin_backup_api)
-            # Public tasks endpoint (for users to see available tasks)
-            app.router.add_get('/api/tasks', public_tasks_api)
-            # Добавляем роуты для Eggchain Explorer
-            setup_eggchain_routes(app)
-            # Task subscription check endpoint
-            app.router.add_post('/api/tasks/check_subscription', check_task_subscription_api)
-            app.router.add_options('/api/tasks/check_subscription', check_task_subscription_api)
-            runner = web.AppRunner(app)
-            await runner.setup()
-            site = web.TCPSite(runner, '0.0.0.0', port)
-            await site.start()
-            logger.info(f"API server started on http://0.0.0.0:{port}/api/stats")
-            # Держим сервер запущенным
-            await asyncio.Event().wait()
-        
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(start_server())
-    
-    # Запускаем API сервер в отдельном потоке
-    api_thread = threading.Thread(target=run_api_server, daemon=True)
-    api_thread.start()
+    add_bot_handlers(application)
+    if WORKERS > 0:
+        # Апдейты раздаются процессам-обработчикам раньше обычных обработчиков
+        application.add_handler(TypeHandler(Update, route_update), group=-1)
+        logger.info(f"Updates are handled by {WORKERS} worker processes")
     
     # Запускаем бота
     logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        if WEBHOOK_URL:
+            asyncio.run(run_webhook())
+        else:
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        # Страховка: если post_shutdown не отработал, сбрасываем изменения здесь
+        persister.flush()
+        unreachable_saver.flush()
+        storage.close()
 
 
 if __name__ == '__main__':
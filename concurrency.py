@@ -0,0 +1,66 @@
+"""
+Блокировки для конкурентной обработки апдейтов
+
+Обработчики бота работают в одном цикле событий, но между await другие апдейты
+могут изменить те же данные. Изменения без await (транзакции вроде hatch_egg)
+атомарны сами по себе, а проверки, которые ждут ответа Bot API между проверкой
+и начислением (подписка на канал, задания), держат блокировку ключа, иначе два
+одновременных запроса начислят награду дважды.
+
+KeyedLocks - таблица asyncio блокировок, разбитая на полосы (lock striping):
+ключ по хешу попадает в одну из stripes блокировок. Память постоянная,
+независимо от числа пользователей, а разные ключи почти никогда не конкурируют.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+class KeyedLocks:
+    """Блокировки по ключу поверх фиксированного числа полос"""
+
+    def __init__(self, stripes=1024):
+        self.stripes = stripes
+        # Блокировки создаются лениво: asyncio.Lock привязывается к циклу событий при первом ожидании
+        self._locks = [None] * stripes
+
+        # Метрики
+        self.acquired = 0
+        self.contended = 0
+        self.max_wait_ms = 0.0
+
+    def lock(self, key):
+        """Блокировка полосы, в которую попадает ключ"""
+        index = hash(key) % self.stripes
+        lock = self._locks[index]
+        if lock is None:
+            lock = self._locks[index] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, key):
+        """Захватывает блокировку ключа на время блока async with"""
+        lock = self.lock(key)
+        if lock.locked():
+            self.contended += 1
+            started = time.perf_counter()
+            await lock.acquire()
+            wait_ms = (time.perf_counter() - started) * 1000
+            if wait_ms > self.max_wait_ms:
+                self.max_wait_ms = wait_ms
+        else:
+            await lock.acquire()
+        self.acquired += 1
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self):
+        return {
+            'stripes': self.stripes,
+            'acquired': self.acquired,
+            'contended': self.contended,
+            'max_wait_ms': round(self.max_wait_ms, 3)
+        }
@@ -0,0 +1,125 @@
+"""
+Черновики яиц, предложенных в inline режиме
+
+Telegram присылает inline query на каждое нажатие клавиши ("e", "eg", "egg",
+"egg 5", "egg 50"), и раньше каждый такой запрос создавал яйцо в eggs_detail и
+увеличивал счетчики отправленных. Теперь предложенное яйцо живет только в
+памяти как черновик и попадает в постоянное состояние, когда пользователь
+действительно отправил его (ChosenInlineResult) или когда под ним впервые
+нажали кнопку. Невыбранные черновики удаляются по TTL.
+
+Черновик может быть привязан к варианту предложения (отправитель + вид яйца):
+в течение reuse_window секунд после первого ответа (пока Telegram все равно
+может показать закэшированный результат) повторные inline запросы того же
+варианта получают то же яйцо (find_offer), а не создают новое. Дольше
+предложение не переиспользуется: ChosenInlineResult приходит только при
+включенном inline feedback, и без него одно яйцо, отправленное в несколько
+чатов, вылуплялось бы один раз на все чаты.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class DraftEggCache:
+    """Черновики {egg_key: egg_info} с ограничением по времени жизни и размеру
+
+    Записи добавляются в порядке времени, поэтому устаревшие всегда в начале
+    словаря и удаляются без полного перебора.
+    """
+
+    def __init__(self, ttl=86400.0, max_size=200000, reuse_window=10.0):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.reuse_window = reuse_window
+        # {egg_key: (expires_at, egg_info, offer)}
+        self._drafts = OrderedDict()
+        # {offer: (egg_key, reuse_until)} черновики, которые можно предложить повторно
+        self._offers = {}
+
+        # Метрики
+        self.offered = 0
+        self.promoted = 0
+        self.expired = 0
+        self.evicted = 0
+        self.reused = 0
+
+    def _purge(self, now):
+        drafts = self._drafts
+        while drafts:
+            egg_key, (expires_at, _, offer) = next(iter(drafts.items()))
+            if expires_at > now:
+                break
+            del drafts[egg_key]
+            self._forget_offer(offer, egg_key)
+            self.expired += 1
+        while len(drafts) > self.max_size:
+            egg_key, (_, _, offer) = drafts.popitem(last=False)
+            self._forget_offer(offer, egg_key)
+            self.evicted += 1
+
+    def _forget_offer(self, offer, egg_key):
+        if offer is not None and self._offers.get(offer, (None,))[0] == egg_key:
+            del self._offers[offer]
+
+    def put(self, egg_key, egg_info, offer=None):
+        """Запоминает предложенное яйцо (offer - вариант для повторного предложения)"""
+        now = time.monotonic()
+        self._drafts[egg_key] = (now + self.ttl, egg_info, offer)
+        self._drafts.move_to_end(egg_key)
+        if offer is not None and self.reuse_window > 0:
+            self._offers[offer] = (egg_key, now + self.reuse_window)
+        self.offered += 1
+        self._purge(now)
+
+    def find_offer(self, offer):
+        """Ключ невыбранного черновика варианта offer
+
+        None, если его нет, он истек или с первого ответа прошло больше
+        reuse_window секунд (сам черновик остается до выбора или TTL).
+        """
+        entry = self._offers.get(offer)
+        if entry is None:
+            return None
+        egg_key, reuse_until = entry
+        now = time.monotonic()
+        if reuse_until <= now:
+            del self._offers[offer]
+            return None
+        if egg_key not in self:
+            self._purge(now)
+            return None
+        self.reused += 1
+        return egg_key
+
+    def pop(self, egg_key):
+        """Забирает черновик для переноса в постоянное состояние (None, если его нет)"""
+        self._purge(time.monotonic())
+        entry = self._drafts.pop(egg_key, None)
+        if entry is None:
+            return None
+        # Выбранное яйцо больше не предлагается - следующий запрос получит новое
+        self._forget_offer(entry[2], egg_key)
+        self.promoted += 1
+        return entry[1]
+
+    def __contains__(self, egg_key):
+        entry = self._drafts.get(egg_key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def __len__(self):
+        return len(self._drafts)
+
+    def stats(self):
+        self._purge(time.monotonic())
+        return {
+            'drafts': len(self._drafts),
+            'offers': len(self._offers),
+            'offered': self.offered,
+            'reused': self.reused,
+            'promoted': self.promoted,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'ttl_seconds': self.ttl,
+            'max_size': self.max_size
+        }
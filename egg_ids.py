@@ -0,0 +1,160 @@
+"""
+Компактные номера яиц и упакованный callback_data
+
+Раньше egg_id - первые 16 hex символов UUID, а callback_data кнопки -
+hatch_{sender_id}|{egg_id} (около 35 байт), с запасным кодом на случай, если
+строка не влезет в лимит Telegram 64 байта. Теперь яйца получают возрастающие
+номера, а в egg_id и callback_data номер записан в base36:
+
+    2{вид}{max_hatches в base36}.{sender_id в base36}:{egg_id}     вид: h - обычное яйцо, m - multi egg
+
+Первый символ - версия формата (старые hatch_/multi_ начинаются с буквы).
+max_hatches в кнопке нужен, чтобы учесть яйцо с верным лимитом, даже если
+черновик потерян (рестарт, другой процесс, вытеснение). Кнопки версии 1 -
+1{вид}{sender_id в base36}:{egg_id} - без лимита, их тоже разбираем.
+Ключ яйца остается {sender_id}_{egg_id}: по нему разбиты снимки, архив и
+раздача апдейтов обработчикам, а int(egg_id, 36) дает сам номер.
+
+Номера выдаются блоками: владелец данных помнит верхнюю границу выданных
+номеров в файле (EggIdSequence), а процесс берет блок и раздает номера из
+него без обращения к диску. Номера неиспользованной части блока после
+рестарта пропускаются - важна только уникальность и возрастание.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_VERSION = '2'
+# Формат без max_hatches (кнопки, отправленные до версии 2)
+CALLBACK_VERSION_1 = '1'
+KIND_REGULAR = 'h'
+KIND_MULTI = 'm'
+
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def to_base36(number):
+    if number == 0:
+        return '0'
+    digits = []
+    while number:
+        number, rest = divmod(number, 36)
+        digits.append(_DIGITS[rest])
+    return ''.join(reversed(digits))
+
+
+def encode_callback_data(is_multi, sender_id, egg_id, max_hatches):
+    """callback_data кнопки яйца в компактном формате"""
+    kind = KIND_MULTI if is_multi else KIND_REGULAR
+    return f"{CALLBACK_VERSION}{kind}{to_base36(max_hatches)}.{to_base36(sender_id)}:{egg_id}"
+
+
+def decode_callback_data(data):
+    """Разбирает компактный callback_data: (is_multi, sender_id, egg_id, max_hatches) или None
+
+    max_hatches - None для кнопок версии 1.
+    """
+    if len(data) < 5 or data[0] not in (CALLBACK_VERSION, CALLBACK_VERSION_1) or data[1] not in (KIND_REGULAR, KIND_MULTI):
+        return None
+    head, _, egg_id = data[2:].partition(':')
+    max_hatches = None
+    if data[0] == CALLBACK_VERSION:
+        max_hatches, _, head = head.partition('.')
+    if not head or not egg_id or max_hatches == '':
+        return None
+    try:
+        if max_hatches is not None:
+            max_hatches = int(max_hatches, 36)
+        return data[1] == KIND_MULTI, int(head, 36), egg_id, max_hatches
+    except ValueError:
+        return None
+
+
+class EggIdSequence:
+    """Верхняя граница выданных номеров яиц в файле (у владельца данных)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.next_id = 1
+
+        # Метрики
+        self.reserved_blocks = 0
+
+    def load(self, has_data=False):
+        """Читает границу из файла
+
+        Если файла нет, а данные уже есть (файл потерян), нумерация начинается
+        с текущего unix времени в секундах: столько яиц раньше выдано быть не
+        могло, поэтому номера не повторятся.
+        """
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.next_id = json.load(f)['next_id']
+            except Exception as e:
+                logger.error(f"Error loading egg id sequence: {e}")
+                raise
+        elif has_data:
+            self.next_id = int(time.time())
+            logger.warning(f"Egg id sequence file {self.path} not found, starting at {self.next_id}")
+        logger.info(f"Egg id sequence starts at {self.next_id}")
+
+    def reserve(self, count):
+        """Выдает блок номеров [start, start + count) и сразу сохраняет новую границу"""
+        start = self.next_id
+        self.next_id += count
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'next_id': self.next_id}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.reserved_blocks += 1
+        return start
+
+    def stats(self):
+        return {
+            'next_id': self.next_id,
+            'reserved_blocks': self.reserved_blocks
+        }
+
+
+class EggIdAllocator:
+    """Раздает номера яиц из блока; reserve(count) - корутина, выдающая новый блок"""
+
+    def __init__(self, reserve, block_size=1000):
+        self.reserve = reserve
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+        # Метрики
+        self.allocated = 0
+        self.blocks = 0
+
+    async def allocate(self):
+        """Следующий номер яйца в base36"""
+        if self._next >= self._end:
+            async with self._lock:
+                if self._next >= self._end:
+                    start = await self.reserve(self.block_size)
+                    self._next, self._end = start, start + self.block_size
+                    self.blocks += 1
+        number = self._next
+        self._next += 1
+        self.allocated += 1
+        return to_base36(number)
+
+    def stats(self):
+        return {
+            'allocated': self.allocated,
+            'blocks': self.blocks,
+            'left_in_block': self._end - self._next,
+            'block_size': self.block_size
+        }
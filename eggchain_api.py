@@ -1,26 +1,41 @@
 """
 API endpoints для Eggchain Explorer
-Работает с JSON файлом bot_data.json
+Работает через хранилище бота (storage.py), а без бота - со снимком на диске
 """
 
 from aiohttp import web
-import json
 import os
+import time
 from datetime import datetime
+from archive import EggArchive
+from storage import COLLECTIONS, InMemoryStorage, serialize_state
+from snapshots import SegmentedSnapshot
+from json_stream import load_sections
 
 # Глобальная переменная для доступа к боту (будет установлена из bot.py)
 bot_instance = None
 
+# Хранилище данных бота (будет установлено из bot.py)
+storage = None
+
 def set_bot_instance(bot):
     """Устанавливает экземпляр бота для получения информации о пользователях"""
     global bot_instance
     bot_instance = bot
 
-async def get_user_info(user_id):
-    """Получает информацию о пользователе из Telegram"""
-    if not bot_instance:
-        return None, None, None
-    
+def set_storage(backend):
+    """Устанавливает хранилище бота, через которое ищутся яйца"""
+    global storage
+    storage = backend
+
+# Кэш профилей пользователей из Telegram: {user_id: (expires_at, (username, avatar_file_id, avatar_url))}
+# Один запрос Explorer показывает десятки пользователей, и на каждого уходило три вызова Bot API
+USER_INFO_TTL = float(os.environ.get('USER_INFO_TTL', '600'))
+USER_INFO_CACHE_SIZE = 10000
+user_info_cache = {}
+
+async def fetch_user_info(user_id):
+    """Запрашивает информацию о пользователе у Telegram (None при ошибке)"""
     try:
         user = await bot_instance.get_chat(user_id)
         username = user.username if hasattr(user, 'username') and user.username else None
@@ -42,7 +57,28 @@ async def get_user_info(user_id):
         
         return username, avatar_file_id, avatar_url
     except Exception as e:
+        return None
+
+async def get_user_info(user_id):
+    """Получает информацию о пользователе из Telegram (с кэшем на USER_INFO_TTL секунд)"""
+    if not bot_instance:
         return None, None, None
+    
+    now = time.monotonic()
+    cached = user_info_cache.get(user_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
+    info = await fetch_user_info(user_id)
+    if info is None:
+        # Ошибку не кэшируем - в следующий раз спросим снова
+        return None, None, None
+    user_info_cache.pop(user_id, None)
+    user_info_cache[user_id] = (now + USER_INFO_TTL, info)
+    if len(user_info_cache) > USER_INFO_CACHE_SIZE:
+        # Словарь хранит порядок вставки - удаляем самую старую запись
+        del user_info_cache[next(iter(user_info_cache))]
+    return info
 
 # Путь к файлу данных (должен совпадать с bot.py)
 # Используем ту же логику, что и в bot.py
@@ -58,16 +94,42 @@ else:
         # Fallback на рабочую директорию
         DATA_FILE = os.path.join(os.getcwd(), "bot_data.json")
 
+# Сегментированный снимок бота лежит рядом с файлом данных
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR') or os.path.join(os.path.dirname(DATA_FILE), "bot_data.snapshot")
+# Архив холодных яиц бота (вылупленные и старые яйца)
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or os.path.join(os.path.dirname(DATA_FILE), "bot_data.archive")
+
+# Архив открывается один раз и только для чтения
+archive = None
+
 def load_data():
-    """Загружает данные из JSON файла"""
+    """Загружает данные из сегментированного снимка или из JSON файла"""
+    snapshot = SegmentedSnapshot(SNAPSHOT_DIR, COLLECTIONS, format=os.environ.get('SNAPSHOT_FORMAT', 'binary').lower())
+    if snapshot.exists():
+        # Бот может заменить сегменты прямо во время чтения - тогда читаем заново
+        for attempt in range(3):
+            try:
+                state, journal_seq = snapshot.load(remove_orphans=False)
+                return serialize_state(state)
+            except Exception as e:
+                continue
+        return {}
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return load_sections(DATA_FILE)
         except Exception as e:
             return {}
     return {}
 
+def get_storage():
+    """Возвращает хранилище бота или, если бот не подключен, снимок из файла"""
+    global archive
+    if storage is not None:
+        return storage
+    if archive is None:
+        archive = EggArchive.open_existing(ARCHIVE_DIR)
+    return InMemoryStorage(load_data(), archive=archive)
+
 def add_cors_headers(response):
     """Добавляет CORS заголовки к ответу"""
     response.headers['Access-Control-Allow-Origin'] = '*'
@@ -93,32 +155,26 @@ async def get_egg_by_id(request):
         return add_cors_headers(response)
     
     try:
-        data = load_data()
-        
-        # Получаем детальную информацию о яйцах
-        eggs_detail = data.get('eggs_detail', {})  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched}}
-        hatched_eggs = set(data.get('hatched_eggs', []))
+        data_storage = get_storage()
         
         # Ищем яйцо в eggs_detail
         egg_info = None
         egg_key = None
         
         # Сначала пробуем найти по полному ключу (sender_id_egg_id)
-        if egg_id_param in eggs_detail:
+        egg_info = data_storage.get_egg_detail(egg_id_param)
+        if egg_info is not None:
             egg_key = egg_id_param
-            egg_info = eggs_detail[egg_key]
         else:
             # Ищем по частичному совпадению (только egg_id)
-            for key, info in eggs_detail.items():
-                if info.get('egg_id') == egg_id_param:
-                    egg_key = key
-                    egg_info = info
-                    break
+            egg_key = data_storage.find_egg_key(egg_id_param)
+            if egg_key is not None:
+                egg_info = data_storage.get_egg_detail(egg_key)
         
         # Если не нашли в детальной информации, пробуем восстановить из hatched_eggs
         if not egg_info:
             # Ищем в hatched_eggs по формату sender_id_egg_id
-            if egg_id_param in hatched_eggs:
+            if data_storage.is_hatched(egg_id_param):
                 parts = egg_id_param.split('_', 1)
                 if len(parts) == 2:
                     sender_id = int(parts[0])
@@ -133,21 +189,20 @@ async def get_egg_by_id(request):
                     egg_key = egg_id_param
             else:
                 # Пробуем найти по egg_id в hatched_eggs
-                for egg_key_candidate in hatched_eggs:
-                    if egg_key_candidate.endswith(f'_{egg_id_param}'):
-                        parts = egg_key_candidate.split('_', 1)
-                        if len(parts) == 2:
-                            sender_id = int(parts[0])
-                            egg_id = parts[1]
-                            egg_info = {
-                                'sender_id': sender_id,
-                                'egg_id': egg_id,
-                                'hatched_by': None,
-                                'timestamp_sent': None,
-                                'timestamp_hatched': None
-                            }
-                            egg_key = egg_key_candidate
-                            break
+                egg_key_candidate = data_storage.find_hatched_key(egg_id_param)
+                if egg_key_candidate:
+                    parts = egg_key_candidate.split('_', 1)
+                    if len(parts) == 2:
+                        sender_id = int(parts[0])
+                        egg_id = parts[1]
+                        egg_info = {
+                            'sender_id': sender_id,
+                            'egg_id': egg_id,
+                            'hatched_by': None,
+                            'timestamp_sent': None,
+                            'timestamp_hatched': None
+                        }
+                        egg_key = egg_key_candidate
         
         if not egg_info:
             response = web.json_response({'error': 'Egg not found'}, status=404)
@@ -164,9 +219,8 @@ async def get_egg_by_id(request):
         hatched_by_list = egg_info.get('hatched_by_list', [])
         
         # Для multi eggs проверяем multi_eggs
-        multi_eggs = data.get('multi_eggs', {})
-        if is_multi and egg_key in multi_eggs:
-            multi_egg_data = multi_eggs[egg_key]
+        multi_egg_data = data_storage.get_multi_egg(egg_key) if is_multi else None
+        if multi_egg_data is not None:
             hatched_by_list = multi_egg_data.get('hatched_by_list', [])
             hatched_count = multi_egg_data.get('hatched_count', 0)
         
@@ -175,7 +229,7 @@ async def get_egg_by_id(request):
         if is_multi:
             is_hatched = hatched_count > 0
         else:
-            is_hatched = egg_key in hatched_eggs if egg_key else False
+            is_hatched = data_storage.is_hatched(egg_key) if egg_key else False
         
         # Если вылуплено, но hatched_by не указан, пытаемся найти из других источников
         if is_hatched and not hatched_by and not is_multi:
@@ -246,27 +300,20 @@ async def get_user_eggs(request):
         return add_cors_headers(response)
     
     try:
-        data = load_data()
-        
-        # Получаем детальную информацию о яйцах
-        eggs_detail = data.get('eggs_detail', {})
-        hatched_eggs = set(data.get('hatched_eggs', []))
-        
-        # Получаем информацию о multi eggs
-        multi_eggs = data.get('multi_eggs', {})
+        data_storage = get_storage()
         
         # Находим все яйца, отправленные этим пользователем
         user_eggs = []
-        for egg_key, egg_info in eggs_detail.items():
+        for egg_key, egg_info in data_storage.eggs_sent_by(user_id):
             if egg_info.get('sender_id') == user_id:
                 egg_id = egg_info.get('egg_id', egg_key.split('_', 1)[1] if '_' in egg_key else egg_key)
                 is_multi = egg_info.get('is_multi', False)
                 hatched_by = egg_info.get('hatched_by')
                 
                 # Для multi eggs проверяем hatched_count
+                multi_egg_data = data_storage.get_multi_egg(egg_key) if is_multi else None
                 if is_multi:
-                    if egg_key in multi_eggs:
-                        multi_egg_data = multi_eggs[egg_key]
+                    if multi_egg_data is not None:
                         hatched_count = multi_egg_data.get('hatched_count', 0)
                         is_hatched = hatched_count > 0
                         # Для multi eggs hatched_by может быть None, но есть hatched_by_list
@@ -277,7 +324,7 @@ async def get_user_eggs(request):
                     else:
                         is_hatched = False
                 else:
-                    is_hatched = egg_key in hatched_eggs
+                    is_hatched = data_storage.is_hatched(egg_key)
                 
                 # Получаем информацию о том, кто вылупил
                 hatched_by_username, hatched_by_avatar_file, hatched_by_avatar_url = await get_user_info(hatched_by) if hatched_by else (None, None, None)
@@ -293,12 +340,12 @@ async def get_user_eggs(request):
                     'timestamp_hatched': egg_info.get('timestamp_hatched'),
                     'status': 'hatched' if is_hatched else 'pending',
                     'is_multi': is_multi,
-                    'hatched_count': multi_eggs.get(egg_key, {}).get('hatched_count', 0) if is_multi else None,
+                    'hatched_count': (multi_egg_data or {}).get('hatched_count', 0) if is_multi else None,
                     'max_hatches': egg_info.get('max_hatches', 1) if is_multi else None
                 })
         
         # Также проверяем hatched_eggs для яиц, которых нет в eggs_detail
-        for egg_key in hatched_eggs:
+        for egg_key in data_storage.hatched_keys_of_sender(user_id):
             if egg_key.startswith(f'{user_id}_'):
                 # Проверяем, нет ли уже этого яйца в списке
                 egg_id = egg_key.split('_', 1)[1] if '_' in egg_key else egg_key
@@ -351,19 +398,10 @@ async def get_user_by_username(request):
         # Можно попробовать через get_chat, но это работает только если бот знает пользователя
         
         # Альтернативный подход: ищем в eggs_detail всех пользователей с таким username
-        data = load_data()
-        eggs_detail = data.get('eggs_detail', {})
-        hatched_eggs = set(data.get('hatched_eggs', []))
+        data_storage = get_storage()
         
         # Собираем всех уникальных user_id из яиц
-        user_ids_found = set()
-        for egg_info in eggs_detail.values():
-            sender_id = egg_info.get('sender_id')
-            hatched_by = egg_info.get('hatched_by')
-            if sender_id:
-                user_ids_found.add(sender_id)
-            if hatched_by:
-                user_ids_found.add(hatched_by)
+        user_ids_found = data_storage.egg_user_ids()
         
         # Проверяем каждого пользователя на совпадение username
         target_user_id = None
@@ -389,36 +427,35 @@ async def get_user_by_username(request):
         user_eggs_sent = []
         user_eggs_hatched = []
         
-        for egg_key, egg_info in eggs_detail.items():
-            sender_id = egg_info.get('sender_id')
+        for egg_key, egg_info in data_storage.eggs_sent_by(target_user_id):
             hatched_by = egg_info.get('hatched_by')
             egg_id = egg_info.get('egg_id', egg_key.split('_', 1)[1] if '_' in egg_key else egg_key)
-            is_hatched = egg_key in hatched_eggs
-            
-            if sender_id == target_user_id:
-                hatched_by_username, _, hatched_by_avatar = await get_user_info(hatched_by) if hatched_by else (None, None, None)
-                user_eggs_sent.append({
-                    'egg_id': egg_id,
-                    'sender_id': target_user_id,
-                    'hatched_by': hatched_by,
-                    'hatched_by_username': hatched_by_username,
-                    'hatched_by_avatar': hatched_by_avatar,
-                    'timestamp_sent': egg_info.get('timestamp_sent'),
-                    'timestamp_hatched': egg_info.get('timestamp_hatched'),
-                    'status': 'hatched' if is_hatched else 'pending'
-                })
-            
-            if hatched_by == target_user_id:
-                sender_username, _, sender_avatar = await get_user_info(sender_id) if sender_id else (None, None, None)
-                user_eggs_hatched.append({
-                    'egg_id': egg_id,
-                    'sender_id': sender_id,
-                    'sender_username': sender_username,
-                    'sender_avatar': sender_avatar,
-                    'timestamp_sent': egg_info.get('timestamp_sent'),
-                    'timestamp_hatched': egg_info.get('timestamp_hatched'),
-                    'status': 'hatched'
-                })
+            is_hatched = data_storage.is_hatched(egg_key)
+            hatched_by_username, _, hatched_by_avatar = await get_user_info(hatched_by) if hatched_by else (None, None, None)
+            user_eggs_sent.append({
+                'egg_id': egg_id,
+                'sender_id': target_user_id,
+                'hatched_by': hatched_by,
+                'hatched_by_username': hatched_by_username,
+                'hatched_by_avatar': hatched_by_avatar,
+                'timestamp_sent': egg_info.get('timestamp_sent'),
+                'timestamp_hatched': egg_info.get('timestamp_hatched'),
+                'status': 'hatched' if is_hatched else 'pending'
+            })
+        
+        for egg_key, egg_info in data_storage.eggs_hatched_by(target_user_id):
+            sender_id = egg_info.get('sender_id')
+            egg_id = egg_info.get('egg_id', egg_key.split('_', 1)[1] if '_' in egg_key else egg_key)
+            sender_username, _, sender_avatar = await get_user_info(sender_id) if sender_id else (None, None, None)
+            user_eggs_hatched.append({
+                'egg_id': egg_id,
+                'sender_id': sender_id,
+                'sender_username': sender_username,
+                'sender_avatar': sender_avatar,
+                'timestamp_sent': egg_info.get('timestamp_sent'),
+                'timestamp_hatched': egg_info.get('timestamp_hatched'),
+                'status': 'hatched'
+            })
         
         # Сортируем по дате
         user_eggs_sent.sort(key=lambda x: x.get('timestamp_sent') or '', reverse=True)
@@ -0,0 +1,252 @@
+"""
+Фоновая очередь побочных действий с приоритетами
+
+Нажатие на яйцо должно отвечать сразу после изменения данных. Личные
+сообщения, поздравления с заданиями и редактирование сообщения с яйцом -
+побочные действия: пользователь не ждет их в ответе на нажатие. Обработчик
+ставит их в очередь и сразу освобождается, а несколько фоновых задач
+выполняют их по приоритету (меньшее число - раньше), в порядке постановки
+внутри одного приоритета.
+
+Упавшее задание повторяется до max_attempts раз с растущей паузой, если
+should_retry(exc) разрешает повтор. Пауза берется из retry_after ошибки,
+если Telegram ее сообщил.
+
+DebouncedJobs склеивает частые задания с одним ключом (например, правки
+одного сообщения): за окно delay выполняется одно задание с последними
+аргументами, а финальное задание ставится сразу.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundJobs:
+    """Очередь фоновых заданий с приоритетами, повторами и метриками"""
+
+    def __init__(self, workers=4, max_size=10000, max_attempts=3, retry_delay=1.0, should_retry=None):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.should_retry = should_retry
+        # (priority, seq, job): seq сохраняет порядок внутри приоритета
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks = []
+        # Задания, ожидающие повтора (еще не вернулись в очередь)
+        self._delayed = 0
+
+        # Метрики
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.total_run_ms = 0.0
+        self.max_run_ms = 0.0
+
+    def submit(self, priority, name, func, *args, **kwargs):
+        """Ставит задание func(*args, **kwargs) в очередь; False, если очередь переполнена"""
+        if self._queue.qsize() >= self.max_size:
+            self.dropped += 1
+            logger.warning(f"Background queue is full ({self.max_size}), dropping job {name}")
+            return False
+        self.submitted += 1
+        self._put(priority, [name, func, args, kwargs, 1, time.perf_counter()])
+        return True
+
+    def _put(self, priority, job):
+        self._queue.put_nowait((priority, next(self._seq), job))
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _retry_later(self, priority, job):
+        self._delayed -= 1
+        job[5] = time.perf_counter()
+        self._put(priority, job)
+
+    def _schedule_retry(self, priority, job, error):
+        delay = getattr(error, 'retry_after', None)
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+        if not delay:
+            delay = self.retry_delay * (2 ** (job[4] - 1))
+        job[4] += 1
+        self.retried += 1
+        self._delayed += 1
+        asyncio.get_running_loop().call_later(delay, self._retry_later, priority, job)
+
+    async def _run(self):
+        while True:
+            priority, _, job = await self._queue.get()
+            name, func, args, kwargs, attempt, enqueued_at = job
+            started = time.perf_counter()
+            wait_ms = (started - enqueued_at) * 1000
+            self.total_wait_ms += wait_ms
+            if wait_ms > self.max_wait_ms:
+                self.max_wait_ms = wait_ms
+            try:
+                await func(*args, **kwargs)
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retry = attempt < self.max_attempts and (self.should_retry is None or self.should_retry(e))
+                if retry:
+                    logger.warning(f"Background job {name} failed (attempt {attempt}), retrying: {e}")
+                    self._schedule_retry(priority, job, e)
+                else:
+                    self.failed += 1
+                    logger.error(f"Background job {name} failed after {attempt} attempt(s): {e}")
+            finally:
+                run_ms = (time.perf_counter() - started) * 1000
+                self.total_run_ms += run_ms
+                if run_ms > self.max_run_ms:
+                    self.max_run_ms = run_ms
+                self._queue.task_done()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10.0):
+        """Дожидается выполнения поставленных заданий (не дольше timeout) и останавливает очередь"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Background queue not drained in {timeout}s, {self._queue.qsize()} job(s) dropped")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        started = self.completed + self.failed + self.retried
+        return {
+            'depth': self._queue.qsize(),
+            'max_depth': self.max_depth,
+            'delayed_retries': self._delayed,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'avg_wait_ms': round(self.total_wait_ms / started, 3) if started else None,
+            'max_wait_ms': round(self.max_wait_ms, 3),
+            'avg_run_ms': round(self.total_run_ms / started, 3) if started else None,
+            'max_run_ms': round(self.max_run_ms, 3),
+            'workers': self.workers
+        }
+
+
+class DebouncedJobs:
+    """Склеивает задания с одним ключом в одно с последними аргументами
+
+    Промежуточное задание ждет delay секунд: если за это время пришли новые,
+    выполняется только последнее. Финальное (final=True) ставится в очередь
+    сразу, как только закончится уже запущенное задание этого ключа, поэтому
+    устаревшая правка не может перезаписать финальную. Промежуточные задания не
+    повторяются при ошибке - следующее все равно принесет свежие данные.
+    """
+
+    def __init__(self, jobs, delay=1.0):
+        self.jobs = jobs
+        self.delay = delay
+        # {key: (priority, name, func, args, kwargs, final)} последнее ожидающее задание
+        self._latest = {}
+        self._timers = {}
+        self._running = set()
+
+        # Метрики
+        self.submitted = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def submit(self, key, priority, name, func, *args, final=False, **kwargs):
+        self.submitted += 1
+        pending = self._latest.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            if pending[5] and not final:
+                # Финальное задание уже ждет - промежуточное опоздало
+                return
+        self._latest[key] = (priority, name, func, args, kwargs, final)
+        if key in self._running:
+            # Запустится после текущего задания этого ключа
+            return
+        if final:
+            timer = self._timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.delay, self._flush, key)
+
+    def _flush(self, key):
+        self._timers.pop(key, None)
+        job = self._latest.pop(key, None)
+        if job is None:
+            return
+        priority, name, func, args, kwargs, final = job
+        self._running.add(key)
+        self.flushed += 1
+        if not self.jobs.submit(priority, name, self._run, key, final, func, args, kwargs):
+            self._done(key)
+
+    async def _run(self, key, final, func, args, kwargs):
+        self._running.add(key)
+        try:
+            await func(*args, **kwargs)
+        except Exception as e:
+            if final:
+                # Финальное задание повторяет BackgroundJobs
+                raise
+            self.failed += 1
+            logger.warning(f"Debounced job for {key} failed: {e}")
+        finally:
+            self._done(key)
+
+    def _done(self, key):
+        self._running.discard(key)
+        job = self._latest.get(key)
+        if job is None:
+            return
+        if job[5]:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.delay, self._flush, key)
+
+    def flush_all(self):
+        """Ставит все ожидающие задания в очередь сразу (перед остановкой)"""
+        for key in list(self._latest):
+            if key in self._running:
+                continue
+            timer = self._timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            self._flush(key)
+
+    def stats(self):
+        return {
+            'waiting': len(self._latest),
+            'running': len(self._running),
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'delay_seconds': self.delay
+        }
@@ -0,0 +1,167 @@
+"""
+Журнал изменений (append-only) для данных бота
+
+Каждое изменение состояния записывается одной короткой строкой JSON в конец
+файла журнала. Полный снимок (bot_data.json) пишется редко - при компактизации,
+после чего журнал начинается заново. При старте загружается последний снимок
+и поверх него проигрывается хвост журнала.
+
+Формат записи: {"s": seq, "e": event, "c": [change, ...]}
+Виды изменений:
+    ["p", collection, key, value]  - записать значение по ключу
+    ["d", collection, key]         - удалить ключ
+    ["r", collection, value]       - заменить коллекцию целиком
+Значения абсолютные (а не приращения), поэтому повторное проигрывание записи
+безопасно.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventJournal:
+    """Журнал изменений с ротацией для компактизации в снимок"""
+
+    def __init__(self, path, fsync_interval=1.0):
+        self.path = path
+        self.rotated_path = path + '.1'
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._last_fsync = time.monotonic()
+        self._unsynced = 0
+
+        self.seq = 0
+        self.entries_since_compaction = 0
+        self.appended_total = 0
+        self.bytes_since_compaction = 0
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, event, changes):
+        """Дописывает запись в журнал и возвращает ее номер"""
+        with self._lock:
+            self.seq += 1
+            line = json.dumps(
+                {'s': self.seq, 'e': event, 'c': changes},
+                ensure_ascii=False,
+                separators=(',', ':')
+            ) + '\n'
+            self._open()
+            self._file.write(line)
+            # flush() передает данные ОС - при падении процесса запись не потеряется
+            self._file.flush()
+            self._unsynced += 1
+            self.entries_since_compaction += 1
+            self.appended_total += 1
+            self.bytes_since_compaction += len(line)
+
+            # fsync не чаще раза в fsync_interval: при сбое машины теряется только хвост
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                self._fsync_locked(now)
+            return self.seq
+
+    def _fsync_locked(self, now=None):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_fsync = now if now is not None else time.monotonic()
+
+    def sync(self):
+        """Принудительно сбрасывает журнал на диск"""
+        with self._lock:
+            self._fsync_locked()
+
+    def rotate(self):
+        """Начинает новый файл журнала перед записью снимка
+
+        Возвращает номер последней записи, которая гарантированно попадет в снимок.
+        Если предыдущая компактизация не завершилась, текущий журнал дописывается
+        к старому повернутому файлу, чтобы ни одна запись не потерялась.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._fsync_locked()
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                if os.path.exists(self.rotated_path):
+                    with open(self.path, 'r', encoding='utf-8') as src, \
+                            open(self.rotated_path, 'a', encoding='utf-8') as dst:
+                        for line in src:
+                            dst.write(line)
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, self.rotated_path)
+            self.entries_since_compaction = 0
+            self.bytes_since_compaction = 0
+            return self.seq
+
+    def discard_rotated(self):
+        """Удаляет повернутый журнал после успешной записи снимка"""
+        with self._lock:
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+
+    def replay(self, after_seq, apply_change):
+        """Проигрывает записи с номером больше after_seq
+
+        Возвращает количество проигранных записей. Оборванная последняя строка
+        (сбой во время записи) пропускается.
+        """
+        applied = 0
+        # Новые записи должны получать номера больше, чем уже вошедшие в снимок
+        if after_seq > self.seq:
+            self.seq = after_seq
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping broken journal line {line_no} in {path}")
+                        continue
+                    seq = entry.get('s', 0)
+                    if seq > self.seq:
+                        self.seq = seq
+                    if seq <= after_seq:
+                        continue
+                    for change in entry.get('c', []):
+                        apply_change(change)
+                    applied += 1
+        self.entries_since_compaction = applied
+        return applied
+
+    def close(self):
+        """Сбрасывает и закрывает файл журнала"""
+        with self._lock:
+            if self._file is not None:
+                self._fsync_locked()
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        """Возвращает метрики журнала"""
+        return {
+            'seq': self.seq,
+            'entries_since_compaction': self.entries_since_compaction,
+            'bytes_since_compaction': self.bytes_since_compaction,
+            'appended_total': self.appended_total,
+            'unsynced_entries': self._unsynced
+        }
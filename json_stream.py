@@ -0,0 +1,245 @@
+"""
+Потоковая загрузка большого bot_data.json
+
+json.load читает файл целиком в строку, строит из нее все словари, а затем
+бот еще раз копирует hatched_eggs в set - пик памяти при старте в разы больше
+рабочего. Здесь файл читается кусками, верхний объект разбирается по секциям,
+а записи больших секций по одной кладутся сразу в итоговые структуры.
+В памяти одновременно находится только текущий кусок текста.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+# Как часто (в записях) проверять, не пора ли написать прогресс в лог
+PROGRESS_EVERY = 50000
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Ключ записи объекта вместе с двоеточием
+ITEM_KEY = re.compile(r'[ \t\n\r]*"((?:[^"\\]|\\.)*)"[ \t\n\r]*:[ \t\n\r]*', re.S)
+# Разделитель после значения
+SEPARATOR = re.compile(r'[ \t\n\r]*([,}\]])')
+# Символы, которыми может продолжаться число (дробная часть, экспонента)
+NUMBER_TAIL = re.compile(r'[0-9.eE+\-]*')
+
+
+class JsonStreamReader:
+    """Читает JSON из файла кусками и разбирает значения по одному"""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self._file = f
+        self._chunk_size = chunk_size
+        # json.load делит одинаковые ключи между всеми словарями файла;
+        # при разборе по одному значению это делает object_pairs_hook
+        self._keys = {}
+        keys = self._keys
+        decoder = json.JSONDecoder(
+            object_pairs_hook=lambda pairs: {keys.setdefault(k, k): v for k, v in pairs}
+        )
+        self._scan_once = decoder.scan_once
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.bytes_read = 0
+
+    def _fill(self):
+        """Дочитывает следующий кусок, отбрасывая уже разобранную часть буфера"""
+        if self._eof:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self.bytes_read += len(chunk) if chunk.isascii() else len(chunk.encode('utf-8'))
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            buffer, pos = self._buffer, self._pos
+            if pos < len(buffer) and buffer[pos] in ' \t\n\r':
+                pos = WHITESPACE.match(buffer, pos).end()
+            self._pos = pos
+            if pos < len(buffer) or not self._fill():
+                return
+
+    def next_char(self):
+        """Возвращает следующий значимый символ и сдвигается за него"""
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of JSON file")
+        char = self._buffer[self._pos]
+        self._pos += 1
+        return char
+
+    def peek(self):
+        """Следующий значимый символ (без сдвига позиции)"""
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of JSON file")
+        return self._buffer[self._pos]
+
+    def expect(self, char):
+        found = self.next_char()
+        if found != char:
+            raise ValueError(f"Expected '{char}' at offset ~{self.bytes_read}, got '{found}'")
+
+    def read_value(self):
+        """Разбирает одно JSON значение целиком"""
+        self._skip_whitespace()
+        while True:
+            buffer, pos = self._buffer, self._pos
+            try:
+                value, end = self._scan_once(buffer, pos)
+            except (StopIteration, json.JSONDecodeError):
+                # Значение оборвано концом куска - дочитываем и пробуем снова
+                if self._fill():
+                    continue
+                raise ValueError(f"Invalid JSON value at offset ~{self.bytes_read}")
+            # Число в конце буфера может продолжаться в следующем куске: "-2" + ".5"
+            if NUMBER_TAIL.match(buffer, end).end() == len(buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def iter_items(self):
+        """Перебирает пары (ключ, значение) объекта, не собирая его целиком
+
+        Самый горячий цикл загрузки: ключ и разделители разбираются регулярными
+        выражениями, значение - C сканером json, без промежуточных вызовов.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        scan_once = self._scan_once
+        keys = self._keys
+        while True:
+            buffer, pos = self._buffer, self._pos
+            match = ITEM_KEY.match(buffer, pos)
+            separator = None
+            if match is not None:
+                try:
+                    value, end = scan_once(buffer, match.end())
+                    separator = SEPARATOR.match(buffer, end)
+                except (StopIteration, json.JSONDecodeError):
+                    pass
+            if separator is None:
+                # Запись оборвана концом куска - дочитываем и разбираем ее заново
+                if self._fill():
+                    continue
+                raise ValueError(f"Invalid JSON object entry at offset ~{self.bytes_read}")
+
+            key = match.group(1)
+            if '\\' in key:
+                key = json.loads(f'"{key}"')
+            yield keys.setdefault(key, key), value
+            self._pos = separator.end()
+            char = separator.group(1)
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f"Expected ',' or '}}' at offset ~{self.bytes_read}, got '{char}'")
+
+    def iter_keys(self):
+        """Перебирает ключи объекта; значение каждого ключа читает вызывающий код"""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            char = self.next_char()
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f"Expected ',' or '}}' at offset ~{self.bytes_read}, got '{char}'")
+
+    def iter_array(self):
+        """Перебирает элементы массива по одному"""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        scan_once = self._scan_once
+        while True:
+            self._skip_whitespace()
+            buffer, pos = self._buffer, self._pos
+            separator = None
+            try:
+                value, end = scan_once(buffer, pos)
+                separator = SEPARATOR.match(buffer, end)
+            except (StopIteration, json.JSONDecodeError):
+                pass
+            if separator is None:
+                if self._fill():
+                    continue
+                raise ValueError(f"Invalid JSON array item at offset ~{self.bytes_read}")
+
+            yield value
+            self._pos = separator.end()
+            char = separator.group(1)
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f"Expected ',' or ']' at offset ~{self.bytes_read}, got '{char}'")
+
+
+def load_sections(path, set_sections=(), chunk_size=CHUNK_SIZE):
+    """Потоково загружает объект верхнего уровня из JSON файла
+
+    Секции-объекты заполняются запись за записью, секции из set_sections
+    (массивы) собираются сразу в set. Пишет в лог прогресс и время по секциям.
+    """
+    total_size = os.path.getsize(path)
+    total_mb = total_size / (1 << 20)
+    started = time.perf_counter()
+    data = {}
+    next_report = [10]
+
+    def report_progress(reader):
+        percent = reader.bytes_read * 100 // total_size if total_size else 100
+        if percent >= next_report[0]:
+            logger.info(
+                f"Loading progress: {min(percent, 100)}% "
+                f"({reader.bytes_read / (1 << 20):.1f}/{total_mb:.1f} MB)"
+            )
+            next_report[0] = (percent // 10 + 1) * 10
+
+    with open(path, 'r', encoding='utf-8') as f:
+        reader = JsonStreamReader(f, chunk_size)
+        for section in reader.iter_keys():
+            section_started = time.perf_counter()
+            first = reader.peek()
+            if first == '{':
+                value = {}
+                for key, item in reader.iter_items():
+                    value[key] = item
+                    if len(value) % PROGRESS_EVERY == 0:
+                        report_progress(reader)
+            elif first == '[' and section in set_sections:
+                value = set()
+                for item in reader.iter_array():
+                    value.add(item)
+                    if len(value) % PROGRESS_EVERY == 0:
+                        report_progress(reader)
+            else:
+                value = reader.read_value()
+            data[section] = value
+
+            section_ms = (time.perf_counter() - section_started) * 1000
+            count = f"{len(value)} entries" if isinstance(value, (dict, list, set)) else "value"
+            logger.info(f"Loaded section {section}: {count} in {section_ms:.1f} ms")
+            report_progress(reader)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(f"Streamed {path} ({total_mb:.1f} MB) in {elapsed_ms:.1f} ms")
+    return data
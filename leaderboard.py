@@ -0,0 +1,195 @@
+"""
+Таблица лидеров по egg_points с запросами места за O(log n)
+
+Сортировать все egg_points на каждый запрос - O(n log n) на запрос. Вместо
+этого пользователи хранятся упорядоченными по (-points, user_id) в
+отсортированных блоках (как sortedcontainers.SortedList): вставка и удаление
+меняют один блок, а дерево Фенвика над размерами блоков дает число записей
+перед блоком за O(log n). Место пользователя и начало страницы находятся
+бинарным поиском по блокам и спуском по дереву, без прохода по всем.
+
+Таблица обновляется на каждом изменении счетчика поинтов (UserTable.watch),
+поэтому ее не нужно поддерживать отдельно в каждом месте, где начисляются
+поинты. Пользователи с 0 поинтов в таблицу не попадают.
+
+Место - "спортивное": у пользователей с равными поинтами одно место, а
+следующее место пропускает занятые (1, 2, 2, 4).
+"""
+
+import logging
+from bisect import bisect_left, insort
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """Упорядоченная таблица {user_id: points} с местом и страницами за O(log n)"""
+
+    def __init__(self, load=512):
+        self.load = load
+        self._points = {}
+        # Отсортированные блоки ключей (-points, user_id) и последний ключ каждого блока
+        self._blocks = []
+        self._maxes = []
+        # Дерево Фенвика над длинами блоков (индексация с 1)
+        self._tree = [0]
+
+        # Метрики
+        self.updates = 0
+        self.rebuilds = 0
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, user_id):
+        return user_id in self._points
+
+    def load_from(self, items):
+        """Строит таблицу целиком из пар (user_id, points)"""
+        self._points = {user_id: points for user_id, points in items if points and points > 0}
+        keys = sorted((-points, user_id) for user_id, points in self._points.items())
+        self._blocks = [keys[i:i + self.load] for i in range(0, len(keys), self.load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._rebuild_tree()
+        logger.info(f"Leaderboard built: {len(self._points)} users in {len(self._blocks)} blocks")
+
+    def set(self, user_id, points):
+        """Новое значение поинтов пользователя (None или 0 - убрать из таблицы)"""
+        old = self._points.get(user_id)
+        if old == points:
+            return
+        self.updates += 1
+        if old is not None:
+            self._remove((-old, user_id))
+            del self._points[user_id]
+        if points and points > 0:
+            self._points[user_id] = points
+            self._insert((-points, user_id))
+
+    def points(self, user_id):
+        return self._points.get(user_id, 0)
+
+    def rank(self, user_id):
+        """Место пользователя (с 1) или None, если у него нет поинтов"""
+        points = self._points.get(user_id)
+        if points is None:
+            return None
+        return self._count_before((-points,)) + 1
+
+    def page(self, offset=0, limit=50):
+        """Страница таблицы: [(rank, user_id, points)] начиная с позиции offset"""
+        result = []
+        if offset >= len(self._points) or limit <= 0:
+            return result
+        block_index, index = self._locate(offset)
+        rank = None
+        previous = None
+        position = offset
+        while block_index < len(self._blocks) and len(result) < limit:
+            block = self._blocks[block_index]
+            while index < len(block) and len(result) < limit:
+                score, user_id = block[index]
+                if score != previous:
+                    # Первая запись страницы или новые поинты: место = позиция, если
+                    # перед ней нет равных (иначе - место первого из равных)
+                    rank = position + 1 if previous is not None else self._count_before((score,)) + 1
+                    previous = score
+                result.append((rank, user_id, -score))
+                index += 1
+                position += 1
+            block_index += 1
+            index = 0
+        return result
+
+    # Отсортированные блоки
+
+    def _insert(self, key):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._blocks[i].append(key)
+            self._maxes[i] = key
+        else:
+            insort(self._blocks[i], key)
+        self._tree_add(i, 1)
+        block = self._blocks[i]
+        if len(block) > 2 * self.load:
+            # Делим переполненный блок пополам
+            self._blocks[i:i + 1] = [block[:self.load], block[self.load:]]
+            self._maxes[i:i + 1] = [block[self.load - 1], block[-1]]
+            self._rebuild_tree()
+
+    def _remove(self, key):
+        i = bisect_left(self._maxes, key)
+        block = self._blocks[i]
+        del block[bisect_left(block, key)]
+        if block:
+            self._maxes[i] = block[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+            self._rebuild_tree()
+
+    def _count_before(self, key):
+        """Сколько записей меньше key"""
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return len(self._points)
+        return self._prefix(i) + bisect_left(self._blocks[i], key)
+
+    # Дерево Фенвика над длинами блоков
+
+    def _rebuild_tree(self):
+        tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+        self.rebuilds += 1
+
+    def _tree_add(self, block_index, delta):
+        i = block_index + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, block_index):
+        """Сумма длин блоков [0, block_index)"""
+        total = 0
+        i = block_index
+        tree = self._tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, position):
+        """(номер блока, индекс в блоке) для позиции position спуском по дереву"""
+        tree = self._tree
+        block_index = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            nxt = block_index + step
+            if nxt < len(tree) and tree[nxt] <= position:
+                block_index = nxt
+                position -= tree[nxt]
+            step >>= 1
+        return block_index, position
+
+    def stats(self):
+        return {
+            'users': len(self._points),
+            'blocks': len(self._blocks),
+            'updates': self.updates,
+            'tree_rebuilds': self.rebuilds,
+            'top_points': -self._blocks[0][0][0] if self._blocks else 0
+        }
@@ -0,0 +1,242 @@
+"""
+Планировщик исходящих сообщений с ограничением скорости
+
+Telegram ограничивает бота примерно 30 сообщениями в секунду в целом и
+одним сообщением в секунду в один чат; при превышении Bot API отвечает 429
+(RetryAfter) с паузой, которую нужно выждать. Вирусный multi egg легко
+упирается в оба лимита: сотни вылуплений - сотни личных сообщений.
+
+Все личные сообщения бота идут через OutboundScheduler:
+- общий token bucket (rate сообщений в секунду, запас burst);
+- в один чат не чаще раза в chat_interval секунд, сообщения чата - по порядку;
+- RetryAfter ставит отправку на паузу на указанное время, а сообщение
+  возвращается в начало очереди своего чата;
+- одинаковые уведомления (тот же chat_id и coalesce_key), которые еще ждут
+  отправки, склеиваются в одно;
+- сообщения чатам, для которых skip(chat_id) истинно, не отправляются, а об
+  окончательной ошибке отправки сообщает on_undeliverable(chat_id, error).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundScheduler:
+    """Очередь исходящих сообщений: общий лимит, интервал на чат, RetryAfter"""
+
+    def __init__(self, rate=25.0, burst=25, chat_interval=1.0, max_pending=50000,
+                 max_attempts=3, retry_delay=1.0, should_retry=None, skip=None, on_undeliverable=None):
+        self.rate = rate
+        self.burst = burst
+        self.chat_interval = chat_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.should_retry = should_retry
+        self.skip = skip
+        self.on_undeliverable = on_undeliverable
+        self.bot = None
+
+        # {chat_id: deque([text, kwargs, coalesce_key, attempt, enqueued_at])}
+        self._chats = {}
+        # Куча (ready_at, seq, chat_id) чатов с ожидающими сообщениями
+        self._ready = []
+        self._seq = itertools.count()
+        # {chat_id: время, раньше которого в чат нельзя писать} для чатов без очереди
+        self._chat_free_at = {}
+        self._pending_keys = set()
+        self._pending = 0
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()
+
+        # Метрики
+        self.sent = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.coalesced = 0
+        self.retry_after = 0
+        self.retried = 0
+        self.skipped = 0
+        self.max_pending_seen = 0
+
+    def send(self, chat_id, text, coalesce_key=None, **kwargs):
+        """Ставит сообщение в очередь; False, если оно пропущено, склеено с ожидающим или очередь полна"""
+        if self.skip is not None and self.skip(chat_id):
+            self.skipped += 1
+            return False
+        if coalesce_key is not None and (chat_id, coalesce_key) in self._pending_keys:
+            self.coalesced += 1
+            return False
+        if self._pending >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Outbound queue is full ({self.max_pending}), dropping message to {chat_id}")
+            return False
+        if coalesce_key is not None:
+            self._pending_keys.add((chat_id, coalesce_key))
+
+        now = time.monotonic()
+        message = [text, kwargs, coalesce_key, 1, now]
+        self._pending += 1
+        if self._pending > self.max_pending_seen:
+            self.max_pending_seen = self._pending
+        queue = self._chats.get(chat_id)
+        if queue is not None:
+            # Чат уже в расписании - сообщение уйдет после предыдущих
+            queue.append(message)
+            self.delayed += 1
+            return True
+        ready_at = max(now, self._chat_free_at.pop(chat_id, 0.0))
+        if ready_at > now:
+            self.delayed += 1
+        self._chats[chat_id] = deque([message])
+        self._schedule(chat_id, ready_at)
+        return True
+
+    def _schedule(self, chat_id, ready_at):
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _take_token(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def _sleep(self, delay):
+        """Ждет delay секунд или нового сообщения"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            ready_at, _, chat_id = self._ready[0]
+            wait = max(ready_at, self._paused_until) - now
+            if wait > 0:
+                await self._sleep(wait)
+                continue
+            wait = self._take_token(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            heapq.heappop(self._ready)
+            queue = self._chats[chat_id]
+            message = queue.popleft()
+            if queue:
+                self._schedule(chat_id, now + self.chat_interval)
+            else:
+                del self._chats[chat_id]
+                self._chat_free_at[chat_id] = now + self.chat_interval
+                if len(self._chat_free_at) > 10000:
+                    self._chat_free_at = {
+                        chat: free_at for chat, free_at in self._chat_free_at.items() if free_at > now
+                    }
+            task = asyncio.create_task(self._deliver(chat_id, message))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _requeue(self, chat_id, message, ready_at):
+        queue = self._chats.get(chat_id)
+        if queue is not None:
+            queue.appendleft(message)
+            return
+        self._chat_free_at.pop(chat_id, None)
+        self._chats[chat_id] = deque([message])
+        self._schedule(chat_id, ready_at)
+
+    def _finish(self, chat_id, message):
+        self._pending -= 1
+        if message[2] is not None:
+            self._pending_keys.discard((chat_id, message[2]))
+
+    async def _deliver(self, chat_id, message):
+        text, kwargs, coalesce_key, attempt, enqueued_at = message
+        if self.skip is not None and self.skip(chat_id):
+            # Чат стал недоступен, пока сообщение ждало в очереди
+            self.skipped += 1
+            self._finish(chat_id, message)
+            return
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            self.sent += 1
+            self._finish(chat_id, message)
+        except RetryAfter as e:
+            delay = e.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            # Лимит бота превышен: пауза для всех отправок, сообщение - в начало очереди чата
+            self.retry_after += 1
+            self.delayed += 1
+            resume_at = time.monotonic() + delay
+            self._paused_until = max(self._paused_until, resume_at)
+            logger.warning(f"Telegram flood limit hit, pausing outbound messages for {delay}s")
+            self._requeue(chat_id, message, resume_at)
+        except Exception as e:
+            if attempt < self.max_attempts and (self.should_retry is None or self.should_retry(e)):
+                self.retried += 1
+                message[3] = attempt + 1
+                self._requeue(chat_id, message, time.monotonic() + self.retry_delay * (2 ** (attempt - 1)))
+                return
+            self.dropped += 1
+            self._finish(chat_id, message)
+            logger.error(f"Failed to send message to {chat_id}: {e}")
+            if self.on_undeliverable is not None:
+                self.on_undeliverable(chat_id, e)
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает планировщик"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logger.warning(f"Outbound queue not drained in {timeout}s, {self._pending} message(s) dropped")
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self):
+        return {
+            'pending': self._pending,
+            'max_pending': self.max_pending_seen,
+            'chats_waiting': len(self._chats),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'delayed': self.delayed,
+            'coalesced': self.coalesced,
+            'retry_after': self.retry_after,
+            'retried': self.retried,
+            'skipped': self.skipped,
+            'paused_seconds_left': round(max(0.0, self._paused_until - time.monotonic()), 3),
+            'rate_per_second': self.rate,
+            'chat_interval_seconds': self.chat_interval
+        }
@@ -0,0 +1,247 @@
+"""
+Отложенное сохранение (write-behind) состояния бота
+
+Обработчики больше не пишут файл данных сами: они только помечают состояние
+как измененное через mark_dirty(). Фоновая задача склеивает все изменения,
+накопившиеся за интервал, в один снимок и сохраняет его одним вызовом.
+
+Сохранение идет в две фазы: в цикле событий быстро снимается согласованная
+копия измененных данных (capture), а сериализация и fsync выполняются в
+отдельном потоке (write), не задерживая обработку апдейтов и запросы API.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseTimer:
+    """Метрики длительности одной фазы сохранения"""
+
+    def __init__(self):
+        self.count = 0
+        self.last_ms = None
+        self.max_ms = 0.0
+        self.total_ms = 0.0
+
+    def add(self, elapsed_ms):
+        self.count += 1
+        self.last_ms = elapsed_ms
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+
+    def stats(self):
+        return {
+            'last_ms': round(self.last_ms, 3) if self.last_ms is not None else None,
+            'avg_ms': round(self.total_ms / self.count, 3) if self.count else None,
+            'max_ms': round(self.max_ms, 3)
+        }
+
+
+class WriteBehindSaver:
+    """Фоновый сохранятель: копит изменения и сбрасывает их одним снимком
+
+    capture_func - быстрая синхронная функция, которая снимает копию измененных
+    данных и возвращает функцию записи (или None, если писать нечего).
+    Функция записи выполняется в отдельном потоке.
+    Сброс происходит раз в interval секунд или сразу, как только накопилось
+    max_dirty изменений.
+    """
+
+    def __init__(self, capture_func, interval=2.0, max_dirty=100):
+        self.capture_func = capture_func
+        self.interval = interval
+        self.max_dirty = max_dirty
+
+        # Счетчик меняется и в цикле событий, и в синхронном flush() при остановке
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self._first_dirty_at = None
+
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        # Один поток: записи снимков идут строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot-writer')
+
+        # Метрики
+        self.flush_count = 0
+        self.flushed_changes = 0
+        self.error_count = 0
+        self.last_flush_ms = None
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.last_flush_at = None
+        self.max_queue_depth = 0
+        self.capture_timer = PhaseTimer()
+        self.write_timer = PhaseTimer()
+
+    def mark_dirty(self, count=1):
+        """Помечает состояние как измененное (сохранение произойдет в фоне)"""
+        with self._lock:
+            if self._dirty == 0:
+                self._first_dirty_at = time.monotonic()
+            self._dirty += count
+            if self._dirty > self.max_queue_depth:
+                self.max_queue_depth = self._dirty
+            urgent = self._dirty >= self.max_dirty
+
+        if urgent:
+            self._wake()
+
+    def _wake(self):
+        """Будит фоновую задачу (безопасно из любого потока)"""
+        if self._loop is None or self._wakeup is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            # Цикл событий уже закрыт - финальный сброс сделает stop()
+            pass
+
+    @property
+    def pending(self):
+        """Количество изменений, еще не записанных на диск"""
+        return self._dirty
+
+    def _take_pending(self):
+        with self._lock:
+            pending = self._dirty
+            first_dirty_at = self._first_dirty_at
+            self._dirty = 0
+            self._first_dirty_at = None
+        return pending, first_dirty_at
+
+    def _requeue(self, pending, first_dirty_at, error):
+        """Не теряем изменения: вернем их в очередь, чтобы повторить позже"""
+        self.error_count += 1
+        with self._lock:
+            self._dirty += pending
+            if self._first_dirty_at is None:
+                self._first_dirty_at = first_dirty_at
+        logger.error(f"Write-behind flush failed ({pending} pending changes): {error}", exc_info=True)
+
+    def _capture(self):
+        """Фаза 1: снимает копию изменений, возвращает (write, capture_ms)"""
+        started = time.perf_counter()
+        write = self.capture_func()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.capture_timer.add(elapsed_ms)
+        return write, elapsed_ms
+
+    def _write(self, write):
+        """Фаза 2: сериализация и fsync, возвращает write_ms"""
+        started = time.perf_counter()
+        if write is not None:
+            write()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.write_timer.add(elapsed_ms)
+        return elapsed_ms
+
+    def _record_flush(self, pending, capture_ms, write_ms):
+        elapsed_ms = capture_ms + write_ms
+        self.flush_count += 1
+        self.flushed_changes += pending
+        self.last_flush_ms = elapsed_ms
+        self.total_flush_ms += elapsed_ms
+        if elapsed_ms > self.max_flush_ms:
+            self.max_flush_ms = elapsed_ms
+        self.last_flush_at = time.time()
+        logger.info(
+            f"Write-behind flush: {pending} changes coalesced into one snapshot "
+            f"(capture {capture_ms:.1f} ms, write {write_ms:.1f} ms)"
+        )
+
+    def flush(self):
+        """Синхронно записывает снимок, если есть несохраненные изменения"""
+        pending, first_dirty_at = self._take_pending()
+        if pending == 0:
+            return False
+        try:
+            write, capture_ms = self._capture()
+            write_ms = self._write(write)
+        except Exception as e:
+            self._requeue(pending, first_dirty_at, e)
+            return False
+        self._record_flush(pending, capture_ms, write_ms)
+        return True
+
+    async def flush_async(self):
+        """Снимает копию в цикле событий, а запись выполняет в отдельном потоке"""
+        pending, first_dirty_at = self._take_pending()
+        if pending == 0:
+            return False
+        try:
+            write, capture_ms = self._capture()
+            write_ms = await asyncio.get_running_loop().run_in_executor(self._executor, self._write, write)
+        except Exception as e:
+            self._requeue(pending, first_dirty_at, e)
+            return False
+        self._record_flush(pending, capture_ms, write_ms)
+        return True
+
+    async def _run(self):
+        """Основной цикл фоновой задачи"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            await self.flush_async()
+
+    def start(self):
+        """Запускает фоновую задачу в текущем цикле событий"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = self._loop.create_task(self._run())
+        logger.info(f"Write-behind saver started (interval={self.interval}s, max_dirty={self.max_dirty})")
+        # Изменения могли накопиться до запуска
+        if self._dirty >= self.max_dirty:
+            self._wakeup.set()
+
+    async def stop(self):
+        """Останавливает фоновую задачу и сбрасывает все оставшиеся изменения"""
+        if self._task is not None:
+            # Не прерываем запись на середине: даем текущему сбросу завершиться
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        self.flush()
+        self._executor.shutdown(wait=True)
+        logger.info("Write-behind saver stopped, all pending changes flushed")
+
+    def stats(self):
+        """Возвращает метрики для админ-панели"""
+        with self._lock:
+            pending = self._dirty
+            first_dirty_at = self._first_dirty_at
+        oldest_pending_s = time.monotonic() - first_dirty_at if first_dirty_at else 0.0
+        return {
+            'pending_changes': pending,
+            'oldest_pending_seconds': round(oldest_pending_s, 3),
+            'max_queue_depth': self.max_queue_depth,
+            'flush_count': self.flush_count,
+            'flushed_changes': self.flushed_changes,
+            'errors': self.error_count,
+            'last_flush_ms': round(self.last_flush_ms, 3) if self.last_flush_ms is not None else None,
+            'avg_flush_ms': round(self.total_flush_ms / self.flush_count, 3) if self.flush_count else None,
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'capture': self.capture_timer.stats(),
+            'write': self.write_timer.stats(),
+            'last_flush_at': self.last_flush_at,
+            'interval_seconds': self.interval,
+            'max_dirty': self.max_dirty
+        }
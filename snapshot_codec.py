@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Компактный бинарный формат снимка данных бота
+
+Структура файла:
+    заголовок (24 байта): магия b'EGGB', версия формата, версия marshal,
+                          флаги, CRC32 и длина тела
+    тело: последовательность записей-секций
+          [u16 длина имени][имя utf-8][u8 раскладка][u32 длина][значение в marshal]
+
+Значения кодируются стандартным marshal (C реализация): числа остаются
+числами, а не строками, и разбор в разы быстрее json. Словари записей
+одинаковой формы (eggs_detail, daily_eggs_sent, ...) хранятся по колонкам:
+имена полей пишутся один раз на форму, а не в каждой записи.
+
+marshal зависит от версии Python - она записана в заголовке. Для переноса
+между версиями и для ручной правки есть конвертер в JSON и обратно:
+
+    python snapshot_codec.py to-binary bot_data.json bot_data.bin
+    python snapshot_codec.py to-json bot_data.bin bot_data.json
+
+Формат предназначен только для собственных файлов бота: marshal нельзя
+использовать для данных из недоверенных источников.
+"""
+
+import gc
+import json
+import marshal
+import struct
+import sys
+import zlib
+
+from json_stream import load_sections
+
+MAGIC = b'EGGB'
+FORMAT_VERSION = 1
+MARSHAL_VERSION = 4
+
+# Флаги заголовка
+FLAG_COMPRESSED = 1
+
+# magic, format version, marshal version, flags, crc32 тела, длина тела
+HEADER = struct.Struct('<4sHHHxxIQ')
+NAME_LENGTH = struct.Struct('<H')
+RECORD_HEADER = struct.Struct('<BI')
+
+# Раскладка значения секции
+LAYOUT_PLAIN = 0
+LAYOUT_COLUMNS = 1
+
+
+class SnapshotFormatError(ValueError):
+    """Файл не является снимком в бинарном формате или поврежден"""
+
+
+def _to_columns(value):
+    """Раскладывает {key: {field: ...}} по колонкам, группируя записи по набору полей
+
+    Возвращает [(fields, keys, columns), ...] или None, если значение не подходит.
+    """
+    if not isinstance(value, dict) or not value:
+        return None
+    shapes = {}
+    for key, record in value.items():
+        if not isinstance(record, dict):
+            return None
+        fields = tuple(record)
+        shape = shapes.get(fields)
+        if shape is None:
+            shape = shapes[fields] = ([], [[] for _ in fields])
+        shape[0].append(key)
+        for column, field_value in zip(shape[1], record.values()):
+            column.append(field_value)
+    return [(fields, keys, columns) for fields, (keys, columns) in shapes.items()]
+
+
+def _from_columns(shapes):
+    """Собирает словарь записей из колонок"""
+    value = {}
+    for fields, keys, columns in shapes:
+        if columns:
+            value.update(zip(keys, [dict(zip(fields, row)) for row in zip(*columns)]))
+        else:
+            value.update((key, {}) for key in keys)
+    return value
+
+
+def encode(sections, compress=False):
+    """Кодирует {имя секции: значение} в байты бинарного снимка"""
+    parts = []
+    for name, value in sections.items():
+        columns = _to_columns(value)
+        if columns is not None:
+            layout, payload = LAYOUT_COLUMNS, marshal.dumps(columns, MARSHAL_VERSION)
+        else:
+            layout, payload = LAYOUT_PLAIN, marshal.dumps(value, MARSHAL_VERSION)
+        name_bytes = name.encode('utf-8')
+        parts.append(NAME_LENGTH.pack(len(name_bytes)))
+        parts.append(name_bytes)
+        parts.append(RECORD_HEADER.pack(layout, len(payload)))
+        parts.append(payload)
+    body = b''.join(parts)
+
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 6)
+        flags |= FLAG_COMPRESSED
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, MARSHAL_VERSION, flags, zlib.crc32(body), len(body))
+    return header + body
+
+
+def decode(blob):
+    """Разбирает байты бинарного снимка в {имя секции: значение}"""
+    if len(blob) < HEADER.size:
+        raise SnapshotFormatError("File is too short for a snapshot header")
+    magic, version, marshal_version, flags, crc, length = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise SnapshotFormatError("Not a binary snapshot (bad magic)")
+    if version > FORMAT_VERSION:
+        raise SnapshotFormatError(f"Snapshot format version {version} is newer than supported {FORMAT_VERSION}")
+    if marshal_version > marshal.version:
+        raise SnapshotFormatError(
+            f"Snapshot was written with marshal version {marshal_version}, "
+            f"this Python supports {marshal.version}; convert it with to-json"
+        )
+
+    body = memoryview(blob)[HEADER.size:]
+    if len(body) != length:
+        raise SnapshotFormatError(f"Snapshot body is truncated: {len(body)} of {length} bytes")
+    if zlib.crc32(body) != crc:
+        raise SnapshotFormatError("Snapshot checksum mismatch")
+    if flags & FLAG_COMPRESSED:
+        body = memoryview(zlib.decompress(body))
+
+    # Сборщик мусора на каждом выделении обходит миллионы только что созданных
+    # объектов, которые все равно живут дальше - на время разбора он выключен
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        sections = {}
+        offset = 0
+        while offset < len(body):
+            (name_length,) = NAME_LENGTH.unpack_from(body, offset)
+            offset += NAME_LENGTH.size
+            name = bytes(body[offset:offset + name_length]).decode('utf-8')
+            offset += name_length
+            layout, payload_length = RECORD_HEADER.unpack_from(body, offset)
+            offset += RECORD_HEADER.size
+            value = marshal.loads(body[offset:offset + payload_length])
+            offset += payload_length
+            if layout == LAYOUT_COLUMNS:
+                value = _from_columns(value)
+            elif layout != LAYOUT_PLAIN:
+                raise SnapshotFormatError(f"Unknown layout {layout} of section {name}")
+            sections[name] = value
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return sections
+
+
+def is_binary(blob):
+    """Проверяет, начинаются ли байты с заголовка бинарного снимка"""
+    return blob[:len(MAGIC)] == MAGIC
+
+
+def json_to_binary(json_path, binary_path, compress=False):
+    """Конвертирует bot_data.json в бинарный снимок"""
+    data = load_sections(json_path, set_sections=('hatched_eggs',))
+    blob = encode(data, compress=compress)
+    with open(binary_path, 'wb') as f:
+        f.write(blob)
+    return len(blob)
+
+
+def binary_to_json(binary_path, json_path):
+    """Конвертирует бинарный снимок обратно в JSON формат bot_data.json"""
+    with open(binary_path, 'rb') as f:
+        data = decode(f.read())
+    if isinstance(data.get('hatched_eggs'), (set, frozenset)):
+        data['hatched_eggs'] = list(data['hatched_eggs'])
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def main(argv):
+    usage = "Usage: snapshot_codec.py to-binary|to-json <input> <output> [--compress]"
+    if len(argv) < 4 or argv[1] not in ('to-binary', 'to-json'):
+        print(usage)
+        return 2
+    command, source, target = argv[1], argv[2], argv[3]
+    if command == 'to-binary':
+        size = json_to_binary(source, target, compress='--compress' in argv[4:])
+        print(f"OK: {source} -> {target} ({size} bytes)")
+    else:
+        binary_to_json(source, target)
+        print(f"OK: {source} -> {target}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,418 @@
+"""
+Снимок данных бота, разбитый на сегменты
+
+Вместо одного большого bot_data.json каждая коллекция хранится в своем файле,
+а большие коллекции с яйцами (eggs_detail, hatched_eggs, multi_eggs) и коллекции
+пользователей (egg_points, daily_eggs_sent, ...) дополнительно разбиты на
+сегменты по хешу ключа: копия при записи снимается только с измененных
+сегментов, а не со всей коллекции. Список актуальных файлов лежит в manifest.json.
+
+При компактизации переписываются только сегменты, в которых были изменения:
+каждый сегмент пишется в новый файл с номером поколения, затем атомарно
+заменяется manifest.json. До замены манифеста на диске остается целым старый
+снимок, поэтому сбой посреди записи ничего не портит.
+
+Сегменты пишутся в JSON или в компактном бинарном формате (snapshot_codec.py),
+формат файла определяется по расширению, поэтому снимок читается при любой
+настройке, а при смене формата переписывается целиком.
+
+Запись разделена на две фазы: capture() в цикле событий быстро снимает копии
+измененных сегментов, а write_captured() сериализует их и делает fsync в
+отдельном потоке, не блокируя обработчики.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections.abc import Mapping
+
+import snapshot_codec
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Расширения файлов сегментов по формату
+SEGMENT_EXTENSIONS = {'json': '.json', 'binary': '.bin'}
+
+# Коллекции, которые делятся на сегменты по хешу ключа: яйца и все коллекции с ключом user_id
+PARTITIONED_COLLECTIONS = (
+    'eggs_detail', 'hatched_eggs', 'multi_eggs',
+    'eggs_hatched_by_user', 'user_eggs_hatched_by_others', 'eggs_sent_by_user',
+    'daily_eggs_sent', 'egg_points', 'completed_tasks', 'referrers',
+    'referral_earnings', 'ton_payments'
+)
+
+
+def bucket_of(key, buckets):
+    """Номер сегмента для ключа (одинаковый для int и str ключей)"""
+    return zlib.crc32(str(key).encode('utf-8')) % buckets
+
+
+def _copy_value(value):
+    """Копия значения коллекции, которую обработчики уже не изменят
+
+    Обработчики меняют вложенные словари и списки на месте (счетчики за день,
+    hatched_by_list), поэтому копируются два уровня. Вложенные объекты глубже
+    (записи платежей) после создания не меняются.
+    """
+    if isinstance(value, Mapping):
+        return {k: (v.copy() if isinstance(v, (dict, list)) else v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [(v.copy() if isinstance(v, (dict, list)) else v) for v in value]
+    return value
+
+
+class SegmentedSnapshot:
+    """Снимок в директории: сегменты + манифест
+
+    collections - имена коллекций состояния. hatched_eggs хранится как список,
+    admin_tasks - как список целиком, остальные коллекции - словари.
+    """
+
+    def __init__(self, directory, collections, buckets=64, format='json'):
+        if format not in SEGMENT_EXTENSIONS:
+            raise ValueError(f"Unknown snapshot format: {format}")
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.collections = tuple(collections)
+        self.buckets = buckets
+        self.format = format
+
+        self.manifest = None
+
+        # Сегменты, измененные после последней записи снимка
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._all_dirty = False
+        # Ключи разбитых коллекций по сегментам: {collection: [set(), ...]}
+        # Строится при первой записи и дальше поддерживается по записям журнала,
+        # чтобы снимать копию сегмента без прохода по всей коллекции
+        self._bucket_keys = {}
+        # Записи снимка идут строго по очереди
+        self._write_lock = threading.Lock()
+
+        # Метрики
+        self.write_count = 0
+        self.last_segments_written = 0
+        self.last_bytes_written = 0
+        self.last_write_ms = None
+        self.total_segments_written = 0
+        self.total_bytes_written = 0
+
+    def exists(self):
+        """Есть ли на диске сегментированный снимок"""
+        return os.path.exists(self.manifest_path)
+
+    def _segment_name(self, collection, bucket=None):
+        if bucket is None:
+            return collection
+        return f'{collection}.{bucket:03d}'
+
+    def segment_of(self, collection, key):
+        """Имя сегмента, в котором хранится ключ коллекции"""
+        if collection in PARTITIONED_COLLECTIONS:
+            return self._segment_name(collection, bucket_of(key, self.buckets))
+        return collection
+
+    def segments_of(self, collection):
+        """Все сегменты коллекции"""
+        if collection in PARTITIONED_COLLECTIONS:
+            return [self._segment_name(collection, b) for b in range(self.buckets)]
+        return [collection]
+
+    def all_segments(self):
+        names = []
+        for collection in self.collections:
+            names.extend(self.segments_of(collection))
+        return names
+
+    def mark_changes(self, changes):
+        """Помечает сегменты, которые затрагивают записи журнала"""
+        with self._lock:
+            for change in changes:
+                op, collection = change[0], change[1]
+                if op == 'r':
+                    self._dirty.update(self.segments_of(collection))
+                    # Коллекция заменена целиком - индекс построится заново
+                    self._bucket_keys.pop(collection, None)
+                    continue
+                key = change[2]
+                if collection in PARTITIONED_COLLECTIONS:
+                    bucket = bucket_of(key, self.buckets)
+                    self._dirty.add(self._segment_name(collection, bucket))
+                    index = self._bucket_keys.get(collection)
+                    if index is not None:
+                        if op == 'p':
+                            index[bucket].add(key)
+                        else:
+                            index[bucket].discard(key)
+                else:
+                    self._dirty.add(collection)
+
+    def mark_all_dirty(self):
+        """Следующая запись перепишет снимок целиком"""
+        with self._lock:
+            self._all_dirty = True
+
+    def dirty_count(self):
+        with self._lock:
+            return len(self.all_segments()) if self._all_dirty else len(self._dirty)
+
+    def take_dirty(self):
+        """Забирает набор измененных сегментов (для записи снимка)"""
+        with self._lock:
+            if self._all_dirty or self.manifest is None:
+                dirty = set(self.all_segments())
+            else:
+                dirty = self._dirty
+            self._dirty = set()
+            self._all_dirty = False
+        return dirty
+
+    def restore_dirty(self, dirty):
+        """Возвращает сегменты в набор измененных, если запись не удалась"""
+        with self._lock:
+            self._dirty |= dirty
+
+    # Чтение
+
+    def load(self, remove_orphans=True):
+        """Загружает снимок: возвращает (state, journal_seq)
+
+        remove_orphans=False - только чтение (снимок может писать другой процесс).
+        """
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        state = {}
+        for collection in self.collections:
+            state[collection] = [] if collection in ('hatched_eggs', 'admin_tasks') else {}
+
+        started = time.perf_counter()
+        for name, filename in manifest['segments'].items():
+            collection = name.split('.', 1)[0]
+            if collection not in state:
+                logger.warning(f"Skipping unknown snapshot segment {name}")
+                continue
+            payload = self._read_segment(name, filename)
+            if isinstance(state[collection], dict):
+                state[collection].update(payload)
+            else:
+                state[collection].extend(payload)
+        state['hatched_eggs'] = set(state['hatched_eggs'])
+
+        self.manifest = manifest
+        if manifest.get('buckets') != self.buckets:
+            # Число сегментов поменялось - следующая запись переразобьет снимок
+            logger.info(f"Snapshot buckets changed {manifest.get('buckets')} -> {self.buckets}, full rewrite scheduled")
+            self.mark_all_dirty()
+        elif any(not filename.endswith(SEGMENT_EXTENSIONS[self.format]) for filename in manifest['segments'].values()):
+            logger.info(f"Snapshot format changed to {self.format}, full rewrite scheduled")
+            self.mark_all_dirty()
+        elif not set(manifest['segments']) <= set(self.all_segments()):
+            # Коллекция, которая раньше лежала одним файлом, теперь разбита на сегменты
+            logger.info("Snapshot segment layout changed, full rewrite scheduled")
+            self.mark_all_dirty()
+        if remove_orphans:
+            self._remove_orphans()
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"Loaded snapshot generation {manifest['generation']} from {self.directory}: "
+            f"{len(manifest['segments'])} segments in {elapsed_ms:.1f} ms"
+        )
+        return state, manifest.get('journal_seq', 0)
+
+    def _read_segment(self, name, filename):
+        path = os.path.join(self.directory, filename)
+        if filename.endswith(SEGMENT_EXTENSIONS['binary']):
+            with open(path, 'rb') as f:
+                return snapshot_codec.decode(f.read())[name]
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _encode_segment(self, name, payload):
+        if self.format == 'binary':
+            return snapshot_codec.encode({name: payload})
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def _remove_orphans(self):
+        """Удаляет файлы сегментов, не попавшие в манифест (остатки прерванной записи)"""
+        referenced = set(self.manifest['segments'].values()) if self.manifest else set()
+        for filename in os.listdir(self.directory):
+            if filename == MANIFEST_NAME or filename in referenced:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError as e:
+                logger.warning(f"Failed to remove stale snapshot file {filename}: {e}")
+
+    # Запись
+
+    def _keys_by_bucket(self, collection, container, buckets):
+        """Возвращает ключи коллекции в указанных сегментах"""
+        with self._lock:
+            index = self._bucket_keys.get(collection)
+            if index is None:
+                # Первая запись: один проход по коллекции строит индекс
+                index = [set() for _ in range(self.buckets)]
+                for key in list(container):
+                    index[bucket_of(key, self.buckets)].add(key)
+                self._bucket_keys[collection] = index
+            return {bucket: list(index[bucket]) for bucket in buckets}
+
+    def _collect(self, state, dirty):
+        """Снимает копии измененных сегментов из состояния в памяти"""
+        payloads = {}
+        for collection in self.collections:
+            names = [name for name in self.segments_of(collection) if name in dirty]
+            if not names:
+                continue
+            container = state[collection]
+            if collection not in PARTITIONED_COLLECTIONS:
+                payloads[collection] = _copy_value(container)
+                continue
+
+            buckets = [int(name.rsplit('.', 1)[1]) for name in names]
+            for bucket, keys in self._keys_by_bucket(collection, container, buckets).items():
+                name = self._segment_name(collection, bucket)
+                if collection == 'hatched_eggs':
+                    payloads[name] = [key for key in keys if key in container]
+                else:
+                    payloads[name] = {
+                        key: _copy_value(container[key]) for key in keys if key in container
+                    }
+        return payloads
+
+    def _write_file(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _fsync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def capture(self, state, journal_seq):
+        """Первая фаза записи: забирает измененные сегменты и снимает их копии
+
+        Вызывается в потоке, который меняет состояние, и должна быть быстрой.
+        Возвращает (dirty, payloads, journal_seq) для write_captured().
+        """
+        dirty = self.take_dirty()
+        try:
+            payloads = self._collect(state, dirty)
+        except Exception:
+            self.restore_dirty(dirty)
+            raise
+        return dirty, payloads, journal_seq
+
+    def write(self, state, journal_seq):
+        """Снимает копию и сразу записывает ее (обе фазы в текущем потоке)"""
+        return self.write_captured(self.capture(state, journal_seq))
+
+    def write_captured(self, captured):
+        """Вторая фаза: сериализует сегменты, делает fsync и атомарно меняет манифест
+
+        Возвращает количество записанных сегментов.
+        """
+        dirty, payloads, journal_seq = captured
+        with self._write_lock:
+            return self._write_locked(dirty, payloads, journal_seq)
+
+    def _write_locked(self, dirty, payloads, journal_seq):
+        started = time.perf_counter()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            generation = (self.manifest['generation'] + 1) if self.manifest else 1
+            segments = dict(self.manifest['segments']) if self.manifest else {}
+            if self.manifest and self.manifest.get('buckets') != self.buckets:
+                segments = {}
+
+            bytes_written = 0
+            replaced = []
+            # Сегменты старой раскладки (коллекция одним файлом) уходят из манифеста,
+            # когда снимок переписывается целиком (mark_all_dirty при загрузке)
+            valid = set(self.all_segments())
+            if valid <= dirty:
+                for name in [name for name in segments if name not in valid]:
+                    replaced.append(segments.pop(name))
+            for name, payload in payloads.items():
+                filename = f'{name}.{generation}{SEGMENT_EXTENSIONS[self.format]}'
+                data = self._encode_segment(name, payload)
+                self._write_file(os.path.join(self.directory, filename), data)
+                bytes_written += len(data)
+                if name in segments:
+                    replaced.append(segments[name])
+                segments[name] = filename
+
+            manifest = {
+                'version': MANIFEST_VERSION,
+                'generation': generation,
+                'journal_seq': journal_seq,
+                'buckets': self.buckets,
+                'created_at': time.time(),
+                'segments': segments
+            }
+            temp_path = self.manifest_path + '.tmp'
+            self._write_file(temp_path, json.dumps(manifest, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            # Атомарная замена манифеста - с этого момента действует новый снимок
+            os.replace(temp_path, self.manifest_path)
+            self._fsync_directory()
+        except Exception:
+            self.restore_dirty(dirty)
+            raise
+
+        previous, self.manifest = self.manifest, manifest
+        if previous and previous.get('buckets') != self.buckets:
+            self._remove_orphans()
+        else:
+            for filename in replaced:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError as e:
+                    logger.warning(f"Failed to remove old snapshot segment {filename}: {e}")
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.write_count += 1
+        self.last_segments_written = len(dirty)
+        self.last_bytes_written = bytes_written
+        self.last_write_ms = elapsed_ms
+        self.total_segments_written += len(dirty)
+        self.total_bytes_written += bytes_written
+        logger.info(
+            f"Snapshot generation {generation}: rewrote {len(dirty)}/{len(segments)} segments "
+            f"({bytes_written} bytes) in {elapsed_ms:.1f} ms, journal seq {journal_seq}"
+        )
+        return len(dirty)
+
+    def stats(self):
+        """Возвращает метрики снимка"""
+        return {
+            'directory': self.directory,
+            'generation': self.manifest['generation'] if self.manifest else 0,
+            'segments': len(self.manifest['segments']) if self.manifest else 0,
+            'buckets': self.buckets,
+            'format': self.format,
+            'dirty_segments': self.dirty_count(),
+            'writes': self.write_count,
+            'last_segments_written': self.last_segments_written,
+            'last_bytes_written': self.last_bytes_written,
+            'last_write_ms': round(self.last_write_ms, 3) if self.last_write_ms is not None else None,
+            'total_segments_written': self.total_segments_written,
+            'total_bytes_written': self.total_bytes_written
+        }
@@ -0,0 +1,796 @@
+"""
+Типизированная модель состояния бота в памяти
+
+Ключи пользователей приводятся к int на границе загрузки: JSON хранит ключи
+строками ("123"), а обработчики пишут int (123), и без нормализации после
+рестарта у одного пользователя появлялись две записи, а поиск по int промахивался.
+
+Пять числовых счетчиков пользователя (поинты, вылуплено, вылуплено другими,
+отправлено, реферальный заработок) хранятся в одной компактной записи
+UserRecord на пользователя. Коллекции egg_points, eggs_hatched_by_user и др.
+остаются словарями для обработчиков, но это представления (UserCounterView)
+над общей таблицей пользователей.
+
+Так же устроены яйца: одна запись Egg на яйцо вместо словаря в eggs_detail,
+словаря в multi_eggs (с копией того же списка вылупивших) и ключа в
+hatched_eggs. Коллекции остаются представлениями над EggTable, а формат
+снимка, журнала и архива не меняется.
+
+referrers хранит вместе с прямым словарем обратный индекс "реферер ->
+рефералы" (ReferrerMap), чтобы не перебирать всех рефералов ради одного
+пользователя.
+"""
+
+import itertools
+import logging
+from collections.abc import Mapping, MutableMapping, MutableSet, Set
+
+logger = logging.getLogger(__name__)
+
+# Коллекция счетчика -> поле UserRecord (совпадает с колонками users в SQLite)
+USER_COUNTERS = {
+    'egg_points': 'points',
+    'eggs_hatched_by_user': 'hatched',
+    'user_eggs_hatched_by_others': 'hatched_by_others',
+    'eggs_sent_by_user': 'sent',
+    'referral_earnings': 'referral_earned'
+}
+
+# Счетчики, по которым пользователь считается в общей статистике (admin_stats)
+ACTIVITY_FIELDS = ('points', 'hatched', 'hatched_by_others', 'sent')
+
+# Все коллекции, ключ которых - user_id
+USER_KEYED_COLLECTIONS = tuple(USER_COUNTERS) + (
+    'daily_eggs_sent',
+    'completed_tasks',
+    'referrers',
+    'ton_payments'
+)
+
+
+def normalize_user_id(value):
+    """Приводит user_id к int ("123" -> 123); остальные значения не меняет"""
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+class UserRecord:
+    """Счетчики одного пользователя; None - значения в коллекции нет"""
+
+    __slots__ = tuple(USER_COUNTERS.values())
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, None)
+
+    def is_empty(self):
+        return all(getattr(self, field) is None for field in self.__slots__)
+
+    def is_active(self):
+        return any(getattr(self, field) is not None for field in ACTIVITY_FIELDS)
+
+
+class UserTable:
+    """Таблица пользователей {user_id: UserRecord} с представлениями по счетчикам"""
+
+    EMPTY = UserRecord()
+
+    def __init__(self):
+        self.users = {}
+        # Количество пользователей, у которых заполнено поле (для len() представлений)
+        self.counts = dict.fromkeys(UserRecord.__slots__, 0)
+        # Сумма значений по полю и число пользователей хотя бы с одним счетчиком
+        # из ACTIVITY_FIELDS - общая статистика без прохода по всем пользователям
+        self.totals = dict.fromkeys(UserRecord.__slots__, 0)
+        self.active_users = 0
+        self.views = {
+            collection: UserCounterView(self, field)
+            for collection, field in USER_COUNTERS.items()
+        }
+        # {field: callback(user_id, value)} - вызывается при каждом изменении счетчика
+        # (value=None - значение удалено)
+        self.watchers = {}
+
+    def get(self, user_id):
+        """Все счетчики пользователя одним поиском (пустая запись, если его нет)"""
+        return self.users.get(user_id, self.EMPTY)
+
+    def watch(self, field, callback):
+        """Подписывает callback(user_id, value) на изменения счетчика field"""
+        self.watchers[field] = callback
+
+    def recount(self):
+        """Пересчитывает counts, totals и active_users по всем записям
+
+        Возвращает {показатель: (было, стало)} для разошедшихся значений.
+        """
+        counts = dict.fromkeys(UserRecord.__slots__, 0)
+        totals = dict.fromkeys(UserRecord.__slots__, 0)
+        active_users = 0
+        for record in list(self.users.values()):
+            for field in UserRecord.__slots__:
+                value = getattr(record, field)
+                if value is not None:
+                    counts[field] += 1
+                    totals[field] += value
+            if record.is_active():
+                active_users += 1
+        drift = {}
+        for field in UserRecord.__slots__:
+            if counts[field] != self.counts[field]:
+                drift[f'count_{field}'] = (self.counts[field], counts[field])
+            if totals[field] != self.totals[field]:
+                drift[f'total_{field}'] = (self.totals[field], totals[field])
+        if active_users != self.active_users:
+            drift['active_users'] = (self.active_users, active_users)
+        self.counts, self.totals, self.active_users = counts, totals, active_users
+        return drift
+
+
+class UserCounterView(MutableMapping):
+    """Словарь {user_id: value} для одного счетчика поверх UserTable"""
+
+    __slots__ = ('_table', '_users', '_field')
+
+    def __init__(self, table, field):
+        self._table = table
+        self._users = table.users
+        self._field = field
+
+    @property
+    def table(self):
+        return self._table
+
+    def __getitem__(self, user_id):
+        record = self._users.get(user_id)
+        if record is not None:
+            value = getattr(record, self._field)
+            if value is not None:
+                return value
+        raise KeyError(user_id)
+
+    def get(self, user_id, default=None):
+        record = self._users.get(user_id)
+        if record is None:
+            return default
+        value = getattr(record, self._field)
+        return default if value is None else value
+
+    def __contains__(self, user_id):
+        record = self._users.get(user_id)
+        return record is not None and getattr(record, self._field) is not None
+
+    def __setitem__(self, user_id, value):
+        if value is None:
+            raise ValueError("Counter value cannot be None")
+        table = self._table
+        field = self._field
+        record = self._users.get(user_id)
+        if record is None:
+            record = self._users[user_id] = UserRecord()
+        old = getattr(record, field)
+        if old is None:
+            table.counts[field] += 1
+            if field in ACTIVITY_FIELDS and not record.is_active():
+                table.active_users += 1
+            old = 0
+        table.totals[field] += value - old
+        setattr(record, field, value)
+        watcher = table.watchers.get(field)
+        if watcher is not None:
+            watcher(user_id, value)
+
+    def __delitem__(self, user_id):
+        record = self._users.get(user_id)
+        if record is None or getattr(record, self._field) is None:
+            raise KeyError(user_id)
+        self._table.totals[self._field] -= getattr(record, self._field)
+        setattr(record, self._field, None)
+        self._table.counts[self._field] -= 1
+        if self._field in ACTIVITY_FIELDS and not record.is_active():
+            self._table.active_users -= 1
+        if record.is_empty():
+            del self._users[user_id]
+        watcher = self._table.watchers.get(self._field)
+        if watcher is not None:
+            watcher(user_id, None)
+
+    def __iter__(self):
+        field = self._field
+        return (user_id for user_id, record in list(self._users.items()) if getattr(record, field) is not None)
+
+    def __len__(self):
+        return self._table.counts[self._field]
+
+    def values(self):
+        field = self._field
+        return [value for value in (getattr(record, field) for record in list(self._users.values())) if value is not None]
+
+    def items(self):
+        field = self._field
+        return [
+            (user_id, getattr(record, field)) for user_id, record in list(self._users.items())
+            if getattr(record, field) is not None
+        ]
+
+    def clear(self):
+        for user_id in list(self):
+            del self[user_id]
+
+    def __repr__(self):
+        return f'UserCounterView({self._field}, {len(self)} users)'
+
+
+class ReferrerMap(MutableMapping):
+    """referrers {user_id: referrer_id} с обратным индексом рефералов
+
+    Индекс {referrer_id: {user_id: None}} обновляется при каждой записи, поэтому
+    количество и список рефералов пользователя не требуют прохода по всем
+    referrers. Рефералы в индексе идут в порядке появления.
+    """
+
+    __slots__ = ('_referrers', '_referrals')
+
+    def __init__(self, items=()):
+        self._referrers = {}
+        self._referrals = {}
+        self.update(items)
+
+    def __getitem__(self, user_id):
+        return self._referrers[user_id]
+
+    def get(self, user_id, default=None):
+        return self._referrers.get(user_id, default)
+
+    def __contains__(self, user_id):
+        return user_id in self._referrers
+
+    def __setitem__(self, user_id, referrer_id):
+        old = self._referrers.get(user_id)
+        if old is not None:
+            self._unlink(user_id, old)
+        self._referrers[user_id] = referrer_id
+        self._referrals.setdefault(referrer_id, {})[user_id] = None
+
+    def __delitem__(self, user_id):
+        self._unlink(user_id, self._referrers.pop(user_id))
+
+    def _unlink(self, user_id, referrer_id):
+        referrals = self._referrals.get(referrer_id)
+        if referrals is not None:
+            referrals.pop(user_id, None)
+            if not referrals:
+                del self._referrals[referrer_id]
+
+    def __iter__(self):
+        return iter(self._referrers)
+
+    def __len__(self):
+        return len(self._referrers)
+
+    def items(self):
+        return self._referrers.items()
+
+    def clear(self):
+        self._referrers.clear()
+        self._referrals.clear()
+
+    def referral_count(self, referrer_id):
+        return len(self._referrals.get(referrer_id, ()))
+
+    def referrals_of(self, referrer_id, offset=0, limit=None, newest_first=True):
+        """Рефералы пользователя (страница offset/limit), по умолчанию новые первыми"""
+        referrals = self._referrals.get(referrer_id)
+        if not referrals:
+            return []
+        ordered = reversed(referrals) if newest_first else iter(referrals)
+        stop = None if limit is None else offset + limit
+        return list(itertools.islice(ordered, offset, stop))
+
+    def referrer_count(self):
+        """Сколько пользователей привели хотя бы одного реферала"""
+        return len(self._referrals)
+
+    def __repr__(self):
+        return f'ReferrerMap({len(self)} referrals, {len(self._referrals)} referrers)'
+
+
+class DailyQuotaMap(MutableMapping):
+    """daily_eggs_sent {user_id: {'date', 'count', 'paid_eggs'}} со счетчиком пользователей по дате
+
+    Обработчики меняют count и paid_eggs на месте, а новую дату всегда
+    записывают новым словарем, поэтому счетчик обновляется в __setitem__.
+    """
+
+    __slots__ = ('_quotas', '_by_date')
+
+    def __init__(self, items=()):
+        self._quotas = {}
+        self._by_date = {}
+        self.update(items)
+
+    def __getitem__(self, user_id):
+        return self._quotas[user_id]
+
+    def get(self, user_id, default=None):
+        return self._quotas.get(user_id, default)
+
+    def __contains__(self, user_id):
+        return user_id in self._quotas
+
+    def __setitem__(self, user_id, quota):
+        old = self._quotas.get(user_id)
+        if old is not None:
+            self._count(old.get('date'), -1)
+        self._quotas[user_id] = quota
+        self._count(quota.get('date'), 1)
+
+    def __delitem__(self, user_id):
+        self._count(self._quotas.pop(user_id).get('date'), -1)
+
+    def _count(self, day, delta):
+        users = self._by_date.get(day, 0) + delta
+        if users:
+            self._by_date[day] = users
+        else:
+            del self._by_date[day]
+
+    def __iter__(self):
+        return iter(self._quotas)
+
+    def __len__(self):
+        return len(self._quotas)
+
+    def items(self):
+        return self._quotas.items()
+
+    def clear(self):
+        self._quotas.clear()
+        self._by_date.clear()
+
+    def users_on(self, day):
+        """Сколько пользователей с записью за день day (isoformat)"""
+        return self._by_date.get(day, 0)
+
+    def recount(self):
+        """Пересчитывает счетчик по датам; возвращает {дата: (было, стало)} для расхождений"""
+        by_date = {}
+        for quota in list(self._quotas.values()):
+            day = quota.get('date')
+            by_date[day] = by_date.get(day, 0) + 1
+        drift = {
+            day: (self._by_date.get(day, 0), by_date.get(day, 0))
+            for day in set(by_date) | set(self._by_date)
+            if by_date.get(day, 0) != self._by_date.get(day, 0)
+        }
+        self._by_date = by_date
+        return drift
+
+    def __repr__(self):
+        return f'DailyQuotaMap({len(self)} users, {len(self._by_date)} dates)'
+
+
+# Поля детальной информации о яйце (eggs_detail), которые хранятся в слотах Egg
+DETAIL_FIELDS = (
+    'sender_id', 'egg_id', 'hatched_by', 'timestamp_sent', 'timestamp_hatched',
+    'is_multi', 'max_hatches', 'hatched_count'
+)
+# Коллекция яиц -> флаг записи Egg (совпадает с колонками eggs в SQLite и индексом архива)
+EGG_COLLECTIONS = {
+    'eggs_detail': 'in_detail',
+    'multi_eggs': 'in_multi',
+    'hatched_eggs': 'in_hatched'
+}
+# До скольких вылупивших проверка идет по списку; дальше строится множество
+SMALL_HATCHERS = 8
+
+
+class Egg(Mapping):
+    """Одно яйцо: детальная информация, прогресс multi egg и отметка вылупления
+
+    Флаги in_detail, in_multi и in_hatched говорят, в каких коллекциях есть
+    яйцо. Вылупившие хранятся один раз: hatchers - порядок вылупления (для
+    показа), hatcher_set - множество для проверки "уже вылуплял" у multi egg
+    с большим числом вылупивших. hatched_count - счетчик eggs_detail,
+    multi_count - счетчик multi_eggs.
+
+    Как Mapping запись читается так же, как словарь из eggs_detail: поля,
+    которых не было в словаре, не заданы и в записи. Менять запись нужно
+    через методы и атрибуты, а не присваиванием ключей.
+    """
+
+    __slots__ = DETAIL_FIELDS + (
+        'multi_count', 'hatchers', 'hatcher_set', 'extra',
+        'in_detail', 'in_multi', 'in_hatched'
+    )
+
+    def __init__(self):
+        self.multi_count = 0
+        self.hatchers = None
+        self.hatcher_set = None
+        self.extra = None
+        self.in_detail = self.in_multi = self.in_hatched = False
+
+    def is_empty(self):
+        return not (self.in_detail or self.in_multi or self.in_hatched)
+
+    # Вылупившие
+
+    def has_hatcher(self, user_id):
+        if self.hatcher_set is not None:
+            return user_id in self.hatcher_set
+        return self.hatchers is not None and user_id in self.hatchers
+
+    def add_hatcher(self, user_id):
+        if self.hatchers is None:
+            self.hatchers = []
+        self.hatchers.append(user_id)
+        if self.hatcher_set is not None:
+            self.hatcher_set.add(user_id)
+        elif len(self.hatchers) > SMALL_HATCHERS:
+            self.hatcher_set = set(self.hatchers)
+
+    def set_hatchers(self, user_ids):
+        self.hatchers = list(user_ids) if user_ids is not None else None
+        self.hatcher_set = set(self.hatchers) if self.hatchers and len(self.hatchers) > SMALL_HATCHERS else None
+
+    # Загрузка и выгрузка в формате коллекций
+
+    def set_detail(self, info):
+        for field in DETAIL_FIELDS:
+            if hasattr(self, field):
+                delattr(self, field)
+        extra = None
+        for key, value in info.items():
+            if key in DETAIL_FIELDS:
+                setattr(self, key, value)
+            elif key == 'hatched_by_list':
+                self.set_hatchers(value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self.extra = extra
+
+    def set_multi(self, data):
+        self.multi_count = data.get('hatched_count', 0)
+        self.set_hatchers(data.get('hatched_by_list', []))
+
+    def multi_dict(self):
+        return {'hatched_by_list': list(self.hatchers or ()), 'hatched_count': self.multi_count}
+
+    def __getitem__(self, key):
+        if key in DETAIL_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if key == 'hatched_by_list' and self.hatchers is not None:
+            return list(self.hatchers)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for field in DETAIL_FIELDS:
+            if hasattr(self, field):
+                yield field
+        if self.hatchers is not None:
+            yield 'hatched_by_list'
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Egg({dict(self)!r})'
+
+
+class EggTable:
+    """Таблица яиц {egg_key: Egg} с представлениями eggs_detail, multi_eggs, hatched_eggs"""
+
+    def __init__(self):
+        self.eggs = {}
+        # Количество яиц с флагом (для len() представлений)
+        self.counts = dict.fromkeys(EGG_COLLECTIONS.values(), 0)
+        self.views = {
+            'eggs_detail': EggDetailView(self),
+            'multi_eggs': MultiEggView(self),
+            'hatched_eggs': HatchedEggView(self)
+        }
+
+    def get(self, egg_key):
+        """Запись яйца (None, если его нет ни в одной коллекции)"""
+        return self.eggs.get(egg_key)
+
+    def flag(self, egg_key, flag):
+        """Запись яйца с установленным флагом коллекции (создает ее при необходимости)"""
+        egg = self.eggs.get(egg_key)
+        if egg is None:
+            egg = self.eggs[egg_key] = Egg()
+        if not getattr(egg, flag):
+            setattr(egg, flag, True)
+            self.counts[flag] += 1
+        return egg
+
+    def unflag(self, egg_key, flag):
+        """Снимает флаг коллекции; False, если его не было"""
+        egg = self.eggs.get(egg_key)
+        if egg is None or not getattr(egg, flag):
+            return False
+        setattr(egg, flag, False)
+        self.counts[flag] -= 1
+        if egg.is_empty():
+            del self.eggs[egg_key]
+        return True
+
+    def keys_with(self, flag):
+        return [egg_key for egg_key, egg in list(self.eggs.items()) if getattr(egg, flag)]
+
+
+class _EggCollectionView:
+    """Общая часть представлений коллекций яиц"""
+
+    __slots__ = ('_table', '_eggs', '_flag')
+
+    def __init__(self, table, flag):
+        self._table = table
+        self._eggs = table.eggs
+        self._flag = flag
+
+    @property
+    def table(self):
+        return self._table
+
+    def _record(self, egg_key):
+        egg = self._eggs.get(egg_key)
+        if egg is not None and getattr(egg, self._flag):
+            return egg
+        return None
+
+    def __contains__(self, egg_key):
+        return self._record(egg_key) is not None
+
+    def __iter__(self):
+        return iter(self._table.keys_with(self._flag))
+
+    def __len__(self):
+        return self._table.counts[self._flag]
+
+    def clear(self):
+        for egg_key in self._table.keys_with(self._flag):
+            self._table.unflag(egg_key, self._flag)
+
+
+class EggDetailView(_EggCollectionView, MutableMapping):
+    """eggs_detail: {egg_key: Egg}, запись читается как словарь детальной информации"""
+
+    __slots__ = ()
+
+    def __init__(self, table):
+        super().__init__(table, 'in_detail')
+
+    def __getitem__(self, egg_key):
+        egg = self._record(egg_key)
+        if egg is None:
+            raise KeyError(egg_key)
+        return egg
+
+    def get(self, egg_key, default=None):
+        egg = self._record(egg_key)
+        return default if egg is None else egg
+
+    def __setitem__(self, egg_key, info):
+        egg = self._table.flag(egg_key, 'in_detail')
+        if info is not egg:
+            egg.set_detail(info)
+
+    def __delitem__(self, egg_key):
+        if not self._table.unflag(egg_key, 'in_detail'):
+            raise KeyError(egg_key)
+
+    def values(self):
+        return [egg for egg in list(self._eggs.values()) if egg.in_detail]
+
+    def items(self):
+        return [(egg_key, egg) for egg_key, egg in list(self._eggs.items()) if egg.in_detail]
+
+    def __repr__(self):
+        return f'EggDetailView({len(self)} eggs)'
+
+
+class MultiEggView(_EggCollectionView, MutableMapping):
+    """multi_eggs: {egg_key: {'hatched_by_list', 'hatched_count'}} - значения собираются из Egg"""
+
+    __slots__ = ()
+
+    def __init__(self, table):
+        super().__init__(table, 'in_multi')
+
+    def __getitem__(self, egg_key):
+        egg = self._record(egg_key)
+        if egg is None:
+            raise KeyError(egg_key)
+        return egg.multi_dict()
+
+    def __setitem__(self, egg_key, data):
+        self._table.flag(egg_key, 'in_multi').set_multi(data)
+
+    def __delitem__(self, egg_key):
+        if not self._table.unflag(egg_key, 'in_multi'):
+            raise KeyError(egg_key)
+
+    def __repr__(self):
+        return f'MultiEggView({len(self)} eggs)'
+
+
+class HatchedEggView(_EggCollectionView, MutableSet):
+    """hatched_eggs: множество ключей вылупленных обычных яиц"""
+
+    __slots__ = ()
+
+    def __init__(self, table):
+        super().__init__(table, 'in_hatched')
+
+    def add(self, egg_key):
+        self._table.flag(egg_key, 'in_hatched')
+
+    def discard(self, egg_key):
+        self._table.unflag(egg_key, 'in_hatched')
+
+    def __repr__(self):
+        return f'HatchedEggView({len(self)} eggs)'
+
+
+# Представления, которые нельзя заменить новым объектом: обработчики держат на них ссылку
+TABLE_VIEWS = (UserCounterView, ReferrerMap, DailyQuotaMap, EggDetailView, MultiEggView, HatchedEggView)
+
+
+def plain_record(value):
+    """Запись коллекции в виде обычных dict/list (Egg -> словарь eggs_detail)"""
+    if isinstance(value, Egg):
+        return {key: (item.copy() if isinstance(item, list) else item) for key, item in value.items()}
+    return value
+
+
+def plain_collection(value):
+    """Превращает коллекцию в обычный dict/list для сериализации"""
+    if isinstance(value, (dict, list)):
+        return value
+    if isinstance(value, (set, frozenset, Set)):
+        return list(value)
+    if isinstance(value, Mapping):
+        return {key: plain_record(item) for key, item in value.items()}
+    return value
+
+
+def build_egg_table(state):
+    """Переносит eggs_detail, multi_eggs и hatched_eggs в одну таблицу записей Egg
+
+    Для multi egg вылупившие берутся из multi_eggs: по ним проверяется лимит.
+    """
+    table = EggTable()
+    details = table.views['eggs_detail']
+    for egg_key, info in (state.get('eggs_detail') or {}).items():
+        details[egg_key] = info
+    multi = table.views['multi_eggs']
+    for egg_key, data in (state.get('multi_eggs') or {}).items():
+        multi[egg_key] = data
+    hatched = table.views['hatched_eggs']
+    for egg_key in state.get('hatched_eggs') or ():
+        hatched.add(egg_key)
+    for collection, view in table.views.items():
+        state[collection] = view
+    logger.info(
+        f"Egg table: {len(table.eggs)} eggs ({len(details)} with details, "
+        f"{len(multi)} multi, {len(hatched)} hatched)"
+    )
+    return table
+
+
+def _merge_counters(a, b):
+    # После рестарта обработчик начинал счет заново под int ключом -
+    # реальное значение это сумма старого и нового
+    return (a or 0) + (b or 0)
+
+
+def _merge_daily(a, b):
+    if a.get('date') != b.get('date'):
+        newer, older = (a, b) if (a.get('date') or '') > (b.get('date') or '') else (b, a)
+        merged = dict(newer)
+        merged['paid_eggs'] = newer.get('paid_eggs', 0) + older.get('paid_eggs', 0)
+        return merged
+    merged = dict(a)
+    merged['count'] = a.get('count', 0) + b.get('count', 0)
+    merged['paid_eggs'] = a.get('paid_eggs', 0) + b.get('paid_eggs', 0)
+    return merged
+
+
+def _merge_tasks(a, b):
+    merged = dict(a)
+    for task_key, done in b.items():
+        merged[task_key] = merged.get(task_key, False) or done
+    return merged
+
+
+def _merge_payments(a, b):
+    merged = list(a)
+    seen = {p.get('tx_hash') for p in a if p.get('tx_hash')}
+    for payment in b:
+        if not payment.get('tx_hash') or payment['tx_hash'] not in seen:
+            merged.append(payment)
+    return merged
+
+
+def _merge_referrer(a, b):
+    # Первый установленный реферер остается
+    return a
+
+
+MERGERS = {
+    'daily_eggs_sent': _merge_daily,
+    'completed_tasks': _merge_tasks,
+    'ton_payments': _merge_payments,
+    'referrers': _merge_referrer
+}
+
+
+def normalize_user_keys(collection, items):
+    """Приводит ключи коллекции к int, сливая дубликаты "123" и 123
+
+    Возвращает (dict, количество слитых дубликатов). Записи с int ключом
+    идут после строковых, поэтому при слиянии они считаются более новыми.
+    """
+    merge = MERGERS.get(collection, _merge_counters)
+    result = {}
+    merged = 0
+    for user_id, value in sorted(items, key=lambda item: not isinstance(item[0], str)):
+        user_id = normalize_user_id(user_id)
+        if collection == 'referrers':
+            value = normalize_user_id(value)
+        if user_id in result:
+            result[user_id] = merge(result[user_id], value)
+            merged += 1
+        else:
+            result[user_id] = value
+    return result, merged
+
+
+def build_state(state):
+    """Нормализует загруженное состояние и собирает типизированную модель
+
+    Коллекции с ключом user_id приводятся к int ключам, счетчики переезжают
+    в UserTable, referrers получает обратный индекс (ReferrerMap), а
+    daily_eggs_sent - счетчик пользователей по дате (DailyQuotaMap). Коллекции заменяются в том же словаре state. Возвращает
+    количество исправленных ключей (их нужно переписать на диске).
+    """
+    table = UserTable()
+    total_fixed = 0
+    total_merged = 0
+    for collection in USER_KEYED_COLLECTIONS:
+        items = state.get(collection) or {}
+        fixed = sum(1 for user_id in items if isinstance(user_id, str))
+        normalized, merged = normalize_user_keys(collection, items.items())
+        total_fixed += fixed
+        total_merged += merged
+        if collection in USER_COUNTERS:
+            view = table.views[collection]
+            for user_id, value in normalized.items():
+                view[user_id] = value
+            state[collection] = view
+        elif collection == 'referrers':
+            state[collection] = ReferrerMap(normalized)
+        elif collection == 'daily_eggs_sent':
+            state[collection] = DailyQuotaMap(normalized)
+        else:
+            state[collection] = normalized
+    if total_merged:
+        logger.warning(f"Merged {total_merged} duplicate user entries with string and int keys")
+    logger.info(f"User table: {len(table.users)} users, {total_fixed} string user ids normalized")
+    build_egg_table(state)
+    return total_fixed
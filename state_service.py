@@ -0,0 +1,316 @@
+"""
+Сервис состояния для работы бота в нескольких процессах
+
+Один Python процесс упирается в одно ядро: разбор апдейтов, обработчики и
+вызовы Bot API идут в одном цикле событий. В режиме WORKERS > 0 процесс-владелец
+держит данные (хранилище, журнал, архив, API) и получает апдейты от Telegram,
+а обработкой занимаются WORKERS процессов-обработчиков на той же машине.
+
+Владелец раздает апдейты обработчикам по ключу раздела (отправитель яйца),
+поэтому черновики яиц и все нажатия под одним яйцом попадают в один процесс.
+Обработчики не держат данных: каждое изменение - одна именованная транзакция,
+которую владелец выполняет синхронно в своем цикле событий. Транзакции идут
+по одной, поэтому атомарны без блокировок, а писатель на диск остается один.
+
+Протокол - кадры по unix сокету: 4 байта длины + JSON массив.
+    ['attach', worker_index]                   обработчик -> владелец
+    ['call', call_id, operation, args]         обработчик -> владелец
+    ['result', call_id, ok, value]             владелец -> обработчик
+    ['update', update_dict]                    владелец -> обработчик
+    ['maintenance', enabled]                   владелец -> обработчик
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('>I')
+
+
+class StateServiceError(RuntimeError):
+    """Транзакция завершилась ошибкой в процессе-владельце"""
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+
+def write_frame(writer, message):
+    body = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    writer.write(FRAME_HEADER.pack(len(body)) + body)
+
+
+class StateServer:
+    """Сервер транзакций в процессе-владельце данных
+
+    operations - {имя: синхронная функция}. Функции выполняются прямо в цикле
+    событий владельца, между ними не бывает переключений на другие задачи.
+    """
+
+    def __init__(self, path, operations):
+        self.path = path
+        self.operations = operations
+        self._server = None
+        # {worker_index: writer} подключенных обработчиков
+        self._workers = {}
+        # {задача соединения: writer} всех подключений
+        self._connections = {}
+
+        # Метрики
+        self.calls = 0
+        self.errors = 0
+        self.pushed = 0
+        self.push_failures = 0
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Сокет от предыдущего запуска
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+        logger.info(f"State service listening on {self.path}")
+
+    async def _serve(self, reader, writer):
+        worker_index = None
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                message = await read_frame(reader)
+                kind = message[0]
+                if kind == 'call':
+                    _, call_id, operation, args = message
+                    write_frame(writer, self._execute(call_id, operation, args))
+                    await writer.drain()
+                elif kind == 'attach':
+                    worker_index = message[1]
+                    self._workers[worker_index] = writer
+                    logger.info(f"Worker {worker_index} attached to state service")
+                else:
+                    logger.warning(f"Unknown state service message: {kind}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"State service connection failed: {e}", exc_info=True)
+        finally:
+            if worker_index is not None and self._workers.get(worker_index) is writer:
+                del self._workers[worker_index]
+                logger.warning(f"Worker {worker_index} detached from state service")
+            self._connections.pop(task, None)
+            writer.close()
+
+    def _execute(self, call_id, operation, args):
+        self.calls += 1
+        try:
+            return ['result', call_id, True, self.operations[operation](*args)]
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"State operation {operation} failed: {e}", exc_info=True)
+            return ['result', call_id, False, f"{type(e).__name__}: {e}"]
+
+    def push(self, worker_index, message):
+        """Отправляет сообщение обработчику; False, если он не подключен"""
+        writer = self._workers.get(worker_index)
+        if writer is None or writer.is_closing():
+            self.push_failures += 1
+            return False
+        write_frame(writer, message)
+        self.pushed += 1
+        return True
+
+    def broadcast(self, message):
+        for worker_index in list(self._workers):
+            self.push(worker_index, message)
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        # Закрытие соединения завершает его задачу (чтение получает EOF)
+        connections = list(self._connections.items())
+        for _, writer in connections:
+            writer.close()
+        await asyncio.gather(*(task for task, _ in connections), return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def stats(self):
+        return {
+            'socket': self.path,
+            'workers_attached': sorted(self._workers),
+            'calls': self.calls,
+            'errors': self.errors,
+            'pushed': self.pushed,
+            'push_failures': self.push_failures
+        }
+
+
+class StateClient:
+    """Клиент сервиса состояния в процессе-обработчике
+
+    Вызовы конвейеризуются: несколько транзакций могут ждать ответа одновременно.
+    on_push(message) получает сообщения владельца, которые не являются ответами.
+    """
+
+    def __init__(self, path, on_push=None):
+        self.path = path
+        self.on_push = on_push
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._pending = {}
+        self._next_id = 0
+        # Устанавливается, когда соединение с владельцем потеряно
+        self.closed = asyncio.Event()
+
+        # Метрики
+        self.calls = 0
+        self.total_ms = 0.0
+
+    async def connect(self, worker_index=None, timeout=30.0):
+        """Подключается к владельцу, дожидаясь появления сокета"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+        if worker_index is not None:
+            write_frame(self._writer, ['attach', worker_index])
+            await self._writer.drain()
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                message = await read_frame(self._reader)
+                if message[0] == 'result':
+                    _, call_id, ok, value = message
+                    future = self._pending.pop(call_id, None)
+                    if future is None or future.done():
+                        continue
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(StateServiceError(value))
+                elif self.on_push is not None:
+                    self.on_push(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error("Connection to state service lost")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("state service connection lost"))
+            self._pending.clear()
+            self.closed.set()
+
+    async def call(self, operation, *args):
+        """Выполняет транзакцию у владельца и возвращает ее результат"""
+        if self.closed.is_set():
+            raise ConnectionError("state service connection lost")
+        started = time.perf_counter()
+        self._next_id += 1
+        call_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = future
+        write_frame(self._writer, ['call', call_id, operation, list(args)])
+        await self._writer.drain()
+        try:
+            return await future
+        finally:
+            self.calls += 1
+            self.total_ms += (time.perf_counter() - started) * 1000
+
+    async def close(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+            self._read_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'avg_ms': round(self.total_ms / self.calls, 3) if self.calls else None,
+            'pending': len(self._pending)
+        }
+
+
+class WorkerPool:
+    """Процессы-обработчики, запущенные владельцем
+
+    Каждый обработчик - тот же скрипт с ROLE=worker и своим WORKER_INDEX.
+    Упавший процесс перезапускается через restart_delay секунд.
+    """
+
+    def __init__(self, script, count, env=None, restart_delay=1.0):
+        self.script = script
+        self.count = count
+        self.env = env or {}
+        self.restart_delay = restart_delay
+        self._processes = {}
+        self._tasks = []
+
+        # Метрики
+        self.restarts = 0
+
+    async def _supervise(self, worker_index):
+        env = {**os.environ, **self.env, 'ROLE': 'worker', 'WORKER_INDEX': str(worker_index)}
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, self.script, env=env)
+            self._processes[worker_index] = process
+            logger.info(f"Worker {worker_index} started (pid {process.pid})")
+            code = await process.wait()
+            logger.error(f"Worker {worker_index} exited with code {code}, restarting in {self.restart_delay}s")
+            self.restarts += 1
+            await asyncio.sleep(self.restart_delay)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._supervise(worker_index))
+            for worker_index in range(self.count)
+        ]
+
+    async def stop(self, timeout=10.0):
+        """Останавливает обработчики: SIGTERM, затем SIGKILL по таймауту"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        for worker_index, process in self._processes.items():
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Worker {worker_index} did not stop in {timeout}s, killing")
+                process.kill()
+                await process.wait()
+        self._processes = {}
+
+    def stats(self):
+        return {
+            'workers': self.count,
+            'pids': {index: process.pid for index, process in self._processes.items()},
+            'restarts': self.restarts
+        }
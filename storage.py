@@ -0,0 +1,1216 @@
+"""
+Хранилище данных бота
+
+Обработчики и API работают с хранилищем через единый интерфейс StorageBackend:
+- load() загружает состояние в память при старте
+- record() фиксирует изменения одного события
+- checkpoint() вызывается фоновым сохранятелем и сбрасывает накопленное на диск
+- методы поиска яиц используются Eggchain Explorer
+
+Реализации:
+- JsonFileStorage - сегментированный снимок (snapshots.py) + журнал изменений
+- SQLiteStorage - индексированные таблицы в SQLite (WAL, пакетные транзакции);
+  в памяти держатся только счетчики пользователей и еще не вылупленные яйца
+
+У JsonFileStorage холодные яйца (вылупленные или старше N дней) переносятся
+из памяти в архив (archive.py), методы поиска проваливаются в него прозрачно.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from archive import ARCHIVE_FLAGS, ArchivedEgg, EggArchive
+from journal import EventJournal
+from json_stream import load_sections
+from snapshots import SegmentedSnapshot
+from state import (
+    TABLE_VIEWS, USER_COUNTERS, USER_KEYED_COLLECTIONS, build_state,
+    normalize_user_id, normalize_user_keys, plain_collection
+)
+
+logger = logging.getLogger(__name__)
+
+# Коллекции состояния бота (имена совпадают с ключами снимка)
+COLLECTIONS = (
+    'hatched_eggs',
+    'eggs_hatched_by_user',
+    'user_eggs_hatched_by_others',
+    'eggs_sent_by_user',
+    'daily_eggs_sent',
+    'egg_points',
+    'completed_tasks',
+    'referrers',
+    'referral_earnings',
+    'ton_payments',
+    'eggs_detail',
+    'multi_eggs',
+    'admin_tasks'
+)
+
+
+def get_default_data():
+    """Возвращает данные по умолчанию"""
+    return {
+        'hatched_eggs': set(),
+        'eggs_hatched_by_user': {},
+        'user_eggs_hatched_by_others': {},
+        'eggs_sent_by_user': {},
+        'daily_eggs_sent': {},
+        'egg_points': {},
+        'completed_tasks': {},
+        'referrers': {},
+        'referral_earnings': {},
+        'ton_payments': {},
+        'eggs_detail': {},
+        'multi_eggs': {},
+        'admin_tasks': []
+    }
+
+
+def apply_change(state, change):
+    """Применяет одно изменение из журнала к словарю с данными
+
+    Ключи пользователей приводятся к int, как и при загрузке снимка.
+    """
+    op, collection = change[0], change[1]
+    user_keyed = collection in USER_KEYED_COLLECTIONS
+    if op == 'r':
+        value = change[2]
+        if user_keyed:
+            value, _ = normalize_user_keys(collection, value.items())
+        container = state[collection]
+        if isinstance(container, TABLE_VIEWS):
+            # Представление таблицы нельзя заменить - обработчики держат на него ссылку
+            container.clear()
+            if collection == 'hatched_eggs':
+                container |= value
+            else:
+                container.update(value)
+        elif collection == 'hatched_eggs':
+            state[collection] = set(value)
+        else:
+            state[collection] = value
+    elif op == 'p':
+        if collection == 'hatched_eggs':
+            state[collection].add(change[2])
+        elif user_keyed:
+            value = normalize_user_id(change[3]) if collection == 'referrers' else change[3]
+            state[collection][normalize_user_id(change[2])] = value
+        else:
+            state[collection][change[2]] = change[3]
+    elif op == 'd':
+        if collection == 'hatched_eggs':
+            state[collection].discard(change[2])
+        else:
+            key = normalize_user_id(change[2]) if user_keyed else change[2]
+            state[collection].pop(key, None)
+
+
+def serialize_state(state):
+    """Превращает состояние из памяти в словарь, пригодный для json.dump"""
+    return {name: plain_collection(state[name]) for name in COLLECTIONS}
+
+
+def sender_from_egg_key(egg_key):
+    """Извлекает sender_id из ключа яйца формата {sender_id}_{egg_id}"""
+    parts = str(egg_key).split('_', 1)
+    if len(parts) == 2:
+        try:
+            return int(parts[0])
+        except ValueError:
+            return None
+    return None
+
+
+class StorageBackend:
+    """Базовый интерфейс хранилища
+
+    state_getter, переданный в attach(), возвращает словарь с живыми коллекциями
+    бота из памяти. Все методы поиска учитывают изменения в памяти, которые еще
+    не попали на диск.
+    """
+
+    name = 'base'
+
+    def __init__(self, checkpoint_interval=60.0, checkpoint_max_pending=5000):
+        # Подсказки для фонового сохранятеля: как часто вызывать checkpoint()
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_max_pending = checkpoint_max_pending
+        self._state = None
+        # Сколько изменений после load() еще нужно записать на диск
+        # (проигранный журнал, исправленные ключи)
+        self.dirty_after_load = 0
+        # Архив холодных яиц (EggArchive), в который проваливаются методы поиска
+        self.archive = None
+
+    def attach(self, state_getter):
+        """Подключает хранилище к состоянию бота в памяти"""
+        self._state = state_getter
+
+    def load(self):
+        """Загружает состояние при старте"""
+        raise NotImplementedError
+
+    def record(self, event, changes):
+        """Фиксирует изменения одного события (список записей журнала)"""
+        raise NotImplementedError
+
+    def checkpoint(self):
+        """Сбрасывает накопленные изменения на диск"""
+        write = self.capture_checkpoint()
+        if write is not None:
+            write()
+
+    def capture_checkpoint(self):
+        """Готовит сброс на диск и возвращает функцию записи
+
+        Вызывается в цикле событий и должна быть быстрой; возвращенная функция
+        выполняется фоновым сохранятелем в отдельном потоке.
+        """
+        raise NotImplementedError
+
+    def fault_in(self, egg_key):
+        """Подгружает яйцо с диска в память, если его там нет
+
+        Возвращает True, если яйцо было подгружено.
+        """
+        return False
+
+    def capture_cold_eggs(self, limit):
+        """Выбирает холодные яйца для переноса в архив (ColdEggMover)
+
+        Возвращает пачку или None, если хранилище не держит архив.
+        """
+        return None
+
+    def _is_resident(self, egg_key):
+        state = self._state()
+        return egg_key in state['eggs_detail'] or egg_key in state['multi_eggs'] or egg_key in state['hatched_eggs']
+
+    def export_data(self):
+        """Возвращает полный снимок данных (для backup)"""
+        data = serialize_state(self._state())
+        if self.archive is not None:
+            # Словари из serialize_state - живые коллекции бота, дополняем копии.
+            # Версия из памяти новее архивной
+            data['eggs_detail'] = dict(data['eggs_detail'])
+            data['multi_eggs'] = dict(data['multi_eggs'])
+            hatched = set(data['hatched_eggs'])
+            for egg in self.archive.iter_all():
+                if egg.detail is not None:
+                    data['eggs_detail'].setdefault(egg.egg_key, egg.detail)
+                if egg.multi is not None:
+                    data['multi_eggs'].setdefault(egg.egg_key, egg.multi)
+                if egg.hatched:
+                    hatched.add(egg.egg_key)
+            data['hatched_eggs'] = list(hatched)
+        return data
+
+    def close(self):
+        """Освобождает ресурсы хранилища"""
+
+    def stats(self):
+        """Возвращает метрики хранилища"""
+        return {'backend': self.name}
+
+    # Поиск яиц для Eggchain Explorer: сначала память (там самые свежие данные), затем архив
+
+    def get_egg_detail(self, egg_key):
+        """Возвращает детальную информацию о яйце по ключу"""
+        info = self._state()['eggs_detail'].get(egg_key)
+        if info is None and self.archive is not None:
+            egg = self.archive.get(egg_key)
+            if egg is not None:
+                return egg.detail
+        return info
+
+    def find_egg_key(self, egg_id):
+        """Ищет ключ яйца по egg_id"""
+        for key, info in list(self._state()['eggs_detail'].items()):
+            if info.get('egg_id') == egg_id:
+                return key
+        if self.archive is not None:
+            return self.archive.find_egg_key(egg_id)
+        return None
+
+    def is_hatched(self, egg_key):
+        """Проверяет, вылуплено ли обычное яйцо"""
+        if egg_key in self._state()['hatched_eggs']:
+            return True
+        return self.archive is not None and self.archive.is_hatched(egg_key)
+
+    def find_hatched_key(self, egg_id):
+        """Ищет вылупленное яйцо без детальной информации по egg_id"""
+        suffix = f'_{egg_id}'
+        for egg_key in list(self._state()['hatched_eggs']):
+            if egg_key.endswith(suffix):
+                return egg_key
+        if self.archive is not None:
+            return self.archive.find_hatched_key(egg_id)
+        return None
+
+    def get_multi_egg(self, egg_key):
+        """Возвращает данные multi egg (список вылупивших и счетчик)"""
+        data = self._state()['multi_eggs'].get(egg_key)
+        if data is None and self.archive is not None:
+            egg = self.archive.get(egg_key)
+            if egg is not None:
+                return egg.multi
+        return data
+
+    def _with_archived(self, archived, resident_items):
+        if self.archive is None:
+            return resident_items
+        result = {egg.egg_key: egg.detail for egg in archived}
+        # Версия из памяти новее архивной
+        result.update(resident_items)
+        return list(result.items())
+
+    def eggs_sent_by(self, user_id):
+        """Возвращает [(egg_key, egg_info)] для яиц, отправленных пользователем"""
+        resident = [
+            (key, info) for key, info in list(self._state()['eggs_detail'].items())
+            if info.get('sender_id') == user_id
+        ]
+        return self._with_archived(self.archive.sent_by(user_id) if self.archive else (), resident)
+
+    def eggs_hatched_by(self, user_id):
+        """Возвращает [(egg_key, egg_info)] для яиц, вылупленных пользователем"""
+        resident = [
+            (key, info) for key, info in list(self._state()['eggs_detail'].items())
+            if info.get('hatched_by') == user_id
+        ]
+        return self._with_archived(self.archive.hatched_by(user_id) if self.archive else (), resident)
+
+    def hatched_keys_of_sender(self, user_id):
+        """Возвращает ключи вылупленных яиц отправителя, для которых нет детальной информации"""
+        state = self._state()
+        prefix = f'{user_id}_'
+        keys = [key for key in list(state['hatched_eggs']) if key.startswith(prefix)]
+        if self.archive is not None:
+            keys = list(set(keys).union(self.archive.hatched_keys_without_detail(user_id)))
+        return [key for key in keys if key not in state['eggs_detail']]
+
+    def egg_user_ids(self):
+        """Возвращает всех отправителей и вылупивших из детальной информации о яйцах"""
+        user_ids = set()
+        for info in list(self._state()['eggs_detail'].values()):
+            if info.get('sender_id'):
+                user_ids.add(info['sender_id'])
+            if info.get('hatched_by'):
+                user_ids.add(info['hatched_by'])
+        if self.archive is not None:
+            user_ids.update(self.archive.user_ids())
+        return user_ids
+
+    def count_hatched_eggs(self):
+        """Количество вылупленных обычных яиц"""
+        hatched = list(self._state()['hatched_eggs'])
+        if self.archive is None:
+            return len(hatched)
+        # Подгруженные обратно в память яйца есть и в архиве - не считаем их дважды
+        return len(hatched) + self.archive.count_hatched(exclude=hatched)
+
+
+class InMemoryStorage(StorageBackend):
+    """Хранилище только для чтения поверх готового словаря с данными
+
+    Используется Eggchain Explorer, когда он запущен без бота и читает файл сам.
+    """
+
+    name = 'memory'
+
+    def __init__(self, data, archive=None):
+        super().__init__()
+        state = get_default_data()
+        state.update(data)
+        state['hatched_eggs'] = set(state['hatched_eggs'])
+        self.attach(lambda: state)
+        self.archive = archive
+
+    def load(self):
+        return self._state()
+
+    def record(self, event, changes):
+        pass
+
+    def capture_checkpoint(self):
+        return None
+
+
+def _copy_record(value):
+    """Копия записи яйца: hatched_by_list обработчики меняют на месте"""
+    if value is None:
+        return None
+    return {k: (v.copy() if isinstance(v, list) else v) for k, v in value.items()}
+
+
+class JsonFileStorage(StorageBackend):
+    """Сегментированный JSON снимок + журнал изменений
+
+    data_file - старый снимок одним файлом, из него данные переносятся
+    в сегменты при первом запуске.
+    archive_dir - архив холодных яиц; без него все яйца остаются в памяти.
+    """
+
+    name = 'json'
+
+    def __init__(self, data_file, journal_file, snapshot_dir, fsync_interval=1.0,
+                 checkpoint_interval=60.0, checkpoint_max_pending=5000, snapshot_buckets=64,
+                 snapshot_format='json', archive_dir=None, archive_after_days=30):
+        super().__init__(checkpoint_interval, checkpoint_max_pending)
+        self.data_file = data_file
+        self.journal = EventJournal(journal_file, fsync_interval=fsync_interval)
+        self.snapshot = SegmentedSnapshot(
+            snapshot_dir, COLLECTIONS, buckets=snapshot_buckets, format=snapshot_format
+        )
+        if archive_dir is not None:
+            self.archive = EggArchive(archive_dir)
+        self.archive_after_days = archive_after_days
+        # Яйца, подгруженные из архива и с тех пор не менявшиеся
+        self._faulted = set()
+        # Яйца текущего переноса в архив и те из них, что изменились во время записи
+        self._moving = set()
+        self._moving_changed = set()
+        # Коллекции, замененные целиком во время переноса
+        self._moving_reset = set()
+        self.faulted_in = 0
+
+    def _load_snapshot(self):
+        """Загружает старый снимок из одного файла"""
+        data_file = self.data_file
+        logger.info(f"=== LOADING DATA ===")
+        logger.info(f"Loading data from: {data_file}")
+        logger.info(f"Current working directory: {os.getcwd()}")
+        logger.info(f"Volume /data exists: {os.path.exists('/data')}")
+        logger.info(f"Volume /data writable: {os.access('/data', os.W_OK) if os.path.exists('/data') else False}")
+        logger.info(f"File exists: {os.path.exists(data_file)}")
+
+        if os.path.exists(data_file):
+            file_size = os.path.getsize(data_file)
+            logger.info(f"Data file size: {file_size} bytes")
+            # Проверяем, что файл не пустой
+            if file_size == 0:
+                logger.error(f"CRITICAL: Data file {data_file} exists but is EMPTY (0 bytes)!")
+                logger.warning("Using default data - file will be overwritten on first save")
+                return get_default_data(), 0
+
+        if os.path.exists(data_file):
+            try:
+                # Файл разбирается потоково, по секциям: без копии всего текста в памяти,
+                # hatched_eggs собирается сразу в set
+                data = load_sections(data_file, set_sections=('hatched_eggs',))
+
+                # Логируем загруженные данные для отладки
+                egg_points_count = len(data.get('egg_points', {}))
+                referrers_count = len(data.get('referrers', {}))
+                hatched_eggs_count = len(data.get('hatched_eggs', []))
+                eggs_detail_count = len(data.get('eggs_detail', {}))
+                logger.info(f"=== DATA LOADED SUCCESSFULLY ===")
+                logger.info(f"Loaded data: {egg_points_count} users with points, {referrers_count} referrers")
+                logger.info(f"Hatched eggs: {hatched_eggs_count}, Eggs detail: {eggs_detail_count}")
+                logger.info(f"=== END LOADING ===")
+
+                state = {
+                    'hatched_eggs': data.get('hatched_eggs', set()),
+                    'eggs_hatched_by_user': data.get('eggs_hatched_by_user', {}),
+                    'user_eggs_hatched_by_others': data.get('user_eggs_hatched_by_others', {}),
+                    'eggs_sent_by_user': data.get('eggs_sent_by_user', {}),
+                    'daily_eggs_sent': data.get('daily_eggs_sent', {}),  # {user_id: {'date': '2024-01-01', 'count': 5}}
+                    'egg_points': data.get('egg_points', {}),
+                    'completed_tasks': data.get('completed_tasks', {}),
+                    'referrers': data.get('referrers', {}),  # {user_id: referrer_id} - кто привел пользователя
+                    'referral_earnings': data.get('referral_earnings', {}),  # {referrer_id: total_earned} - сколько заработал рефовод
+                    'ton_payments': data.get('ton_payments', {}),  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
+                    'eggs_detail': data.get('eggs_detail', {}),  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched, is_multi, max_hatches, hatched_count, hatched_by_list}}
+                    'multi_eggs': data.get('multi_eggs', {}),  # {egg_key: {hatched_by_list: [user_id1, user_id2, ...], hatched_count: int}}
+                    'admin_tasks': data.get('admin_tasks', [])  # [{id, name, avatar_url, channel, reward, created_at}]
+                }
+                # Последняя запись журнала, вошедшая в снимок
+                return state, data.get('journal_seq', 0)
+            except Exception as e:
+                logger.error(f"=== ERROR LOADING DATA ===")
+                logger.error(f"Error loading data from {data_file}: {e}", exc_info=True)
+                logger.error(f"File exists but corrupted or unreadable!")
+                logger.error(f"CRITICAL: Will NOT use default data to prevent data loss!")
+                logger.error(f"Trying to backup corrupted file and raise error...")
+
+                # Пытаемся создать backup поврежденного файла
+                try:
+                    backup_file = data_file + '.corrupted.' + str(int(time.time()))
+                    if os.path.exists(data_file):
+                        shutil.copy2(data_file, backup_file)
+                        logger.error(f"Corrupted file backed up to: {backup_file}")
+                except Exception as backup_error:
+                    logger.error(f"Failed to backup corrupted file: {backup_error}")
+
+                # НЕ возвращаем дефолтные данные - это приведет к потере данных!
+                # Вместо этого поднимаем исключение
+                raise RuntimeError(f"Failed to load data from {data_file}. File may be corrupted. Backup created if possible.")
+        else:
+            logger.error(f"=== DATA FILE NOT FOUND ===")
+            logger.error(f"Data file {data_file} does not exist!")
+            logger.error(f"Volume /data exists: {os.path.exists('/data')}")
+            logger.error(f"Volume /data writable: {os.access('/data', os.W_OK) if os.path.exists('/data') else False}")
+            logger.error("File does not exist - this is first run or data was lost")
+            logger.error(f"=== END LOADING (DEFAULT DATA) ===")
+            # Только если файла действительно нет - используем дефолт
+            return get_default_data(), 0
+
+    def load(self):
+        if self.snapshot.exists():
+            try:
+                state, journal_seq = self.snapshot.load()
+            except Exception as e:
+                logger.error(f"Error loading snapshot from {self.snapshot.directory}: {e}", exc_info=True)
+                # НЕ возвращаем дефолтные данные - это приведет к потере данных!
+                raise RuntimeError(f"Failed to load snapshot from {self.snapshot.directory}. Segments may be corrupted.")
+        else:
+            state, journal_seq = self._load_snapshot()
+            if os.path.exists(self.data_file):
+                # Переносим старый снимок в сегменты; bot_data.json остается как есть
+                logger.info(f"Migrating {self.data_file} to segmented snapshot in {self.snapshot.directory}")
+                self.snapshot.mark_all_dirty()
+                self.snapshot.write(state, journal_seq)
+
+        # Ключи пользователей приводятся к int до проигрывания журнала, чтобы
+        # записи журнала с int ключами перезаписывали, а не дублировали их
+        normalized = build_state(state)
+        if normalized:
+            self.snapshot.mark_changes([['r', collection] for collection in USER_KEYED_COLLECTIONS])
+
+        def replay_change(change):
+            apply_change(state, change)
+            self.snapshot.mark_changes([change])
+
+        # Проигрываем хвост журнала поверх снимка
+        replayed = self.journal.replay(journal_seq, replay_change)
+        if replayed:
+            logger.info(f"Replayed {replayed} journal entries on top of the snapshot")
+        self.dirty_after_load = replayed + normalized
+        return state
+
+    def record(self, event, changes):
+        # Сегменты помечаются до записи в журнал: если запись попадет в снимок
+        # по номеру, ее сегмент гарантированно будет переписан
+        self.snapshot.mark_changes(changes)
+        self.journal.append(event, changes)
+        if self.archive is not None:
+            for change in changes:
+                if change[1] not in ARCHIVE_FLAGS:
+                    continue
+                if change[0] == 'r':
+                    self.archive.reset(change[1])
+                    if self._moving:
+                        # Пачка в полете допишет в архив флаги, снятые до сброса:
+                        # ее яйца остаются в памяти, а сброс повторяется после записи
+                        self._moving_reset.add(change[1])
+                    continue
+                egg_key = change[2]
+                self._faulted.discard(egg_key)
+                if egg_key in self._moving:
+                    self._moving_changed.add(egg_key)
+
+    def capture_checkpoint(self):
+        """Сворачивает журнал в снимок, переписывая только измененные сегменты
+
+        В цикле событий только поворачивается журнал и снимаются копии измененных
+        сегментов; сериализация и fsync выполняются в возвращенной функции.
+        """
+        # Начинаем новый журнал: все записи до journal_seq уже отражены в памяти
+        journal_seq = self.journal.rotate()
+        captured = self.snapshot.capture(self._state(), journal_seq)
+
+        def write():
+            try:
+                self.snapshot.write_captured(captured)
+            except Exception as e:
+                logger.error(f"Error saving snapshot to {self.snapshot.directory}: {e}", exc_info=True)
+                # Пробрасываем ошибку, чтобы сохранятель вернул изменения в очередь
+                raise
+            # Снимок на месте - старый журнал больше не нужен
+            self.journal.discard_rotated()
+
+        return write
+
+    # Архив холодных яиц
+
+    def fault_in(self, egg_key):
+        if self.archive is None or self._is_resident(egg_key):
+            return False
+        egg = self.archive.get(egg_key)
+        if egg is None:
+            return False
+        state = self._state()
+        if egg.detail is not None:
+            state['eggs_detail'][egg_key] = egg.detail
+        if egg.multi is not None:
+            state['multi_eggs'][egg_key] = egg.multi
+        if egg.hatched:
+            state['hatched_eggs'].add(egg_key)
+        self._faulted.add(egg_key)
+        self.faulted_in += 1
+        return True
+
+    def _is_cold(self, egg_key, info, multi_data, hatched_eggs, cutoff):
+        """Яйцо больше не изменится (вылуплено полностью) или отправлено давно"""
+        if egg_key in hatched_eggs:
+            return True
+        if info.get('is_multi'):
+            hatched_count = (multi_data or info).get('hatched_count') or 0
+            if hatched_count >= (info.get('max_hatches') or 1):
+                return True
+        sent_at = info.get('timestamp_sent')
+        return sent_at is not None and sent_at < cutoff
+
+    def capture_cold_eggs(self, limit):
+        """Выбирает до limit холодных яиц в памяти и снимает их копии
+
+        Вызывается в цикле событий. Возвращает пачку для archive_eggs() и
+        drop_archived_eggs() или None, если переносить нечего.
+        """
+        if self.archive is None or self._moving:
+            return None
+        state = self._state()
+        details, multi, hatched = state['eggs_detail'], state['multi_eggs'], state['hatched_eggs']
+        # timestamp_sent хранится в isoformat, поэтому строки сравниваются как даты
+        cutoff = (datetime.now() - timedelta(days=self.archive_after_days)).isoformat()
+
+        keys = []
+        for egg_key, info in details.items():
+            if self._is_cold(egg_key, info, multi.get(egg_key), hatched, cutoff):
+                keys.append(egg_key)
+                if len(keys) >= limit:
+                    break
+        else:
+            # Старые вылупленные яйца без детальной информации
+            for egg_key in hatched:
+                if egg_key not in details:
+                    keys.append(egg_key)
+                    if len(keys) >= limit:
+                        break
+        if not keys:
+            return None
+
+        # Подгруженные из архива и не менявшиеся яйца там уже есть - их только убираем из памяти
+        eggs = [
+            ArchivedEgg(egg_key, _copy_record(details.get(egg_key)), _copy_record(multi.get(egg_key)), egg_key in hatched)
+            for egg_key in keys if egg_key not in self._faulted
+        ]
+        self._moving = set(keys)
+        self._moving_changed = set()
+        self._moving_reset = set()
+        return eggs, keys
+
+    def archive_eggs(self, batch):
+        """Дописывает пачку в архив (выполняется в отдельном потоке)"""
+        eggs, keys = batch
+        self.archive.append(eggs)
+
+    def release_cold_eggs(self, batch):
+        """Запись в архив не удалась - яйца остаются в памяти"""
+        self._reset_after_move()
+        self._moving = set()
+        self._moving_changed = set()
+
+    def drop_archived_eggs(self, batch):
+        """Убирает из памяти яйца, записанные в архив, и фиксирует это в журнале
+
+        Яйца, изменившиеся во время записи, остаются в памяти (в архиве у них
+        устаревшая копия, память главнее). Возвращает (перенесено яиц, изменений).
+        """
+        eggs, keys = batch
+        state = self._state()
+        changed = self._moving_changed
+        if self._moving_reset:
+            changed = set(keys)
+        self._reset_after_move()
+        self._moving = set()
+        self._moving_changed = set()
+
+        changes = []
+        moved = 0
+        for egg_key in keys:
+            if egg_key in changed:
+                continue
+            for collection in ('eggs_detail', 'multi_eggs'):
+                if state[collection].pop(egg_key, None) is not None:
+                    changes.append(['d', collection, egg_key])
+            if egg_key in state['hatched_eggs']:
+                state['hatched_eggs'].discard(egg_key)
+                changes.append(['d', 'hatched_eggs', egg_key])
+            self._faulted.discard(egg_key)
+            moved += 1
+        if changes:
+            self.record('eggs_archived', changes)
+        return moved, len(changes)
+
+    def _reset_after_move(self):
+        # Запись пачки могла вернуть флаги архива, снятые сбросом коллекции
+        for collection in self._moving_reset:
+            self.archive.reset(collection)
+        self._moving_reset = set()
+
+    def close(self):
+        self.journal.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def stats(self):
+        stats = {
+            'backend': self.name,
+            'journal': self.journal.stats(),
+            'snapshot': self.snapshot.stats()
+        }
+        if self.archive is not None:
+            stats['archive'] = dict(self.archive.stats(), faulted_in=self.faulted_in)
+        return stats
+
+
+# Колонки таблицы users для счетчиков пользователя
+USER_COLUMNS = USER_COUNTERS
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    points INTEGER,
+    hatched INTEGER,
+    hatched_by_others INTEGER,
+    sent INTEGER,
+    referral_earned INTEGER
+);
+CREATE TABLE IF NOT EXISTS daily_quota (
+    user_id INTEGER PRIMARY KEY,
+    date TEXT,
+    count INTEGER,
+    paid_eggs INTEGER
+);
+CREATE TABLE IF NOT EXISTS eggs (
+    egg_key TEXT PRIMARY KEY,
+    egg_id TEXT,
+    sender_id INTEGER,
+    hatched_by INTEGER,
+    timestamp_sent TEXT,
+    timestamp_hatched TEXT,
+    is_multi INTEGER NOT NULL DEFAULT 0,
+    max_hatches INTEGER,
+    hatched_count INTEGER,
+    in_detail INTEGER NOT NULL DEFAULT 0,
+    in_hatched INTEGER NOT NULL DEFAULT 0,
+    in_multi INTEGER NOT NULL DEFAULT 0,
+    multi_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS eggs_egg_id ON eggs(egg_id);
+CREATE INDEX IF NOT EXISTS eggs_sender ON eggs(sender_id);
+CREATE INDEX IF NOT EXISTS eggs_hatched_by ON eggs(hatched_by);
+CREATE TABLE IF NOT EXISTS hatches (
+    egg_key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (egg_key, pos)
+);
+CREATE INDEX IF NOT EXISTS hatches_user ON hatches(user_id);
+CREATE TABLE IF NOT EXISTS referrals (
+    user_id INTEGER PRIMARY KEY,
+    referrer_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS referrals_referrer ON referrals(referrer_id);
+CREATE TABLE IF NOT EXISTS payments (
+    user_id INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    tx_hash TEXT,
+    date TEXT,
+    amount REAL,
+    eggs INTEGER,
+    PRIMARY KEY (user_id, pos)
+);
+CREATE INDEX IF NOT EXISTS payments_tx ON payments(tx_hash);
+CREATE TABLE IF NOT EXISTS tasks (
+    user_id INTEGER NOT NULL,
+    task_key TEXT NOT NULL,
+    done INTEGER NOT NULL,
+    PRIMARY KEY (user_id, task_key)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Колонки eggs, которые соответствуют полям eggs_detail
+EGG_DETAIL_FIELDS = (
+    'egg_id', 'sender_id', 'hatched_by', 'timestamp_sent',
+    'timestamp_hatched', 'is_multi', 'max_hatches', 'hatched_count'
+)
+
+
+class SQLiteStorage(StorageBackend):
+    """Хранилище в SQLite
+
+    Изменения копятся в памяти и применяются к базе пакетом в одной транзакции
+    при checkpoint(). Вылупленные яйца не загружаются в память при старте и
+    подгружаются по требованию через fault_in().
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, db_file, checkpoint_interval=1.0, checkpoint_max_pending=500,
+                 legacy_storage=None):
+        super().__init__(checkpoint_interval, checkpoint_max_pending)
+        self.db_file = db_file
+        # Хранилище, из которого импортируются данные при первом запуске
+        self.legacy_storage = legacy_storage
+
+        # _db_lock защищает соединение, _pending_lock - очередь изменений,
+        # _checkpoint_lock гарантирует, что пакеты применяются строго по порядку
+        self._db_lock = threading.RLock()
+        self._pending_lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._pending = []
+        self.committed_batches = 0
+        self.committed_changes = 0
+        self.faulted_in = 0
+        self._closed = False
+
+        # Соединение используется и циклом событий, и потоком записи, поэтому защищено блокировкой
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SQLITE_SCHEMA)
+
+    # Применение изменений к базе
+
+    def _put_egg_row(self, cur, egg_key, **fields):
+        """Создает строку яйца, если ее нет, и обновляет переданные поля"""
+        cur.execute(
+            'INSERT OR IGNORE INTO eggs (egg_key, sender_id) VALUES (?, ?)',
+            (egg_key, sender_from_egg_key(egg_key))
+        )
+        if fields:
+            columns = ', '.join(f'{name} = ?' for name in fields)
+            cur.execute(f'UPDATE eggs SET {columns} WHERE egg_key = ?', (*fields.values(), egg_key))
+
+    def _put_hatches(self, cur, egg_key, hatched_by_list):
+        cur.execute('DELETE FROM hatches WHERE egg_key = ?', (egg_key,))
+        cur.executemany(
+            'INSERT INTO hatches (egg_key, pos, user_id) VALUES (?, ?, ?)',
+            [(egg_key, pos, user_id) for pos, user_id in enumerate(hatched_by_list or [])]
+        )
+
+    def _put(self, cur, collection, key, value):
+        if collection in USER_COLUMNS:
+            column = USER_COLUMNS[collection]
+            cur.execute(
+                f'INSERT INTO users (user_id, {column}) VALUES (?, ?) '
+                f'ON CONFLICT(user_id) DO UPDATE SET {column} = excluded.{column}',
+                (key, value)
+            )
+        elif collection == 'daily_eggs_sent':
+            cur.execute(
+                'INSERT OR REPLACE INTO daily_quota (user_id, date, count, paid_eggs) VALUES (?, ?, ?, ?)',
+                (key, value.get('date'), value.get('count', 0), value.get('paid_eggs', 0))
+            )
+        elif collection == 'completed_tasks':
+            cur.execute('DELETE FROM tasks WHERE user_id = ?', (key,))
+            cur.executemany(
+                'INSERT INTO tasks (user_id, task_key, done) VALUES (?, ?, ?)',
+                [(key, task_key, 1 if done else 0) for task_key, done in value.items()]
+            )
+        elif collection == 'referrers':
+            cur.execute('INSERT OR REPLACE INTO referrals (user_id, referrer_id) VALUES (?, ?)', (key, value))
+        elif collection == 'ton_payments':
+            cur.execute('DELETE FROM payments WHERE user_id = ?', (key,))
+            cur.executemany(
+                'INSERT INTO payments (user_id, pos, tx_hash, date, amount, eggs) VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (key, pos, p.get('tx_hash'), p.get('date'), p.get('amount'), p.get('eggs'))
+                    for pos, p in enumerate(value)
+                ]
+            )
+        elif collection == 'eggs_detail':
+            fields = {name: value.get(name) for name in EGG_DETAIL_FIELDS}
+            fields['is_multi'] = 1 if fields['is_multi'] else 0
+            self._put_egg_row(cur, key, in_detail=1, **fields)
+            self._put_hatches(cur, key, value.get('hatched_by_list'))
+        elif collection == 'multi_eggs':
+            self._put_egg_row(cur, key, in_multi=1, multi_count=value.get('hatched_count', 0))
+            self._put_hatches(cur, key, value.get('hatched_by_list'))
+        elif collection == 'hatched_eggs':
+            self._put_egg_row(cur, key, in_hatched=1)
+        elif collection == 'admin_tasks':
+            cur.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ('admin_tasks', json.dumps(value, ensure_ascii=False))
+            )
+
+    def _delete(self, cur, collection, key):
+        if collection in USER_COLUMNS:
+            cur.execute(f'UPDATE users SET {USER_COLUMNS[collection]} = NULL WHERE user_id = ?', (key,))
+        elif collection == 'daily_eggs_sent':
+            cur.execute('DELETE FROM daily_quota WHERE user_id = ?', (key,))
+        elif collection == 'completed_tasks':
+            cur.execute('DELETE FROM tasks WHERE user_id = ?', (key,))
+        elif collection == 'referrers':
+            cur.execute('DELETE FROM referrals WHERE user_id = ?', (key,))
+        elif collection == 'ton_payments':
+            cur.execute('DELETE FROM payments WHERE user_id = ?', (key,))
+        elif collection == 'eggs_detail':
+            cur.execute('UPDATE eggs SET in_detail = 0 WHERE egg_key = ?', (key,))
+        elif collection == 'multi_eggs':
+            cur.execute('UPDATE eggs SET in_multi = 0, multi_count = NULL WHERE egg_key = ?', (key,))
+        elif collection == 'hatched_eggs':
+            cur.execute('UPDATE eggs SET in_hatched = 0 WHERE egg_key = ?', (key,))
+
+    def _replace(self, cur, collection, value):
+        # Сначала очищаем коллекцию целиком, затем записываем новые значения
+        if collection in USER_COLUMNS:
+            cur.execute(f'UPDATE users SET {USER_COLUMNS[collection]} = NULL')
+        elif collection == 'daily_eggs_sent':
+            cur.execute('DELETE FROM daily_quota')
+        elif collection == 'completed_tasks':
+            cur.execute('DELETE FROM tasks')
+        elif collection == 'referrers':
+            cur.execute('DELETE FROM referrals')
+        elif collection == 'ton_payments':
+            cur.execute('DELETE FROM payments')
+        elif collection == 'eggs_detail':
+            cur.execute('UPDATE eggs SET in_detail = 0')
+        elif collection == 'multi_eggs':
+            cur.execute('UPDATE eggs SET in_multi = 0, multi_count = NULL')
+        elif collection == 'hatched_eggs':
+            cur.execute('UPDATE eggs SET in_hatched = 0')
+            for key in value:
+                self._put(cur, collection, key, 1)
+            return
+        elif collection == 'admin_tasks':
+            self._put(cur, collection, None, value)
+            return
+        for key, item in value.items():
+            self._put(cur, collection, key, item)
+
+    def _apply(self, cur, change):
+        op, collection = change[0], change[1]
+        if op == 'p':
+            self._put(cur, collection, change[2], change[3])
+        elif op == 'd':
+            self._delete(cur, collection, change[2])
+        elif op == 'r':
+            self._replace(cur, collection, change[2])
+
+    def _commit(self, batches):
+        """Применяет пакет изменений в одной транзакции"""
+        with self._db_lock:
+            cur = self._conn.cursor()
+            cur.execute('BEGIN')
+            try:
+                for changes in batches:
+                    for change in changes:
+                        self._apply(cur, change)
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+
+    # Интерфейс StorageBackend
+
+    def _is_empty(self):
+        with self._db_lock:
+            row = self._conn.execute(
+                'SELECT (SELECT COUNT(*) FROM users) + (SELECT COUNT(*) FROM eggs) + (SELECT COUNT(*) FROM meta)'
+            ).fetchone()
+        return row[0] == 0
+
+    def _import_legacy(self):
+        """Переносит данные из старого хранилища при первом запуске"""
+        logger.info(f"SQLite storage {self.db_file} is empty, importing data from {self.legacy_storage.name} storage")
+        started = time.perf_counter()
+        state = self.legacy_storage.load()
+        self._commit([[['r', collection, state[collection]] for collection in COLLECTIONS]])
+        archived = 0
+        if self.legacy_storage.archive is not None:
+            archived = self._import_archive(self.legacy_storage.archive, state)
+        self.legacy_storage.close()
+        logger.info(
+            f"Imported legacy data into SQLite in {time.perf_counter() - started:.2f}s "
+            f"({archived} archived eggs)"
+        )
+
+    def _import_archive(self, archive, state, batch_size=1000):
+        """Переносит яйца из архива холодных яиц (в load() старого хранилища их нет)"""
+        imported = 0
+        changes = []
+        for egg in archive.iter_all():
+            # Версия из памяти новее архивной - ее уже записал импорт коллекций
+            if egg.detail is not None and egg.egg_key not in state['eggs_detail']:
+                changes.append(['p', 'eggs_detail', egg.egg_key, egg.detail])
+            if egg.multi is not None and egg.egg_key not in state['multi_eggs']:
+                changes.append(['p', 'multi_eggs', egg.egg_key, egg.multi])
+            if egg.hatched:
+                changes.append(['p', 'hatched_eggs', egg.egg_key, 1])
+            imported += 1
+            if len(changes) >= batch_size:
+                self._commit([changes])
+                changes = []
+        if changes:
+            self._commit([changes])
+        return imported
+
+    def load(self):
+        if self.legacy_storage is not None and self._is_empty():
+            self._import_legacy()
+
+        started = time.perf_counter()
+        state = get_default_data()
+        with self._db_lock:
+            conn = self._conn
+            for user_id, points, hatched, hatched_by_others, sent, referral_earned in conn.execute(
+                'SELECT user_id, points, hatched, hatched_by_others, sent, referral_earned FROM users'
+            ):
+                for collection, value in (
+                    ('egg_points', points),
+                    ('eggs_hatched_by_user', hatched),
+                    ('user_eggs_hatched_by_others', hatched_by_others),
+                    ('eggs_sent_by_user', sent),
+                    ('referral_earnings', referral_earned)
+                ):
+                    if value is not None:
+                        state[collection][user_id] = value
+            for user_id, day, count, paid_eggs in conn.execute(
+                'SELECT user_id, date, count, paid_eggs FROM daily_quota'
+            ):
+                state['daily_eggs_sent'][user_id] = {'date': day, 'count': count, 'paid_eggs': paid_eggs}
+            for user_id, task_key, done in conn.execute('SELECT user_id, task_key, done FROM tasks'):
+                state['completed_tasks'].setdefault(user_id, {})[task_key] = bool(done)
+            for user_id, referrer_id in conn.execute('SELECT user_id, referrer_id FROM referrals'):
+                state['referrers'][user_id] = referrer_id
+            for user_id, tx_hash, day, amount, eggs in conn.execute(
+                'SELECT user_id, tx_hash, date, amount, eggs FROM payments ORDER BY user_id, pos'
+            ):
+                state['ton_payments'].setdefault(user_id, []).append(
+                    {'date': day, 'amount': amount, 'tx_hash': tx_hash, 'eggs': eggs}
+                )
+            row = conn.execute("SELECT value FROM meta WHERE key = 'admin_tasks'").fetchone()
+            if row:
+                state['admin_tasks'] = json.loads(row[0])
+
+            # В память попадают только яйца, которые еще можно вылупить
+            rows = conn.execute(
+                'SELECT * FROM eggs WHERE in_hatched = 0 AND ('
+                '(is_multi = 0 AND in_detail = 1) OR '
+                '(is_multi = 1 AND COALESCE(multi_count, hatched_count, 0) < COALESCE(max_hatches, 1)))'
+            ).fetchall()
+            columns = [d[0] for d in conn.execute('SELECT * FROM eggs LIMIT 0').description]
+        rows = [dict(zip(columns, row)) for row in rows]
+        hatches = self._hatches_for([row['egg_key'] for row in rows])
+        for row in rows:
+            self._put_row_in_state(state, row, hatches[row['egg_key']])
+
+        build_state(state)
+        logger.info(
+            f"Loaded SQLite storage {self.db_file} in {time.perf_counter() - started:.2f}s: "
+            f"{len(state['egg_points'])} users with points, {len(state['referrers'])} referrers, "
+            f"{len(state['eggs_detail'])} pending eggs resident in memory"
+        )
+        return state
+
+    def _hatches_for(self, egg_keys):
+        """Возвращает {egg_key: [user_id, ...]} для списка яиц"""
+        result = {key: [] for key in egg_keys}
+        if not egg_keys:
+            return result
+        with self._db_lock:
+            for start in range(0, len(egg_keys), 500):
+                chunk = egg_keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for egg_key, user_id in self._conn.execute(
+                    f'SELECT egg_key, user_id FROM hatches WHERE egg_key IN ({placeholders}) ORDER BY egg_key, pos',
+                    chunk
+                ):
+                    result[egg_key].append(user_id)
+        return result
+
+    def _row_to_detail(self, row, hatched_by_list):
+        detail = {name: row[name] for name in EGG_DETAIL_FIELDS}
+        detail['is_multi'] = bool(row['is_multi'])
+        detail['hatched_by_list'] = list(hatched_by_list)
+        return detail
+
+    def _put_row_in_state(self, state, row, hatched_by_list=None):
+        """Кладет яйцо из строки базы в коллекции состояния в памяти"""
+        egg_key = row['egg_key']
+        if hatched_by_list is None:
+            hatched_by_list = self._hatches_for([egg_key])[egg_key]
+        if row['in_detail']:
+            state['eggs_detail'][egg_key] = self._row_to_detail(row, hatched_by_list)
+        if row['in_multi']:
+            state['multi_eggs'][egg_key] = {
+                'hatched_by_list': list(hatched_by_list),
+                'hatched_count': row['multi_count'] or 0
+            }
+        if row['in_hatched']:
+            state['hatched_eggs'].add(egg_key)
+
+    def _select_eggs(self, where, params):
+        with self._db_lock:
+            cur = self._conn.execute(f'SELECT * FROM eggs WHERE {where}', params)
+            columns = [d[0] for d in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def fault_in(self, egg_key):
+        if self._is_resident(egg_key):
+            return False
+        rows = self._select_eggs('egg_key = ?', (egg_key,))
+        if not rows:
+            return False
+        self._put_row_in_state(self._state(), rows[0])
+        self.faulted_in += 1
+        return True
+
+    def record(self, event, changes):
+        with self._pending_lock:
+            self._pending.append(changes)
+
+    def capture_checkpoint(self):
+        # Изменения уже накоплены в record(); транзакция выполняется целиком в фоне
+        return self.checkpoint
+
+    def checkpoint(self):
+        """Применяет накопленные изменения к базе одной транзакцией"""
+        with self._checkpoint_lock:
+            with self._pending_lock:
+                batches, self._pending = self._pending, []
+            if not batches:
+                return
+            try:
+                self._commit(batches)
+            except Exception:
+                # Возвращаем изменения в очередь, чтобы повторить при следующем сбросе
+                with self._pending_lock:
+                    self._pending = batches + self._pending
+                raise
+            self.committed_batches += 1
+            self.committed_changes += len(batches)
+
+    def export_data(self):
+        """Собирает полный снимок из базы (включая яйца, которых нет в памяти)"""
+        self.checkpoint()
+        state = get_default_data()
+        resident = self._state()
+        for collection in COLLECTIONS:
+            if collection not in ('eggs_detail', 'multi_eggs', 'hatched_eggs'):
+                state[collection] = resident[collection]
+        rows = self._select_eggs('1', ())
+        hatches = self._hatches_for([row['egg_key'] for row in rows])
+        for row in rows:
+            self._put_row_in_state(state, row, hatches[row['egg_key']])
+        return serialize_state(state)
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.checkpoint()
+        finally:
+            with self._db_lock:
+                self._conn.close()
+                self._closed = True
+
+    def stats(self):
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {
+            'backend': self.name,
+            'pending_batches': pending,
+            'committed_batches': self.committed_batches,
+            'committed_changes': self.committed_changes,
+            'faulted_in': self.faulted_in
+        }
+
+    # Поиск яиц: сначала память (там самые свежие данные), затем индексы базы
+
+    def get_egg_detail(self, egg_key):
+        info = super().get_egg_detail(egg_key)
+        if info is not None:
+            return info
+        rows = self._select_eggs('egg_key = ? AND in_detail = 1', (egg_key,))
+        if not rows:
+            return None
+        return self._row_to_detail(rows[0], self._hatches_for([egg_key])[egg_key])
+
+    def find_egg_key(self, egg_id):
+        rows = self._select_eggs('egg_id = ? AND in_detail = 1 LIMIT 1', (egg_id,))
+        if rows:
+            return rows[0]['egg_key']
+        return super().find_egg_key(egg_id)
+
+    def is_hatched(self, egg_key):
+        if super().is_hatched(egg_key):
+            return True
+        return bool(self._select_eggs('egg_key = ? AND in_hatched = 1', (egg_key,)))
+
+    def find_hatched_key(self, egg_id):
+        key = super().find_hatched_key(egg_id)
+        if key is not None:
+            return key
+        # Ключ имеет вид {sender_id}_{egg_id}, поэтому ищем по egg_id или по суффиксу ключа
+        rows = self._select_eggs(
+            "in_hatched = 1 AND (egg_id = ? OR egg_key LIKE ? ESCAPE '\\') LIMIT 1",
+            (egg_id, '%\\_' + egg_id.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        )
+        return rows[0]['egg_key'] if rows else None
+
+    def get_multi_egg(self, egg_key):
+        data = super().get_multi_egg(egg_key)
+        if data is not None:
+            return data
+        rows = self._select_eggs('egg_key = ? AND in_multi = 1', (egg_key,))
+        if not rows:
+            return None
+        return {
+            'hatched_by_list': self._hatches_for([egg_key])[egg_key],
+            'hatched_count': rows[0]['multi_count'] or 0
+        }
+
+    def _merge_with_resident(self, rows, resident_items):
+        hatches = self._hatches_for([row['egg_key'] for row in rows])
+        result = {row['egg_key']: self._row_to_detail(row, hatches[row['egg_key']]) for row in rows}
+        # Версия из памяти новее той, что в базе
+        result.update(resident_items)
+        return list(result.items())
+
+    def eggs_sent_by(self, user_id):
+        rows = self._select_eggs('sender_id = ? AND in_detail = 1', (user_id,))
+        return self._merge_with_resident(rows, super().eggs_sent_by(user_id))
+
+    def eggs_hatched_by(self, user_id):
+        rows = self._select_eggs('hatched_by = ? AND in_detail = 1', (user_id,))
+        return self._merge_with_resident(rows, super().eggs_hatched_by(user_id))
+
+    def hatched_keys_of_sender(self, user_id):
+        rows = self._select_eggs('sender_id = ? AND in_hatched = 1 AND in_detail = 0', (user_id,))
+        keys = {row['egg_key'] for row in rows}
+        keys.update(super().hatched_keys_of_sender(user_id))
+        return [key for key in keys if key not in self._state()['eggs_detail']]
+
+    def egg_user_ids(self):
+        user_ids = super().egg_user_ids()
+        with self._db_lock:
+            for (user_id,) in self._conn.execute(
+                'SELECT sender_id FROM eggs WHERE in_detail = 1 AND sender_id IS NOT NULL '
+                'UNION SELECT hatched_by FROM eggs WHERE in_detail = 1 AND hatched_by IS NOT NULL'
+            ):
+                user_ids.add(user_id)
+        return user_ids
+
+    def count_hatched_eggs(self):
+        # Сначала дописываем в базу вылупления, которые пока есть только в памяти
+        self.checkpoint()
+        with self._db_lock:
+            row = self._conn.execute('SELECT COUNT(*) FROM eggs WHERE in_hatched = 1').fetchone()
+        return row[0]
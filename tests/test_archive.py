@@ -0,0 +1,55 @@
+"""ColdEggMover: ошибки отдельной пачки не останавливают перенос"""
+
+import asyncio
+
+from archive import ColdEggMover
+
+
+class FailingStorage:
+    """Хранилище, у которого падает выбор холодных яиц"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def capture_cold_eggs(self, limit):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError('capture failed')
+        return None
+
+
+def test_mover_survives_failed_runs():
+    async def main():
+        storage = FailingStorage(failures=2)
+        mover = ColdEggMover(storage, interval=0.01)
+        mover.start()
+
+        async def runs():
+            while storage.calls < 4 and not mover._task.done():
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(runs(), timeout=5)
+        assert not mover._task.done()
+        await mover.stop()
+        return mover
+
+    mover = asyncio.run(main())
+    assert mover.errors == 2
+
+
+def test_stop_does_not_raise_for_dead_task():
+    async def main():
+        mover = ColdEggMover(FailingStorage(failures=0), interval=60)
+        mover.start()
+
+        async def dead():
+            raise RuntimeError('task died')
+
+        mover._task.cancel()
+        mover._task = asyncio.get_running_loop().create_task(dead())
+        await asyncio.sleep(0)
+        await mover.stop()
+        assert mover._task is None
+
+    asyncio.run(main())
@@ -0,0 +1,154 @@
+"""Журнал + сегментированный снимок: восстановление после падения процесса"""
+
+import json
+import os
+import random
+
+import pytest
+
+from journal import EventJournal
+from state import build_state
+from storage import JsonFileStorage, apply_change, get_default_data, serialize_state
+
+
+def open_storage(directory, snapshot_format='json'):
+    storage = JsonFileStorage(
+        str(directory / 'bot_data.json'),
+        str(directory / 'bot_data.journal'),
+        str(directory / 'bot_data.snapshot'),
+        fsync_interval=0,
+        snapshot_buckets=4,
+        snapshot_format=snapshot_format
+    )
+    state = storage.load()
+    storage.attach(lambda: state)
+    return storage, state
+
+
+def crash(storage):
+    """Падение процесса: ни checkpoint, ни close (записи журнала уже переданы ОС)"""
+    if storage.journal._file is not None:
+        storage.journal._file.close()
+        storage.journal._file = None
+
+
+def plain(state):
+    data = serialize_state(state)
+    data['hatched_eggs'] = sorted(data['hatched_eggs'])
+    return json.loads(json.dumps(data, sort_keys=True))
+
+
+def random_change(rng):
+    user_id = rng.randint(1, 30)
+    egg_key = f'{user_id}_egg{rng.randint(1, 40)}'
+    kind = rng.randint(0, 7)
+    if kind == 0:
+        return ['d', rng.choice(['egg_points', 'eggs_sent_by_user', 'referrers']), user_id]
+    if kind == 1:
+        return ['p', 'referrers', user_id, rng.randint(31, 40)]
+    if kind == 2:
+        return ['p', 'hatched_eggs', egg_key, 1]
+    if kind == 3:
+        return ['d', 'hatched_eggs', egg_key]
+    if kind == 4:
+        return ['p', 'eggs_detail', egg_key, {
+            'sender_id': user_id, 'egg_id': egg_key.split('_', 1)[1], 'hatched_by': None,
+            'timestamp_sent': '2026-01-01T00:00:00', 'timestamp_hatched': None,
+            'is_multi': False, 'max_hatches': 1, 'hatched_count': 0, 'hatched_by_list': []
+        }]
+    if kind == 5:
+        return ['d', 'eggs_detail', egg_key]
+    if kind == 6:
+        return ['r', 'admin_tasks', [{'id': rng.randint(1, 5), 'reward': rng.randint(1, 9)}]]
+    return ['p', rng.choice(['egg_points', 'eggs_sent_by_user']), user_id, rng.randint(1, 100)]
+
+
+def record(storage, state, reference, rng, count):
+    for _ in range(count):
+        changes = [random_change(rng) for _ in range(rng.randint(1, 3))]
+        for change in changes:
+            apply_change(state, change)
+            apply_change(reference, change)
+        storage.record('test', changes)
+
+
+def new_reference():
+    reference = get_default_data()
+    build_state(reference)
+    return reference
+
+
+@pytest.mark.parametrize('snapshot_format', ['json', 'binary'])
+@pytest.mark.parametrize('seed', range(3))
+def test_crash_without_checkpoint_replays_journal(tmp_path, snapshot_format, seed):
+    rng = random.Random(seed)
+    reference = new_reference()
+    storage, state = open_storage(tmp_path, snapshot_format)
+    record(storage, state, reference, rng, 200)
+    storage.checkpoint()
+    record(storage, state, reference, rng, 200)
+    crash(storage)
+
+    storage, state = open_storage(tmp_path, snapshot_format)
+    assert plain(state) == plain(reference)
+    assert storage.journal.entries_since_compaction == 200
+
+
+def test_crash_between_rotation_and_snapshot_write(tmp_path):
+    rng = random.Random(7)
+    reference = new_reference()
+    storage, state = open_storage(tmp_path)
+    record(storage, state, reference, rng, 100)
+    storage.checkpoint()
+    record(storage, state, reference, rng, 100)
+    # Журнал повернут, но снимок записать не успели
+    storage.capture_checkpoint()
+    record(storage, state, reference, rng, 50)
+    crash(storage)
+    assert os.path.exists(storage.journal.rotated_path)
+
+    storage, state = open_storage(tmp_path)
+    assert plain(state) == plain(reference)
+    # Следующая компактизация дописывает журнал к неудаленному повернутому
+    record(storage, state, reference, rng, 20)
+    storage.capture_checkpoint()
+    crash(storage)
+
+    storage, state = open_storage(tmp_path)
+    assert plain(state) == plain(reference)
+    storage.checkpoint()
+    assert not os.path.exists(storage.journal.rotated_path)
+    storage.close()
+
+    storage, state = open_storage(tmp_path)
+    assert plain(state) == plain(reference)
+    assert storage.journal.entries_since_compaction == 0
+    # Номера новых записей продолжают журнал, а не начинаются заново
+    assert storage.journal.seq == 270
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    rng = random.Random(3)
+    reference = new_reference()
+    storage, state = open_storage(tmp_path)
+    record(storage, state, reference, rng, 30)
+    storage.close()
+    with open(storage.journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"s":31,"e":"test","c":[["p","egg_points",1')
+
+    storage, state = open_storage(tmp_path)
+    assert plain(state) == plain(reference)
+    assert storage.journal.entries_since_compaction == 30
+
+
+def test_replay_skips_entries_in_snapshot(tmp_path):
+    journal = EventJournal(str(tmp_path / 'journal'), fsync_interval=0)
+    for seq in range(1, 6):
+        journal.append('test', [['p', 'egg_points', seq, seq]])
+    journal.close()
+
+    replayed = []
+    journal = EventJournal(str(tmp_path / 'journal'))
+    assert journal.replay(3, replayed.append) == 2
+    assert replayed == [['p', 'egg_points', 4, 4], ['p', 'egg_points', 5, 5]]
+    assert journal.seq == 5
@@ -0,0 +1,65 @@
+"""Потоковая загрузка bot_data.json: результат не зависит от размера куска"""
+
+import json
+import random
+
+import pytest
+
+from json_stream import load_sections
+
+
+def random_value(rng, depth=0):
+    kind = rng.randint(0, 7 if depth < 3 else 4)
+    if kind == 0:
+        return rng.randint(-10 ** 12, 10 ** 12)
+    if kind == 1:
+        return rng.choice([-2.5, 1e10, 1.5e-3, -0.0, 12345.678, 6.02e+23, rng.uniform(-1e6, 1e6)])
+    if kind == 2:
+        return rng.choice(['', 'egg', 'Яйцо 🥚', 'quote " and \\\\ backslash', '\\u0000 tab\\t'])
+    if kind == 3:
+        return rng.choice([True, False, None])
+    if kind == 4:
+        return f'{rng.randint(1, 10 ** 9)}_{rng.randint(1, 10 ** 6)}'
+    if kind == 5:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {f'k{rng.randint(0, 50)}': random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))}
+
+
+def sample_document(rng):
+    return {
+        'hatched_eggs': [f'{user_id}_egg{user_id * 7}' for user_id in range(40)],
+        'egg_points': {str(user_id): rng.randint(0, 10 ** 6) for user_id in range(60)},
+        'ton_payments': {'5': [{'date': '2026-01-01', 'amount': 0.125, 'eggs': 10, 'tx_hash': 'h'}]},
+        'random': {f'r{i}': random_value(rng) for i in range(30)},
+        'admin_tasks': [],
+        'journal_seq': 123456,
+        'price': -2.5,
+        'scale': 1e10
+    }
+
+
+@pytest.mark.parametrize('chunk_size', list(range(1, 18)) + [64, 1000])
+def test_small_chunks_match_json_load(tmp_path, chunk_size):
+    document = sample_document(random.Random(chunk_size))
+    path = tmp_path / 'bot_data.json'
+    for indent in (None, 2):
+        path.write_text(json.dumps(document, ensure_ascii=False, indent=indent), encoding='utf-8')
+        data = load_sections(str(path), set_sections=('hatched_eggs',), chunk_size=chunk_size)
+        expected = json.loads(path.read_text(encoding='utf-8'))
+        expected['hatched_eggs'] = set(expected['hatched_eggs'])
+        assert data == expected
+
+
+@pytest.mark.parametrize('text', ['{"a": -2.5}', '{"a": 1e10}', '{"a": 1E-7, "b": 3}', '{"a": [0.5, -1e+2]}'])
+def test_numbers_split_across_chunks(tmp_path, text):
+    path = tmp_path / 'bot_data.json'
+    path.write_text(text, encoding='utf-8')
+    for chunk_size in range(1, len(text) + 1):
+        assert load_sections(str(path), chunk_size=chunk_size) == json.loads(text)
+
+
+def test_truncated_file_is_rejected(tmp_path):
+    path = tmp_path / 'bot_data.json'
+    path.write_text('{"egg_points": {"1": 5, "2": ', encoding='utf-8')
+    with pytest.raises(ValueError):
+        load_sections(str(path), chunk_size=4)
@@ -0,0 +1,80 @@
+"""Leaderboard против эталона: полной сортировки на каждый запрос"""
+
+import random
+
+import pytest
+
+from leaderboard import Leaderboard
+
+
+def reference_rows(points):
+    """Таблица полным перебором: [(rank, user_id, points)] со "спортивными" местами"""
+    ordered = sorted((-value, user_id) for user_id, value in points.items() if value > 0)
+    rows = []
+    for position, (score, user_id) in enumerate(ordered):
+        if position and ordered[position - 1][0] == score:
+            rank = rows[-1][0]
+        else:
+            rank = position + 1
+        rows.append((rank, user_id, -score))
+    return rows
+
+
+def check(board, points, rng):
+    rows = reference_rows(points)
+    assert len(board) == len(rows)
+    ranks = {user_id: rank for rank, user_id, _ in rows}
+    for user_id in list(points)[:50] + [rng.randint(0, 300)]:
+        assert board.rank(user_id) == ranks.get(user_id)
+        assert board.points(user_id) == max(points.get(user_id, 0), 0)
+    for _ in range(5):
+        offset = rng.randint(0, len(rows) + 2)
+        limit = rng.randint(0, 40)
+        assert board.page(offset, limit) == rows[offset:offset + limit]
+    assert board.page(0, len(rows) + 1) == rows
+    # Дерево Фенвика согласовано с блоками
+    assert [board._prefix(i) for i in range(len(board._blocks) + 1)] == \
+        [sum(len(block) for block in board._blocks[:i]) for i in range(len(board._blocks) + 1)]
+
+
+@pytest.mark.parametrize('load', [2, 3, 8, 512])
+@pytest.mark.parametrize('seed', range(5))
+def test_random_updates_match_reference(load, seed):
+    rng = random.Random(seed * 1000 + load)
+    board = Leaderboard(load=load)
+    points = {}
+    initial = [(user_id, rng.choice([0, rng.randint(1, 20)])) for user_id in range(rng.randint(0, 120))]
+    board.load_from(initial)
+    points.update(initial)
+    check(board, points, rng)
+
+    for step in range(600):
+        user_id = rng.randint(0, 200)
+        # Небольшой диапазон поинтов - много равных мест
+        value = rng.choice([0, None, rng.randint(1, 15), points.get(user_id, 0) + rng.randint(1, 3)])
+        board.set(user_id, value)
+        points[user_id] = value or 0
+        if step % 37 == 0:
+            check(board, points, rng)
+    check(board, points, rng)
+
+
+def test_ties_share_rank():
+    board = Leaderboard(load=2)
+    board.load_from([(1, 10), (2, 20), (3, 20), (4, 5), (5, 0)])
+    assert board.page() == [(1, 2, 20), (1, 3, 20), (3, 1, 10), (4, 4, 5)]
+    assert board.rank(3) == 1
+    assert board.rank(4) == 4
+    assert board.rank(5) is None
+    # Страница с середины группы равных берет место первого из них
+    assert board.page(1, 2) == [(1, 3, 20), (3, 1, 10)]
+
+
+def test_remove_all_users():
+    board = Leaderboard(load=2)
+    board.load_from([(user_id, user_id) for user_id in range(1, 10)])
+    for user_id in range(1, 10):
+        board.set(user_id, 0)
+    assert len(board) == 0
+    assert board.page() == []
+    assert board.stats()['blocks'] == 0
@@ -0,0 +1,75 @@
+"""Бинарный формат снимка: кодирование и разбор без потерь"""
+
+import json
+
+import pytest
+
+import snapshot_codec
+from snapshot_codec import SnapshotFormatError, decode, encode
+
+
+def sample_sections():
+    return {
+        'hatched_eggs': ['1_a', '2_b', '3_c'],
+        'eggs_detail': {
+            '1_a': {'sender_id': 1, 'egg_id': 'a', 'hatched_by': 2, 'timestamp_sent': '2026-01-01T00:00:00',
+                    'timestamp_hatched': '2026-01-01T00:01:00', 'is_multi': False, 'max_hatches': 1,
+                    'hatched_count': 1, 'hatched_by_list': [2]},
+            # Другой набор полей - отдельная форма в колонках
+            '2_b': {'sender_id': 2, 'egg_id': 'b', 'hatched_by': None, 'is_multi': True},
+            '4_d': {}
+        },
+        'multi_eggs': {'2_b': {'hatched_by_list': [5, 6], 'hatched_count': 2}},
+        'egg_points': {1: 10, 2: 0, 3: -1, 10 ** 12: 7},
+        'daily_eggs_sent': {1: {'date': '2026-01-01', 'count': 3, 'paid_eggs': 0}},
+        'completed_tasks': {1: {'channel_x': True}},
+        'referrers': {2: 1},
+        'ton_payments': {1: [{'date': '2026-01-01', 'amount': 0.5, 'tx_hash': 'h', 'eggs': 10}]},
+        'admin_tasks': [{'id': 1, 'name': 'Задание 🥚', 'reward': 5}],
+        'empty': {},
+        'journal_seq': 42
+    }
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(compress):
+    sections = sample_sections()
+    blob = encode(sections, compress=compress)
+    assert snapshot_codec.is_binary(blob)
+    assert decode(blob) == sections
+
+
+def test_uniform_records_stored_by_columns():
+    records = {user_id: {'date': '2026-01-01', 'count': user_id, 'paid_eggs': 0} for user_id in range(100)}
+    blob = encode({'daily_eggs_sent': records})
+    # Имена полей записаны один раз на форму, а не в каждой записи
+    assert blob.count(b'paid_eggs') == 1
+    assert decode(blob) == {'daily_eggs_sent': records}
+
+
+@pytest.mark.parametrize('damage', ['magic', 'truncated', 'checksum'])
+def test_damaged_file_is_rejected(damage):
+    blob = bytearray(encode(sample_sections()))
+    if damage == 'magic':
+        blob[0:4] = b'JSON'
+    elif damage == 'truncated':
+        del blob[-5:]
+    else:
+        blob[-1] ^= 0xFF
+    with pytest.raises(SnapshotFormatError):
+        decode(bytes(blob))
+
+
+def test_json_conversion_round_trip(tmp_path):
+    sections = sample_sections()
+    sections['hatched_eggs'] = set(sections['hatched_eggs'])
+    (tmp_path / 'a.bin').write_bytes(encode(sections, compress=True))
+
+    snapshot_codec.binary_to_json(str(tmp_path / 'a.bin'), str(tmp_path / 'a.json'))
+    snapshot_codec.json_to_binary(str(tmp_path / 'a.json'), str(tmp_path / 'b.bin'))
+    restored = decode((tmp_path / 'b.bin').read_bytes())
+
+    # JSON превращает ключи пользователей в строки - так же, как bot_data.json
+    expected = json.loads(json.dumps(dict(sections, hatched_eggs=sorted(sections['hatched_eggs']))))
+    restored['hatched_eggs'] = sorted(restored['hatched_eggs'])
+    assert restored == expected
@@ -0,0 +1,64 @@
+"""Переход с JSON хранилища на SQLite: яйца из архива не теряются"""
+
+from datetime import datetime, timedelta
+
+from storage import JsonFileStorage, SQLiteStorage, apply_change
+
+
+def json_storage(directory):
+    return JsonFileStorage(
+        str(directory / 'bot_data.json'),
+        str(directory / 'bot_data.journal'),
+        str(directory / 'bot_data.snapshot'),
+        fsync_interval=0,
+        snapshot_buckets=4,
+        archive_dir=str(directory / 'archive')
+    )
+
+
+def egg_detail(sender_id, egg_id, hatched_by, sent_at):
+    return {
+        'sender_id': sender_id, 'egg_id': egg_id, 'hatched_by': hatched_by,
+        'timestamp_sent': sent_at, 'timestamp_hatched': sent_at if hatched_by else None,
+        'is_multi': False, 'max_hatches': 1, 'hatched_count': 1 if hatched_by else 0,
+        'hatched_by_list': [hatched_by] if hatched_by else []
+    }
+
+
+def test_archived_eggs_survive_switch_to_sqlite(tmp_path):
+    storage = json_storage(tmp_path)
+    state = storage.load()
+    storage.attach(lambda: state)
+    old = (datetime.now() - timedelta(days=60)).isoformat()
+    changes = [
+        ['p', 'eggs_detail', '1_old', egg_detail(1, 'old', 2, old)],
+        ['p', 'hatched_eggs', '1_old', 1],
+        ['p', 'hatched_eggs', '9_legacy', 1],
+        ['p', 'eggs_detail', '3_hot', egg_detail(3, 'hot', None, datetime.now().isoformat())]
+    ]
+    for change in changes:
+        apply_change(state, change)
+    storage.record('test', changes)
+    batch = storage.capture_cold_eggs(100)
+    storage.archive_eggs(batch)
+    assert storage.drop_archived_eggs(batch)[0] == 2
+    assert '1_old' not in state['eggs_detail']
+    storage.checkpoint()
+    storage.close()
+
+    sqlite = SQLiteStorage(str(tmp_path / 'bot_data.sqlite'), legacy_storage=json_storage(tmp_path))
+    state = sqlite.load()
+    sqlite.attach(lambda: state)
+    assert '3_hot' in state['eggs_detail']
+    assert sqlite.is_hatched('1_old')
+    assert sqlite.is_hatched('9_legacy')
+    assert sqlite.get_egg_detail('1_old')['hatched_by'] == 2
+    assert sqlite.count_hatched_eggs() == 2
+    sqlite.close()
+
+    # Повторный запуск не импортирует заново
+    sqlite = SQLiteStorage(str(tmp_path / 'bot_data.sqlite'), legacy_storage=json_storage(tmp_path))
+    state = sqlite.load()
+    sqlite.attach(lambda: state)
+    assert sqlite.count_hatched_eggs() == 2
+    sqlite.close()
@@ -0,0 +1,130 @@
+"""
+Общая статистика бота без прохода по всем пользователям
+
+admin_stats раньше на каждый запрос собирал множество всех пользователей из
+четырех коллекций, суммировал egg_points и eggs_sent_by_user и дважды
+перебирал daily_eggs_sent. Теперь показатели ведутся на каждом изменении:
+суммы и число пользователей - в UserTable, число пользователей по дате - в
+DailyQuotaMap, количество вылупленных обычных яиц - здесь (hatch_egg
+вызывает egg_hatched()).
+
+Фоновая сверка раз в interval секунд пересчитывает все с нуля и исправляет
+расхождения (например, после ручной правки данных или ошибки в новом коде),
+записывая их в лог и метрики. Подсчет вылупленных яиц идет в хранилище (у
+SQLite - со сбросом очереди в базу), поэтому выполняется в отдельном потоке.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class GlobalTotals:
+    """Общие показатели для admin_stats с периодической сверкой
+
+    count_hatched_eggs() - точный подсчет вылупленных обычных яиц в хранилище
+    (с архивом), при сверке вызывается в отдельном потоке.
+    """
+
+    def __init__(self, user_table, daily_quota, count_hatched_eggs, interval=600.0):
+        self.user_table = user_table
+        self.daily_quota = daily_quota
+        self.count_hatched_eggs = count_hatched_eggs
+        self.interval = interval
+        self.hatched_eggs = count_hatched_eggs()
+
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='totals-reconciler')
+
+        # Метрики
+        self.reconciles = 0
+        self.drifts = 0
+        self.last_drift = None
+        self.last_reconcile_ms = None
+        self.last_reconcile_at = None
+
+    def egg_hatched(self):
+        """Обычное яйцо вылуплено"""
+        self.hatched_eggs += 1
+
+    def summary(self):
+        """Показатели для admin_stats"""
+        today = date.today()
+        online_users = self.daily_quota.users_on(today.isoformat())
+        yesterday = (today - timedelta(days=1)).isoformat()
+        return {
+            'total_users': self.user_table.active_users,
+            'online_users': online_users,
+            'active_users_24h': online_users + self.daily_quota.users_on(yesterday),
+            'total_eggs_sent': self.user_table.totals['sent'],
+            'total_eggs_hatched': self.hatched_eggs,
+            'total_points': self.user_table.totals['points']
+        }
+
+    async def reconcile(self):
+        """Пересчитывает показатели с нуля; возвращает найденные расхождения"""
+        started = time.perf_counter()
+        hatched_before = self.hatched_eggs
+        hatched_eggs = await asyncio.get_running_loop().run_in_executor(self._executor, self.count_hatched_eggs)
+        # Таблицы пересчитываются в цикле событий, где их меняют обработчики
+        drift = self.user_table.recount()
+        for day, counts in self.daily_quota.recount().items():
+            drift[f'users_on_{day}'] = counts
+        # Вылупления во время подсчета могли в него не попасть - сверим в следующий раз
+        if hatched_eggs != self.hatched_eggs and self.hatched_eggs == hatched_before:
+            drift['hatched_eggs'] = (self.hatched_eggs, hatched_eggs)
+            self.hatched_eggs = hatched_eggs
+
+        self.reconciles += 1
+        self.last_reconcile_ms = (time.perf_counter() - started) * 1000
+        self.last_reconcile_at = time.time()
+        if drift:
+            self.drifts += 1
+            self.last_drift = {name: list(counts) for name, counts in drift.items()}
+            logger.warning(f"Global totals drifted, fixed by reconciliation: {drift}")
+        return drift
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                break
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Global totals reconciliation failed: {e}", exc_info=True)
+
+    def start(self):
+        """Запускает периодическую сверку в текущем цикле событий"""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            'reconciles': self.reconciles,
+            'drifts': self.drifts,
+            'last_drift': self.last_drift,
+            'last_reconcile_ms': round(self.last_reconcile_ms, 3) if self.last_reconcile_ms is not None else None,
+            'last_reconcile_at': self.last_reconcile_at,
+            'interval_seconds': self.interval
+        }
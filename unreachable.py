@@ -0,0 +1,144 @@
+"""
+Кэш пользователей, которым бот не может написать
+
+Личное сообщение пользователю, который заблокировал бота, удалил аккаунт или
+ни разу не открывал чат с ботом, всегда заканчивается ошибкой Bot API. Раньше
+каждое вылупление такого пользователя снова тратило запрос и исключение.
+Теперь пользователь запоминается как недоступный на ttl секунд: по ошибкам
+отправки и по апдейтам my_chat_member (бота заблокировали в личном чате).
+Когда пользователь снова пишет боту или разблокирует его, запись снимается.
+
+Записи хранятся в отдельном JSON файле и сохраняются в фоне
+(WriteBehindSaver с capture).
+"""
+
+import json
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden
+
+logger = logging.getLogger(__name__)
+
+# Причины недоступности
+REASON_BLOCKED = 'blocked'
+REASON_DEACTIVATED = 'deactivated'
+REASON_CHAT_NOT_FOUND = 'chat_not_found'
+
+
+def undeliverable_reason(error):
+    """Причина, по которой писать пользователю бесполезно, или None"""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        if 'deactivated' in message:
+            return REASON_DEACTIVATED
+        return REASON_BLOCKED
+    if isinstance(error, BadRequest) and 'chat not found' in message:
+        return REASON_CHAT_NOT_FOUND
+    return None
+
+
+class UnreachableUsers:
+    """Недоступные пользователи {user_id: (until, reason)} с истечением по времени
+
+    until - время по часам time.time(), чтобы записи переживали рестарт.
+    """
+
+    def __init__(self, path=None, ttl=7 * 86400.0):
+        self.path = path
+        self.ttl = ttl
+        self._users = {}
+
+        # Метрики
+        self.marked = 0
+        self.cleared = 0
+        self.expired = 0
+        self.hits = 0
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading unreachable users: {e}")
+            return
+        now = time.time()
+        self._users = {
+            int(user_id): (until, reason)
+            for user_id, (until, reason) in data.items()
+            if until > now
+        }
+        logger.info(f"Loaded {len(self._users)} unreachable users")
+
+    def mark(self, user_id, reason, until=None):
+        """Запоминает пользователя как недоступного, возвращает время истечения"""
+        if until is None:
+            until = time.time() + self.ttl
+        self._users[user_id] = (until, reason)
+        self.marked += 1
+        return until
+
+    def clear(self, user_id):
+        """Снимает отметку; True, если пользователь был в кэше"""
+        if self._users.pop(user_id, None) is None:
+            return False
+        self.cleared += 1
+        return True
+
+    def is_unreachable(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            return False
+        if entry[0] <= time.time():
+            del self._users[user_id]
+            self.expired += 1
+            return False
+        self.hits += 1
+        return True
+
+    def export(self):
+        """Живые записи {user_id: [until, reason]} (для сохранения и обработчиков)"""
+        now = time.time()
+        return {user_id: [until, reason] for user_id, (until, reason) in self._users.items() if until > now}
+
+    def replace(self, items):
+        """Заменяет записи выгрузкой export() (ключи могут быть строками после JSON)"""
+        self._users = {int(user_id): (until, reason) for user_id, (until, reason) in items.items()}
+
+    def capture(self):
+        """Снимает копию для WriteBehindSaver и возвращает функцию записи"""
+        if not self.path:
+            return None
+        data = self.export()
+        if len(data) < len(self._users):
+            # Заодно выбрасываем истекшие записи из памяти
+            self.expired += len(self._users) - len(data)
+            self.replace(data)
+        path = self.path
+
+        def write():
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+        return write
+
+    def stats(self):
+        reasons = {}
+        for _, reason in self._users.values():
+            reasons[reason] = reasons.get(reason, 0) + 1
+        return {
+            'users': len(self._users),
+            'reasons': reasons,
+            'marked': self.marked,
+            'cleared': self.cleared,
+            'expired': self.expired,
+            'hits': self.hits,
+            'ttl_seconds': self.ttl
+        }
@@ -0,0 +1,87 @@
+"""
+Прием апдейтов Telegram через webhook на aiohttp сервере API
+
+В режиме polling бот сам опрашивает getUpdates: лишний круг запросов на каждую
+пачку апдейтов. С webhook Telegram присылает апдейт POST запросом на
+WEBHOOK_URL, и эндпоинт монтируется в тот же aiohttp сервер, что и API.
+
+Апдейты кладутся в ограниченную очередь Application. Если обработчики не
+успевают и очередь заполнена, запрос ждет свободного места не дольше
+put_timeout секунд, после чего отвечает 503 - Telegram повторит доставку позже,
+а бот не копит в памяти неограниченный хвост апдейтов.
+"""
+
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookReceiver:
+    """Эндпоинт webhook: разбирает апдейт и кладет его в очередь с backpressure"""
+
+    def __init__(self, bot, update_queue, secret_token=None, put_timeout=5.0):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+        self.put_timeout = put_timeout
+
+        # Метрики
+        self.received = 0
+        self.rejected = 0
+        self.invalid = 0
+        self.waited = 0
+        self.max_wait_ms = 0.0
+        self.max_depth = 0
+
+    async def handle(self, request):
+        if self.secret_token and request.headers.get(SECRET_HEADER) != self.secret_token:
+            logger.warning("Webhook request with invalid secret token")
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.bot)
+        except Exception as e:
+            self.invalid += 1
+            logger.error(f"Invalid webhook update: {e}")
+            return web.Response(status=400)
+
+        queue = self.update_queue
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Очередь заполнена - ждем, пока обработчики ее разгрузят
+            self.waited += 1
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(queue.put(update), self.put_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                logger.warning(f"Update queue is full ({queue.qsize()}), rejecting update {update.update_id}")
+                return web.Response(status=503)
+            wait_ms = (time.perf_counter() - started) * 1000
+            if wait_ms > self.max_wait_ms:
+                self.max_wait_ms = wait_ms
+
+        self.received += 1
+        depth = queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return web.Response(status=200)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'invalid': self.invalid,
+            'waited_for_queue': self.waited,
+            'max_wait_ms': round(self.max_wait_ms, 3),
+            'queue_depth': self.update_queue.qsize(),
+            'max_queue_depth': self.max_depth,
+            'queue_size': self.update_queue.maxsize
+        }